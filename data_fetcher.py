@@ -1,25 +1,23 @@
-import ccxt
 import pandas as pd
 import time
 import datetime
 import ta
 import os
-import threading
+import pickle
+
+from utils.bar_log import BarLog
+from utils.indicators import IndicatorEngine, bar_columns, indicator_columns
+from utils.market_data import CcxtSource, ExchangeError, NetworkError
 
 class CryptoDataLoader:
-    def __init__(self, exchange_name='binance', symbol='BTC/USDT', timeframe='1m', csv_filename=None, start_time_str=None):
-        proxies = {
-            'http': 'http://127.0.0.1:4780',
-            'https': 'http://127.0.0.1:4780',
-        }
-
-        self.exchange = getattr(ccxt, exchange_name)({
-            'proxies': proxies
-        }) if proxies else getattr(ccxt, exchange_name)()
-        
+    def __init__(self, exchange_name='binance', symbol='BTC/USDT', timeframe='1m', csv_filename=None, start_time_str=None,
+                 source=None, proxy=None, retry_delay=20):
+        # source of the bars (utils.market_data), a ccxt exchange by default or e.g. a SimulatedExchange
+        self.exchange = source if source is not None else CcxtSource(exchange_name, proxy)
+        self.retry_delay = retry_delay  # seconds before retrying a failed request
+
         self.symbol = symbol
         self.timeframe = timeframe
-        self.df = pd.DataFrame()  # Initialize empty DataFrame to hold data
         if(csv_filename == None):
             self.csv_filename = './dataset/btc/realtime-' + timeframe + '.csv'
         else:
@@ -27,23 +25,37 @@ class CryptoDataLoader:
 
         self.window_size = 300  # Buffer for the real-time data loading
         if(start_time_str == None):
-            self.start_time_str = (datetime.datetime.utcnow() - datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+            # one day before the current time of the source (the replayed time of a simulated exchange)
+            now = datetime.datetime.utcfromtimestamp(self.exchange.milliseconds() / 1000)
+            self.start_time_str = (now - datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
         else:
             self.start_time_str = start_time_str
         self.from_ts = self.exchange.parse8601(self.start_time_str)
-        self.exit_flag = threading.Event()
-        self.write_interval = 3600  # Write to CSV every hour (3600 seconds)
-
-        # Start a separate thread to handle periodic CSV writing
-        self.write_thread = threading.Thread(target=self.periodic_write_to_csv)
-        self.write_thread.start()
-
-        if not os.path.exists(self.csv_filename):
-            self.load_initial_data()
+        self.indicators = None  # IndicatorEngine of the bars in the log, updated by append_new_data
+
+        # bars are appended to a binary bar log as they arrive, the csv is only an export (save_to_csv).
+        # The log holds the rows with indicators and is the history (get_data reads it through its memory
+        # map), the raw log every fetched bar (including the rows the indicators drop) so that the indicator
+        # state can be rebuilt exactly
+        self.log_filename = os.path.splitext(self.csv_filename)[0] + '.bars'
+        self.raw_log_filename = os.path.splitext(self.csv_filename)[0] + '.raw.bars'
+        self.state_filename = self.log_filename + '.state'
+        self.log = None
+        self.raw_log = None
+        if os.path.exists(self.log_filename):
+            self.log = BarLog(self.log_filename)
+            self.open_raw_log()
+            self.load_state()
+        elif os.path.exists(self.csv_filename):
+            # csv written by a previous version, moved into the bar log once
+            rows = pd.read_csv(self.csv_filename, parse_dates=['date'])
+            self.log = BarLog(self.log_filename, rows.columns[1:])
+            self.log.append(rows)
+            self.open_raw_log()
+            self.load_state()
         else:
-            self.df = pd.read_csv(self.csv_filename, parse_dates=['date'])
-            # print(f"Data loaded from {self.csv_filename}")
-            # self.print_latest_data()
+            self.raw_log = BarLog(self.raw_log_filename, bar_columns[1:])
+            self.load_initial_data()
         
         
     def fetch_all_ohlcv(self, since):
@@ -56,12 +68,12 @@ class CryptoDataLoader:
                 all_bars.extend(bars)
                 since = bars[-1][0] + 1  # Move to the next chunk
                 time.sleep(self.exchange.rateLimit / 1000)  # Respect rate limit
-            except ccxt.NetworkError as e:
-                print(f"Network error: {e}. Retrying in 20 seconds...")
-                time.sleep(20)
-            except ccxt.ExchangeError as e:
-                print(f"Exchange error: {e}. Retrying in 20 seconds...")
-                time.sleep(20)
+            except (NetworkError, ExchangeError) as e:
+                # never sooner than the rate limit allows
+                delay = max(self.retry_delay, self.exchange.rateLimit / 1000)
+                kind = 'Network' if isinstance(e, NetworkError) else 'Exchange'
+                print(f"{kind} error: {e}. Retrying in {delay} seconds...")
+                time.sleep(delay)
         return all_bars
 
     @staticmethod
@@ -108,63 +120,106 @@ class CryptoDataLoader:
     def load_initial_data(self, from_ts=None):
         from_ts = from_ts or self.from_ts
         all_bars = self.fetch_all_ohlcv(from_ts)
-        self.df = pd.DataFrame(all_bars, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        self.df['timestamp'] = pd.to_datetime(self.df['timestamp'], unit='ms')
-        self.df.rename(columns={'timestamp': 'date', 'close': 'OT'}, inplace=True)
-        self.df = self.add_indicators(self.df)
-        print("Initial data loaded into memory.")
+        df = pd.DataFrame(all_bars, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
+        df.rename(columns={'timestamp': 'date', 'close': 'OT'}, inplace=True)
+        self.raw_log.append(df)
+        # same rows as add_indicators, and the state to update them bar by bar later
+        self.indicators = IndicatorEngine()
+        df = self.indicators.update(df)
+        if self.log is None:
+            self.log = BarLog(self.log_filename, bar_columns[1:] + indicator_columns)
+        self.log.append(df)
+        self.save_state()
+        print("Initial data loaded into the bar log.")
         print("All data:")
-        print(self.df)
+        print(df)
         
-    def append_new_data(self):
-        print(f"Fetching latest data for {self.symbol} and updating in-memory data.")
-        last_timestamp = int(self.df['date'].iloc[-1].timestamp() * 1000) if not self.df.empty else self.from_ts
+    def append_new_data(self, verbose=True):
+        # returns the rows added to the log, None when there are no new bars. verbose=False (the realtime
+        # feed refreshing every few seconds) only returns them, without printing on every call
+        if verbose:
+            print(f"Fetching latest data for {self.symbol} and updating the bar log.")
+        if self.indicators is not None and self.indicators.last_date is not None:
+            last_timestamp = int(self.indicators.last_date.timestamp() * 1000)
+        else:
+            last_timestamp = self.from_ts
         new_bars = self.fetch_all_ohlcv(last_timestamp + 1)
         
         if new_bars:
             new_df = pd.DataFrame(new_bars, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
             new_df['timestamp'] = pd.to_datetime(new_df['timestamp'], unit='ms')
             new_df.rename(columns={'timestamp': 'date', 'close': 'OT'}, inplace=True)
+            self.raw_log.append(new_df)
             
-            self.df = pd.concat([self.df, new_df], ignore_index=True)
-            self.df = self.add_indicators(self.df)
-            # print("In-memory data has been updated.")
-            # print("All data:")
-            # print(self.df)
-            self.print_latest_data()
+            if self.indicators is None:
+                self.indicators = IndicatorEngine()
+            # only the new bars are computed, from the rolling state of the previous ones
+            new_df = self.indicators.update(new_df)
+            self.log.append(new_df)
+            self.save_state()
+            if verbose:
+                self.print_latest_data()
+            return new_df
         else:
-            print("No new data to append.")
-
-    def periodic_write_to_csv(self):
-        while not self.exit_flag.is_set():
-            self.exit_flag.wait(self.write_interval)
-            self.save_to_csv()
-
-    def save_to_csv(self):
-        if not self.df.empty:
-            self.df.to_csv(self.csv_filename, index=False)
-            print(f"Data saved to {self.csv_filename}")
+            if verbose:
+                print("No new data to append.")
+            return None
+
+    def open_raw_log(self):
+        self.raw_log = BarLog(self.raw_log_filename, bar_columns[1:])
+        if len(self.raw_log) == 0 and len(self.log) > 0:
+            # log of a previous version without raw bars: only its rows can be replayed
+            self.raw_log.append(self.log.frame())
+
+    def save_state(self):
+        # indicator state of the raw bars, so that a restart continues them without replaying the raw log
+        tmp_filename = self.state_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump((len(self.raw_log), self.indicators), f)
+        os.replace(tmp_filename, self.state_filename)
+
+    def load_state(self):
+        if os.path.exists(self.state_filename):
+            with open(self.state_filename, 'rb') as f:
+                length, indicators = pickle.load(f)
+            if length == len(self.raw_log):
+                self.indicators = indicators
+                return
+        self.replay()
+
+    def replay(self):
+        # missing or stale state (e.g. a crash between two writes): rebuilt from all the raw bars, the rows
+        # of bars that did not reach the log yet are appended to it
+        self.indicators = IndicatorEngine()
+        rows = self.indicators.update(self.raw_log.frame())
+        if self.log.last_time is not None:
+            rows = rows[rows['date'] > pd.Timestamp(self.log.last_time, unit='ms')]
+        if len(rows) > 0:
+            self.log.append(rows)
+        self.save_state()
+
+    def save_to_csv(self, filename=None):
+        filename = filename or self.csv_filename
+        if len(self.log) > 0:
+            self.log.to_csv(filename)
+            print(f"Data saved to {filename}")
 
     def get_data(self, begin=None, end=None):
-        # print("Returning all data:")
-        # print(self.df)
-        if(begin == None):
-            return self.df
-        else:
-            return self.df.iloc[begin:end]
+        # rows [begin, end) of the history, read from the bar log on demand
+        return self.log.frame(begin, end)
 
     def print_latest_data(self):
-        if not self.df.empty:
-            latest_data = self.df.iloc[-1]
+        if len(self.log) > 0:
+            latest_data = self.log.frame(-1).iloc[0]
             print("Latest data:")
             print(latest_data)
             return latest_data
 
     def stop(self):
-        self.exit_flag.set()
-        self.write_thread.join()
-        # self.save_to_csv()
-        print("Data loader has been stopped and data saved to CSV.")
+        self.log.close()
+        self.raw_log.close()
+        print("Data loader has been stopped, bars are in " + self.log_filename)
 
 if __name__ == "__main__":
     exchange_name = 'binance'
@@ -181,5 +236,6 @@ if __name__ == "__main__":
     # except KeyboardInterrupt:
     #     loader.stop()
 
-    loader = CryptoDataLoader(exchange_name, symbol, timeframe, csv_filename, start_time_str)
+    loader = CryptoDataLoader(exchange_name, symbol, timeframe, csv_filename, start_time_str,
+                              proxy='http://127.0.0.1:4780')
     loader.stop()
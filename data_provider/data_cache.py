@@ -0,0 +1,159 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def source_key(dataset):
+    """
+    Key of the parsed source of a forecasting dataset. It changes whenever the file or any option that
+    affects the scaled values or the time stamps changes.
+    """
+    path = os.path.abspath(os.path.join(dataset.root_path, dataset.data_path))
+    fields = [type(dataset).__name__, path, os.stat(path).st_mtime_ns,
+              dataset.features, dataset.target, dataset.scale, dataset.timeenc, dataset.freq]
+    return hashlib.md5('|'.join(map(str, fields)).encode()).hexdigest()[:16]
+
+
+def cache_files(dataset, key):
+    prefix = '{}.{}'.format(os.path.join(dataset.root_path, dataset.data_path), key)
+    return {name: '{}.{}.npy'.format(prefix, name) for name in ('data', 'stamp', 'scaler')}
+
+
+def save_array(path, array):
+    # write to a temporary file first so that a crashed run never leaves a truncated cache behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_arrays(path, **arrays):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def restore_scaler(scaler, stats):
+    """
+    Turns a `sklearn.preprocessing.StandardScaler` into a fitted one from saved (mean, scale) statistics.
+    """
+    scaler.mean_ = stats[0]
+    scaler.scale_ = stats[1]
+    scaler.var_ = stats[1] ** 2
+    scaler.n_features_in_ = stats.shape[1]
+    scaler.n_samples_seen_ = 0
+    return scaler
+
+
+# parsed sources of the current experiment: (source key, data_cache) -> (data, data_stamp, scaler)
+_sources = {}
+
+
+def load_source(dataset, read_source):
+    """
+    Returns the scaled data and the time stamps of the whole source file of a forecasting dataset.
+
+    The source is read and normalized once per experiment: the train/val/test splits of the same file get the
+    same arrays and the same fitted scaler (assigned to `dataset.scaler`) and only slice their own borders.
+
+    With `args.data_cache` the result of `read_source` is also stored as float32 .npy files next to the source
+    file together with the scaler statistics, and later runs memory-map them instead of parsing the file again.
+    Slicing the returned arrays does not copy.
+
+    :param dataset: dataset with root_path, data_path, features, target, scale, timeenc, freq and scaler.
+    :param read_source: callable parsing the source file; returns (data, data_stamp) and fits `dataset.scaler`.
+    """
+    key = source_key(dataset)
+    if (key, dataset.args.data_cache) in _sources:
+        data, data_stamp, dataset.scaler = _sources[key, dataset.args.data_cache]
+        return data, data_stamp
+
+    if dataset.args.data_cache:
+        data, data_stamp = load_cached_source(dataset, key, read_source)
+    else:
+        data, data_stamp = read_source()
+    _sources[key, dataset.args.data_cache] = data, data_stamp, dataset.scaler
+    return data, data_stamp
+
+
+# scalers fitted in the current experiment: source key -> scaler
+_scalers = {}
+
+
+def load_scaler(dataset, fit_scaler):
+    """
+    Returns the scaler of the source of `dataset`, fitted once per experiment by `fit_scaler()`.
+    Used by the datasets that read their source split by split or in chunks instead of loading it whole.
+    """
+    key = source_key(dataset)
+    if key not in _scalers:
+        _scalers[key] = fit_scaler()
+    return _scalers[key]
+
+
+def load_cached_source(dataset, key, read_source):
+    files = cache_files(dataset, key)
+    if all(os.path.exists(f) for f in files.values()):
+        stats = np.load(files['scaler'])
+        if dataset.scale:
+            restore_scaler(dataset.scaler, stats)
+    else:
+        data, data_stamp = read_source()
+        if dataset.scale:
+            stats = np.stack([dataset.scaler.mean_, dataset.scaler.scale_]).astype(np.float64)
+        else:
+            stats = np.zeros((2, 0))
+        save_array(files['data'], np.asarray(data, dtype=np.float32))
+        save_array(files['stamp'], np.asarray(data_stamp, dtype=np.float32))
+        save_array(files['scaler'], stats)
+
+    data = np.load(files['data'], mmap_mode='r')
+    data_stamp = np.load(files['stamp'], mmap_mode='r')
+    return data, data_stamp
+
+
+# arrays derived from source files in the current experiment: (files key, data_cache, name) -> array
+_arrays = {}
+
+
+def load_arrays(dataset, names, compute):
+    """
+    Returns the arrays `names` derived from the source files of a dataset, computed together by `compute()`
+    (a list in the order of `names`) once per experiment and shared by the instances of all flags.
+
+    With `args.data_cache` they are also stored as .npy files next to the sources, and later runs
+    memory-map them instead of reading and scaling the sources again.
+
+    :param dataset: dataset with args, root_path and the names of its `source_files` in root_path.
+    """
+    paths = [os.path.abspath(os.path.join(dataset.root_path, f)) for f in dataset.source_files]
+    fields = [type(dataset).__name__] + ['{}:{}'.format(p, os.stat(p).st_mtime_ns) for p in paths]
+    key = hashlib.md5('|'.join(fields).encode()).hexdigest()[:16]
+    data_cache = dataset.args.data_cache
+    if all((key, data_cache, name) in _arrays for name in names):
+        return [_arrays[key, data_cache, name] for name in names]
+
+    if data_cache:
+        files = [os.path.join(dataset.root_path, '{}.{}.{}.npy'.format(type(dataset).__name__, key, name))
+                 for name in names]
+        if not all(os.path.exists(f) for f in files):
+            for f, array in zip(files, compute()):
+                save_array(f, array)
+        arrays = [np.load(f, mmap_mode='r') for f in files]
+    else:
+        arrays = compute()
+    for name, array in zip(names, arrays):
+        _arrays[key, data_cache, name] = array
+    return arrays
+
+
+def clear():
+    """
+    Drops the sources, scalers and arrays loaded so far, called with `data_factory.clear_views` when an
+    experiment starts so that they do not outlive it (the .npy files of args.data_cache are kept).
+    """
+    _sources.clear()
+    _scalers.clear()
+    _arrays.clear()
@@ -1,7 +1,12 @@
 from data_provider.data_loader import Dataset_Custom_minute, Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_M4, PSMSegLoader, \
-    MSLSegLoader, SMAPSegLoader, SMDSegLoader, SWATSegLoader, UEAloader, Dataset_BTC_minute, Dataset_BTC_RT_minute
-from data_provider.uea import collate_fn
-from torch.utils.data import DataLoader
+    MSLSegLoader, SMAPSegLoader, SMDSegLoader, SWATSegLoader, UEAloader, Dataset_BTC_minute, Dataset_BTC_RT_minute, \
+    SharedMemoryDataset, Dataset_Stream
+from data_provider.uea import collate_fn, BucketBatchSampler
+from data_provider.device_loader import DeviceWindowLoader, fits_on_device, upload_size
+from data_provider import data_cache
+from utils.augmentation import seed_worker
+import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 
 data_dict = {
     'rtBTC': Dataset_BTC_RT_minute,
@@ -20,8 +25,51 @@ data_dict = {
     'UEA': UEAloader
 }
 
+# datasets --stream can replace: the 70/10/20 split and train scaler of Dataset_Custom
+stream_data = ['custom', 'BTC']
 
-def data_provider(args, flag):
+# classification models --dynamic_padding can feed, they pad their encoder output back to seq_len
+dynamic_padding_models = ['TimesNet', 'Transformer', 'Informer', 'Reformer']
+
+# arguments Exp_Classification sets from the data it has loaded, the classification collate reads seq_len lazily
+derived_args = ['seq_len', 'label_len', 'pred_len', 'enc_in', 'num_class']
+
+# (data_set, data_loader) views built for the current experiment, at most max_views of them
+_views = {}
+max_views = 8
+
+
+def clear_views():
+    """
+    Drops the views built so far and the data they were loaded from, called when an experiment starts so
+    that they do not outlive it.
+    """
+    _views.clear()
+    data_cache.clear()
+
+
+def data_provider(args, flag, feed=None):
+    """
+    Returns the dataset and the loader of a split. Repeated calls with the same arguments and flag in one
+    experiment (e.g. the train set rebuilt by Exp_Anomaly_Detection.test) return the views built before.
+    The key is every argument, a change of any of them builds new views.
+    The realtime BTC data is rebuilt on every call as it changes between calls, as a view over the newest
+    bars of `feed` (a data_provider.realtime_feed.RealtimeFeed) when one is given.
+    """
+    if args.data == 'rtBTC':
+        return build_data(args, flag, feed)
+
+    ignored = derived_args if args.task_name == 'classification' else []
+    key = (flag,) + tuple(sorted((name, repr(value)) for name, value in vars(args).items() if name not in ignored))
+    if key not in _views:
+        if len(_views) >= max_views:
+            # the oldest view goes first
+            del _views[next(iter(_views))]
+        _views[key] = build_data(args, flag)
+    return _views[key]
+
+
+def build_data(args, flag, feed=None):
     Data = data_dict[args.data]
     timeenc = 0 if args.embed != 'timeF' else 1
 
@@ -39,6 +87,8 @@ def data_provider(args, flag):
             flag=flag,
         )
         print(flag, len(data_set))
+        if args.num_workers > 0:
+            data_set.share_memory()
         data_loader = DataLoader(
             data_set,
             batch_size=batch_size,
@@ -47,6 +97,9 @@ def data_provider(args, flag):
             drop_last=drop_last)
         return data_set, data_loader
     elif args.task_name == 'classification':
+        if args.dynamic_padding and args.model not in dynamic_padding_models:
+            raise ValueError('--dynamic_padding is only supported by {}, not {}'.format(
+                ', '.join(dynamic_padding_models), args.model))
         drop_last = False
         data_set = Data(
             args = args,
@@ -54,18 +107,45 @@ def data_provider(args, flag):
             flag=flag,
         )
 
+        if args.length_buckets > 0:
+            # batches of similar lengths, padded to their longest sample with --dynamic_padding
+            batch_sampler = BucketBatchSampler(data_set.lengths, batch_size, shuffle=shuffle_flag,
+                                               drop_last=drop_last, num_buckets=args.length_buckets)
+            data_loader = DataLoader(
+                data_set,
+                batch_sampler=batch_sampler,
+                num_workers=args.num_workers,
+                worker_init_fn=seed_worker,
+                collate_fn=lambda x: collate_fn(x, max_len=None if args.dynamic_padding else args.seq_len,
+                                                transform=data_set.collate_transform)
+            )
+            return data_set, data_loader
+
         data_loader = DataLoader(
             data_set,
             batch_size=batch_size,
             shuffle=shuffle_flag,
             num_workers=args.num_workers,
             drop_last=drop_last,
-            collate_fn=lambda x: collate_fn(x, max_len=args.seq_len)
+            worker_init_fn=seed_worker,
+            collate_fn=lambda x: collate_fn(x, max_len=None if args.dynamic_padding else args.seq_len,
+                                            transform=data_set.collate_transform)
         )
         return data_set, data_loader
     else:
         if args.data == 'm4':
             drop_last = False
+        stream_kwargs = {}
+        if args.stream:
+            if args.data not in stream_data:
+                raise ValueError('--stream reads the split of Dataset_Custom, it supports --data {} and not {}'.format(
+                    ' / '.join(stream_data), args.data))
+            if args.augmentation_ratio > 0:
+                raise ValueError('--stream does not apply augmentation, use --augmentation_ratio 0')
+            # the dataset reads the source in chunks and shuffles through its own buffer
+            stream_kwargs = {'minute_unit': Data.minute_unit}
+            Data = Dataset_Stream
+            shuffle_flag = False
         data_set = Data(
             args = args,
             root_path=args.root_path,
@@ -76,12 +156,45 @@ def data_provider(args, flag):
             target=args.target,
             timeenc=timeenc,
             freq=freq,
-            seasonal_patterns=args.seasonal_patterns
+            seasonal_patterns=args.seasonal_patterns,
+            **({'feed': feed} if args.data == 'rtBTC' else {}),
+            **stream_kwargs
         )
-        data_loader = DataLoader(
-            data_set,
-            batch_size=batch_size,
-            shuffle=shuffle_flag,
-            num_workers=args.num_workers,
-            drop_last=drop_last)
+        if args.stream:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
+            return data_set, data_loader
+        if args.data_on_device and args.data not in ['m4', 'rtBTC']:
+            device = torch.device('cuda:{}'.format(args.gpu)) if args.use_gpu else torch.device('cpu')
+            if fits_on_device(data_set, device):
+                data_loader = DeviceWindowLoader(
+                    data_set,
+                    batch_size=batch_size,
+                    shuffle=shuffle_flag,
+                    drop_last=drop_last,
+                    device=device)
+                return data_set, data_loader
+            print('--data_on_device: the {} data ({:.1f} MB) does not fit in the free memory of {}, '
+                  'using the DataLoader'.format(flag, upload_size(data_set) / 2 ** 20, device))
+
+        if args.num_workers > 0 and isinstance(data_set, SharedMemoryDataset):
+            data_set.share_memory()
+        if (args.window_batch or args.data == 'm4') and args.data != 'rtBTC':
+            # the dataset receives the index list of a whole batch and gathers all windows at once
+            sampler = RandomSampler(data_set) if shuffle_flag else SequentialSampler(data_set)
+            data_loader = DataLoader(
+                data_set,
+                batch_size=None,
+                sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+                num_workers=args.num_workers)
+        else:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
         return data_set, data_loader
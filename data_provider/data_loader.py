@@ -1,24 +1,89 @@
+import hashlib
 import os
 import numpy as np
 import pandas as pd
 import glob
 import re
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
 from sklearn.preprocessing import StandardScaler
-from utils.timefeatures import time_features
-from data_provider.m4 import M4Dataset, M4Meta
+from utils.timefeatures import time_stamp
+from data_provider.m4 import M4Dataset, M4Meta, pack_series
+from data_provider.data_cache import load_source, load_scaler, load_arrays, restore_scaler, save_arrays
+from data_provider.readers import is_columnar, frame_columns, frame_length, read_frame, count_rows, iter_frames, \
+    iter_ranges
 from data_provider.uea import subsample, interpolate_missing, Normalizer
 from sktime.datasets import load_from_tsfile_to_dataframe
 import warnings
 from utils.augmentation import run_augmentation_single
-from data_fetcher import CryptoDataLoader
+from utils.batch_augmentation import BatchAugmentation, sample_presets
+from data_provider.realtime_feed import RealtimeFeed
 warnings.filterwarnings('ignore')
 
-class Dataset_BTC_RT_minute(Dataset):
+
+def window_batch(dataset, index):
+    """
+    Gathers a whole batch of sliding windows in one vectorized indexing operation per array.
+    Equivalent to stacking `dataset[i]` for every i in `index`, without the per-sample Python overhead.
+
+    :param dataset: forecasting dataset with seq_len, label_len, pred_len, data_x, data_y and data_stamp.
+    :param index: sequence of window start positions.
+    :return: seq_x, seq_y, seq_x_mark, seq_y_mark, each of shape (batch, window length, dim).
+    """
+    s_begin = np.asarray(index)[:, None]
+    r_begin = s_begin + dataset.seq_len - dataset.label_len
+    s_index = s_begin + np.arange(dataset.seq_len)
+    r_index = r_begin + np.arange(dataset.label_len + dataset.pred_len)
+
+    seq_x = np.take(dataset.data_x, s_index, axis=0)
+    seq_y = np.take(dataset.data_y, r_index, axis=0)
+    seq_x_mark = np.take(dataset.data_stamp, s_index, axis=0)
+    seq_y_mark = np.take(dataset.data_stamp, r_index, axis=0)
+
+    return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+
+class SharedMemoryDataset(Dataset):
+    """
+    Dataset whose arrays can be moved to shared memory once in the parent process, so that every
+    DataLoader worker maps the same pages instead of holding its own copy of the data.
+    Subclasses list the attribute names of their arrays in `shared_arrays`.
+    """
+    shared_arrays = ('data_x', 'data_y', 'data_stamp')
+
+    def share_memory(self):
+        shared = self.__dict__.setdefault('_shared_tensors', {})
+        by_buffer = {}
+        for name in self.shared_arrays:
+            array = getattr(self, name, None)
+            # memory-mapped caches are already shared through the page cache
+            if name in shared or not isinstance(array, np.ndarray) or isinstance(array, np.memmap) \
+                    or array.dtype == object:
+                continue
+            # data_x and data_y are usually two views of the same rows, share them only once
+            buffer = (array.__array_interface__['data'][0], array.shape, array.strides, array.dtype.str)
+            if buffer not in by_buffer:
+                by_buffer[buffer] = torch.from_numpy(np.ascontiguousarray(array)).share_memory_()
+            shared[name] = by_buffer[buffer]
+            setattr(self, name, shared[name].numpy())
+        return self
+
+    def __getstate__(self):
+        # workers started by pickling the dataset receive the shared tensors, not copies of the arrays
+        state = self.__dict__.copy()
+        for name in state.get('_shared_tensors', {}):
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, tensor in state.get('_shared_tensors', {}).items():
+            setattr(self, name, tensor.numpy())
+
+class Dataset_BTC_RT_minute(SharedMemoryDataset):
     def __init__(self, args, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
-                 target='OT', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
+                 target='OT', scale=True, timeenc=0, freq='t', seasonal_patterns=None, feed=None):
         self.args = args
         self.root_path = root_path
         self.flag = flag
@@ -34,21 +99,21 @@ class Dataset_BTC_RT_minute(Dataset):
         self.label_len = size[1]
         self.pred_len = size[2]
 
-        # Initialize CryptoDataLoader
-        self.loader = CryptoDataLoader()
-        if(args.backtest == False):
-            self.loader.append_new_data()
-
-        # Initial read data
-        self.__read_data__()
+        # a view over the newest bars of a long-lived RealtimeFeed (owned by the predictor); without one the
+        # bars are fetched once for this dataset
+        if feed is None:
+            feed = RealtimeFeed(args, capacity=self.seq_len, interval=None)
+            self.__read_data__(feed)
+            feed.stop()
+        else:
+            self.__read_data__(feed)
 
-    def __read_data__(self):
+    def __read_data__(self, feed):
         self.scaler = StandardScaler()
         if(self.args.backtest == False):
-            df_raw = self.loader.get_data(-self.seq_len)
+            df_raw = feed.latest(self.seq_len)
         else:
-            df_raw = self.loader.get_data(self.args.seq_begin, self.args.seq_end)
-        self.loader.stop()
+            df_raw = feed.window(self.args.seq_begin, self.args.seq_end)
         '''
         df_raw.columns: ['date', ...(other features), target feature]
         '''
@@ -71,20 +136,11 @@ class Dataset_BTC_RT_minute(Dataset):
         else:
             data = df_data.values
 
-        df_stamp = df_raw[['date']]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        self.last_time = pd.to_datetime(df_stamp['date'].values)[-1]
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            df_stamp['minute'] = df_stamp.date.apply(lambda row: row.minute, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        dates = pd.to_datetime(df_raw['date'].values)
+        self.last_time = dates[-1]
+        data_stamp = time_stamp(dates, self.timeenc, self.freq, minute_unit=1)
 
+        data = data.astype(np.float32)
         self.data_x = data
         self.data_y = data
 
@@ -115,10 +171,10 @@ class Dataset_BTC_RT_minute(Dataset):
 
 
 
-class Dataset_Custom_minute(Dataset):
+class Dataset_BTC_minute(SharedMemoryDataset):
     def __init__(self, args, root_path, flag='train', size=None,
-                 features='S', data_path='ETTh1.csv',
-                 target='OT', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
+                 features='MS', data_path='btc_usdt_1m_data.csv',
+                 target='close', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
         # size [seq_len, label_len, pred_len]
         self.args = args
         # info
@@ -149,19 +205,11 @@ class Dataset_Custom_minute(Dataset):
         self.scaler = StandardScaler()
         df_raw = pd.read_csv(os.path.join(self.root_path,
                                           self.data_path))
-
-        '''
-        df_raw.columns: ['date', ...(other features), target feature]
-        '''
-        cols = list(df_raw.columns)
-        cols.remove(self.target)
-        cols.remove('date')
-        df_raw = df_raw[['date'] + cols + [self.target]]
-        num_train = int(len(df_raw) * 0.7)
-        num_test = int(len(df_raw) * 0.2)
-        num_vali = len(df_raw) - num_train - num_test
-        border1s = [0, num_train - self.seq_len, len(df_raw) - num_test - self.seq_len]
-        border2s = [num_train, num_train + num_vali, len(df_raw)]
+        train_month = 2 # 12
+        val_month = 1   # 4
+        test_month = 1  # 4
+        border1s = [0, train_month * 30 * 24 * 60 - self.seq_len, (train_month + val_month) * 30 * 24 * 60 - self.seq_len]
+        border2s = [train_month * 30 * 24 * 60, (train_month + val_month) * 30 * 24 * 60, (train_month + test_month + val_month) * 30 * 24 * 60]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
@@ -178,19 +226,11 @@ class Dataset_Custom_minute(Dataset):
         else:
             data = df_data.values
 
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            df_stamp['minute'] = df_stamp.date.apply(lambda row: row.minute, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        cache_dir = self.root_path if self.args.data_cache else None
+        data_stamp = time_stamp(df_raw['timestamp'][border1:border2], self.timeenc, self.freq, minute_unit=1,
+                                cache_dir=cache_dir)
 
+        data = data.astype(np.float32)
         self.data_x = data[border1:border2]
         self.data_y = data[border1:border2]
 
@@ -200,6 +240,8 @@ class Dataset_Custom_minute(Dataset):
         self.data_stamp = data_stamp
 
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return window_batch(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
@@ -219,10 +261,10 @@ class Dataset_Custom_minute(Dataset):
         return self.scaler.inverse_transform(data)
 
 
-class Dataset_BTC_minute(Dataset):
+class Dataset_ETT_hour(SharedMemoryDataset):
     def __init__(self, args, root_path, flag='train', size=None,
-                 features='MS', data_path='btc_usdt_1m_data.csv',
-                 target='close', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
+                 features='S', data_path='ETTh1.csv',
+                 target='OT', scale=True, timeenc=0, freq='h', seasonal_patterns=None):
         # size [seq_len, label_len, pred_len]
         self.args = args
         # info
@@ -251,16 +293,25 @@ class Dataset_BTC_minute(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-        train_month = 2 # 12
-        val_month = 1   # 4
-        test_month = 1  # 4
-        border1s = [0, train_month * 30 * 24 * 60 - self.seq_len, (train_month + val_month) * 30 * 24 * 60 - self.seq_len]
-        border2s = [train_month * 30 * 24 * 60, (train_month + val_month) * 30 * 24 * 60, (train_month + test_month + val_month) * 30 * 24 * 60]
+        data, data_stamp = load_source(self, self.__read_source__)
+
+        border1s = [0, 12 * 30 * 24 - self.seq_len, 12 * 30 * 24 + 4 * 30 * 24 - self.seq_len]
+        border2s = [12 * 30 * 24, 12 * 30 * 24 + 4 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
+        self.data_x = data[border1:border2]
+        self.data_y = data[border1:border2]
+
+        if self.set_type == 0 and self.args.augmentation_ratio > 0:
+            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
+            
+        self.data_stamp = data_stamp[border1:border2]
+
+    def __read_source__(self):
+        df_raw = pd.read_csv(os.path.join(self.root_path,
+                                          self.data_path))
+
         if self.features == 'M' or self.features == 'MS':
             cols_data = df_raw.columns[1:]
             df_data = df_raw[cols_data]
@@ -268,34 +319,18 @@ class Dataset_BTC_minute(Dataset):
             df_data = df_raw[[self.target]]
 
         if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
+            train_data = df_data[0:12 * 30 * 24]
             self.scaler.fit(train_data.values)
             data = self.scaler.transform(df_data.values)
         else:
             data = df_data.values
 
-        df_stamp = df_raw[['timestamp']][border1:border2]
-        df_stamp['timestamp'] = pd.to_datetime(df_stamp.timestamp)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.timestamp.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.timestamp.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.timestamp.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.timestamp.apply(lambda row: row.hour, 1)
-            df_stamp['minute'] = df_stamp.timestamp.apply(lambda row: row.minute, 1)
-            data_stamp = df_stamp.drop(['timestamp'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['timestamp'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
-
-        self.data_x = data[border1:border2]
-        self.data_y = data[border1:border2]
-
-        if self.set_type == 0 and self.args.augmentation_ratio > 0:
-            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
-
-        self.data_stamp = data_stamp
+        data_stamp = time_stamp(df_raw['date'], self.timeenc, self.freq)
+        return data.astype(np.float32), data_stamp
 
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return window_batch(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
@@ -315,10 +350,10 @@ class Dataset_BTC_minute(Dataset):
         return self.scaler.inverse_transform(data)
 
 
-class Dataset_ETT_hour(Dataset):
+class Dataset_ETT_minute(SharedMemoryDataset):
     def __init__(self, args, root_path, flag='train', size=None,
-                 features='S', data_path='ETTh1.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', seasonal_patterns=None):
+                 features='S', data_path='ETTm1.csv',
+                 target='OT', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
         # size [seq_len, label_len, pred_len]
         self.args = args
         # info
@@ -347,14 +382,25 @@ class Dataset_ETT_hour(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        data, data_stamp = load_source(self, self.__read_source__)
 
-        border1s = [0, 12 * 30 * 24 - self.seq_len, 12 * 30 * 24 + 4 * 30 * 24 - self.seq_len]
-        border2s = [12 * 30 * 24, 12 * 30 * 24 + 4 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
+        border1s = [0, 12 * 30 * 24 * 4 - self.seq_len, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.seq_len]
+        border2s = [12 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 8 * 30 * 24 * 4]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
+        self.data_x = data[border1:border2]
+        self.data_y = data[border1:border2]
+
+        if self.set_type == 0 and self.args.augmentation_ratio > 0:
+            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
+
+        self.data_stamp = data_stamp[border1:border2]
+
+    def __read_source__(self):
+        df_raw = pd.read_csv(os.path.join(self.root_path,
+                                          self.data_path))
+
         if self.features == 'M' or self.features == 'MS':
             cols_data = df_raw.columns[1:]
             df_data = df_raw[cols_data]
@@ -362,33 +408,18 @@ class Dataset_ETT_hour(Dataset):
             df_data = df_raw[[self.target]]
 
         if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
+            train_data = df_data[0:12 * 30 * 24 * 4]
             self.scaler.fit(train_data.values)
             data = self.scaler.transform(df_data.values)
         else:
             data = df_data.values
 
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0) 
-
-        self.data_x = data[border1:border2]
-        self.data_y = data[border1:border2]
-
-        if self.set_type == 0 and self.args.augmentation_ratio > 0:
-            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
-            
-        self.data_stamp = data_stamp
+        data_stamp = time_stamp(df_raw['date'], self.timeenc, self.freq, minute_unit=15)
+        return data.astype(np.float32), data_stamp
 
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return window_batch(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
@@ -408,10 +439,13 @@ class Dataset_ETT_hour(Dataset):
         return self.scaler.inverse_transform(data)
 
 
-class Dataset_ETT_minute(Dataset):
+class Dataset_Custom(SharedMemoryDataset):
+    # minute resolution of the calendar marks (timeenc 0), None to leave the minute out
+    minute_unit = None
+
     def __init__(self, args, root_path, flag='train', size=None,
-                 features='S', data_path='ETTm1.csv',
-                 target='OT', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
+                 features='S', data_path='ETTh1.csv',
+                 target='OT', scale=True, timeenc=0, freq='h', seasonal_patterns=None):
         # size [seq_len, label_len, pred_len]
         self.args = args
         # info
@@ -440,13 +474,44 @@ class Dataset_ETT_minute(Dataset):
 
     def __read_data__(self):
         self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
+        path = os.path.join(self.root_path, self.data_path)
+        if is_columnar(path):
+            # columnar files are read split by split, only the needed columns and rows
+            border1, border2 = self.__borders__(frame_length(path))
+            data, data_stamp = self.__read_rows__(path, border1, border2)
+        else:
+            data, data_stamp = load_source(self, self.__read_source__)
+            border1, border2 = self.__borders__(len(data))
+            data, data_stamp = data[border1:border2], data_stamp[border1:border2]
 
-        border1s = [0, 12 * 30 * 24 * 4 - self.seq_len, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.seq_len]
-        border2s = [12 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 8 * 30 * 24 * 4]
-        border1 = border1s[self.set_type]
-        border2 = border2s[self.set_type]
+        self.data_x = data
+        self.data_y = data
+
+        if self.set_type == 0 and self.args.augmentation_ratio > 0:
+            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
+
+        self.data_stamp = data_stamp
+
+    def __borders__(self, length):
+        num_train = int(length * 0.7)
+        num_test = int(length * 0.2)
+        num_vali = length - num_train - num_test
+        border1s = [0, num_train - self.seq_len, length - num_test - self.seq_len]
+        border2s = [num_train, num_train + num_vali, length]
+        return border1s[self.set_type], border2s[self.set_type]
+
+    def __read_source__(self):
+        df_raw = read_frame(os.path.join(self.root_path, self.data_path),
+                            columns=['date', self.target] if self.features == 'S' else None)
+
+        '''
+        df_raw.columns: ['date', ...(other features), target feature]
+        '''
+        cols = list(df_raw.columns)
+        cols.remove(self.target)
+        cols.remove('date')
+        df_raw = df_raw[['date'] + cols + [self.target]]
+        num_train = int(len(df_raw) * 0.7)
 
         if self.features == 'M' or self.features == 'MS':
             cols_data = df_raw.columns[1:]
@@ -455,35 +520,43 @@ class Dataset_ETT_minute(Dataset):
             df_data = df_raw[[self.target]]
 
         if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
+            train_data = df_data[0:num_train]
             self.scaler.fit(train_data.values)
             data = self.scaler.transform(df_data.values)
         else:
             data = df_data.values
 
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            df_stamp['minute'] = df_stamp.date.apply(lambda row: row.minute, 1)
-            df_stamp['minute'] = df_stamp.minute.map(lambda x: x // 15)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        data_stamp = time_stamp(df_raw['date'], self.timeenc, self.freq, minute_unit=self.minute_unit)
+        return data.astype(np.float32), data_stamp
 
-        self.data_x = data[border1:border2]
-        self.data_y = data[border1:border2]
+    def __read_rows__(self, path, border1, border2):
+        cols = frame_columns(path)
+        cols.remove(self.target)
+        cols.remove('date')
+        if self.features == 'M' or self.features == 'MS':
+            cols_data = cols + [self.target]
+        elif self.features == 'S':
+            cols_data = [self.target]
 
-        if self.set_type == 0 and self.args.augmentation_ratio > 0:
-            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
+        if self.scale:
+            num_train = int(frame_length(path) * 0.7)
+            self.scaler = load_scaler(
+                self, lambda: self.scaler.fit(read_frame(path, cols_data, rows=(0, num_train)).values))
 
-        self.data_stamp = data_stamp
+        df_raw = read_frame(path, ['date'] + cols_data, rows=(border1, border2))
+        if self.scale:
+            data = self.scaler.transform(df_raw[cols_data].values)
+        else:
+            data = df_raw[cols_data].values
+
+        cache_dir = self.root_path if self.args.data_cache else None
+        data_stamp = time_stamp(df_raw['date'], self.timeenc, self.freq, minute_unit=self.minute_unit,
+                                cache_dir=cache_dir)
+        return data.astype(np.float32), data_stamp
 
     def __getitem__(self, index):
+        if not np.isscalar(index):
+            return window_batch(self, index)
         s_begin = index
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
@@ -503,10 +576,33 @@ class Dataset_ETT_minute(Dataset):
         return self.scaler.inverse_transform(data)
 
 
-class Dataset_Custom(Dataset):
+class Dataset_Custom_minute(Dataset_Custom):
+    # Dataset_Custom of minute data, the calendar marks keep the minute
+    minute_unit = 1
+
     def __init__(self, args, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', seasonal_patterns=None):
+                 target='OT', scale=True, timeenc=0, freq='t', seasonal_patterns=None):
+        super().__init__(args, root_path, flag, size, features, data_path, target, scale, timeenc, freq,
+                         seasonal_patterns)
+
+
+class Dataset_Stream(IterableDataset):
+    """
+    Out-of-core version of Dataset_Custom for sources that do not fit in memory (csv, Parquet or Feather).
+    The split is read in chunks of `args.stream_chunk` rows and the last seq_len + pred_len - 1 rows of a chunk
+    are carried over to the next one, so the windows are the same as the ones of Dataset_Custom.
+    The scaler statistics of the train rows are computed in a first streaming pass.
+    Training windows go through a shuffle buffer of `args.stream_buffer` windows, so memory stays constant.
+
+    The time column is 'date' or, for the BTC files, 'timestamp'. Augmentation is not applied.
+
+    :param minute_unit: minute resolution of the calendar marks, the `minute_unit` of the replaced dataset.
+    """
+
+    def __init__(self, args, root_path, flag='train', size=None,
+                 features='S', data_path='ETTh1.csv',
+                 target='OT', scale=True, timeenc=0, freq='h', seasonal_patterns=None, minute_unit=None):
         # size [seq_len, label_len, pred_len]
         self.args = args
         # info
@@ -522,97 +618,130 @@ class Dataset_Custom(Dataset):
         assert flag in ['train', 'test', 'val']
         type_map = {'train': 0, 'val': 1, 'test': 2}
         self.set_type = type_map[flag]
+        self.shuffle = flag == 'train'
 
         self.features = features
         self.target = target
         self.scale = scale
         self.timeenc = timeenc
         self.freq = freq
+        self.minute_unit = minute_unit
 
         self.root_path = root_path
         self.data_path = data_path
+        self.chunk_rows = args.stream_chunk
+        self.buffer_size = args.stream_buffer
         self.__read_data__()
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-
-        '''
-        df_raw.columns: ['date', ...(other features), target feature]
-        '''
-        cols = list(df_raw.columns)
+        self.path = os.path.join(self.root_path, self.data_path)
+        cols = frame_columns(self.path)
+        self.date_col = 'date' if 'date' in cols else 'timestamp'
         cols.remove(self.target)
-        cols.remove('date')
-        df_raw = df_raw[['date'] + cols + [self.target]]
-        num_train = int(len(df_raw) * 0.7)
-        num_test = int(len(df_raw) * 0.2)
-        num_vali = len(df_raw) - num_train - num_test
-        border1s = [0, num_train - self.seq_len, len(df_raw) - num_test - self.seq_len]
-        border2s = [num_train, num_train + num_vali, len(df_raw)]
-        border1 = border1s[self.set_type]
-        border2 = border2s[self.set_type]
-
+        cols.remove(self.date_col)
         if self.features == 'M' or self.features == 'MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
+            self.cols_data = cols + [self.target]
         elif self.features == 'S':
-            df_data = df_raw[[self.target]]
-
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
-
-        self.data_x = data[border1:border2]
-        self.data_y = data[border1:border2]
+            self.cols_data = [self.target]
 
-        if self.set_type == 0 and self.args.augmentation_ratio > 0:
-            self.data_x, self.data_y, augmentation_tags = run_augmentation_single(self.data_x, self.data_y, self.args)
-
-        self.data_stamp = data_stamp
-
-    def __getitem__(self, index):
-        s_begin = index
-        s_end = s_begin + self.seq_len
-        r_begin = s_end - self.label_len
-        r_end = r_begin + self.label_len + self.pred_len
+        length = count_rows(self.path)
+        num_train = int(length * 0.7)
+        num_test = int(length * 0.2)
+        num_vali = length - num_train - num_test
+        border1s = [0, num_train - self.seq_len, length - num_test - self.seq_len]
+        border2s = [num_train, num_train + num_vali, length]
+        self.border1 = border1s[self.set_type]
+        self.border2 = border2s[self.set_type]
 
-        seq_x = self.data_x[s_begin:s_end]
-        seq_y = self.data_y[r_begin:r_end]
-        seq_x_mark = self.data_stamp[s_begin:s_end]
-        seq_y_mark = self.data_stamp[r_begin:r_end]
-
-        return seq_x, seq_y, seq_x_mark, seq_y_mark
+        self.scaler = StandardScaler()
+        if self.scale:
+            self.scaler = load_scaler(self, lambda: restore_scaler(self.scaler, self.__train_stats__(num_train)))
+
+    def __train_stats__(self, num_train):
+        # mean and variance merged chunk by chunk (Chan et al.), in float64
+        count, mean, m2 = 0, 0., 0.
+        for df in iter_frames(self.path, self.cols_data, self.chunk_rows, stop=num_train):
+            values = df.values.astype(np.float64)
+            n = len(values)
+            chunk_mean = values.mean(0)
+            delta = chunk_mean - mean
+            mean = mean + delta * n / (count + n)
+            m2 = m2 + ((values - chunk_mean) ** 2).sum(0) + delta ** 2 * count * n / (count + n)
+            count += n
+        scale = np.sqrt(m2 / count)
+        scale[scale == 0] = 1.
+        return np.stack([mean, scale])
+
+    def __chunks__(self):
+        """
+        Yields (data, data_stamp) arrays of the split, each starting with the overlap of the previous chunk.
+        With several loader workers the chunks are divided between them, and every worker only reads the rows
+        of its own chunks.
+        """
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        overlap = self.seq_len + self.pred_len - 1
+
+        # a chunk holds the windows ending in its rows, it is read with the overlap rows before them
+        starts = range(self.border1, self.border2, self.chunk_rows)[worker_id::num_workers]
+        ranges = [(max(start - overlap, self.border1), min(start + self.chunk_rows, self.border2))
+                  for start in starts]
+        for df in iter_ranges(self.path, ranges, [self.date_col] + self.cols_data):
+            if len(df) > overlap:
+                data = df[self.cols_data].values
+                if self.scale:
+                    data = self.scaler.transform(data)
+                data_stamp = time_stamp(df[self.date_col], self.timeenc, self.freq, minute_unit=self.minute_unit)
+                yield data.astype(np.float32), data_stamp
+
+    def __windows__(self):
+        for data, data_stamp in self.__chunks__():
+            for s_begin in range(len(data) - self.seq_len - self.pred_len + 1):
+                s_end = s_begin + self.seq_len
+                r_begin = s_end - self.label_len
+                r_end = r_begin + self.label_len + self.pred_len
+                yield data[s_begin:s_end].copy(), data[r_begin:r_end].copy(), \
+                    data_stamp[s_begin:s_end].copy(), data_stamp[r_begin:r_end].copy()
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from self.__windows__()
+            return
+
+        # the torch generator is seeded per worker and advances between epochs
+        rng = np.random.default_rng(torch.randint(2 ** 31, ()).item())
+        buffer = []
+        for window in self.__windows__():
+            if len(buffer) < self.buffer_size:
+                buffer.append(window)
+                continue
+            j = rng.integers(len(buffer))
+            yield buffer[j]
+            buffer[j] = window
+        rng.shuffle(buffer)
+        yield from buffer
 
     def __len__(self):
-        return len(self.data_x) - self.seq_len - self.pred_len + 1
+        return self.border2 - self.border1 - self.seq_len - self.pred_len + 1
 
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
 
 
-class Dataset_M4(Dataset):
+class Dataset_M4(SharedMemoryDataset):
+    """
+    M4 series of one seasonal pattern, packed into one float32 `values` buffer: series i is
+    values[offsets[i]:offsets[i + 1]]. With `args.data_cache` the packed arrays are memory-mapped.
+    """
+    shared_arrays = ('values', 'offsets')
+
     def __init__(self, args, root_path, flag='pred', size=None,
                  features='S', data_path='ETTh1.csv',
                  target='OT', scale=False, inverse=False, timeenc=0, freq='15min',
                  seasonal_patterns='Yearly'):
         # size [seq_len, label_len, pred_len]
         # init
+        self.args = args
         self.features = features
         self.target = target
         self.scale = scale
@@ -633,38 +762,47 @@ class Dataset_M4(Dataset):
 
     def __read_data__(self):
         # M4Dataset.initialize()
-        if self.flag == 'train':
-            dataset = M4Dataset.load(training=True, dataset_file=self.root_path)
-        else:
-            dataset = M4Dataset.load(training=False, dataset_file=self.root_path)
-        training_values = np.array(
-            [v[~np.isnan(v)] for v in
-             dataset.values[dataset.groups == self.seasonal_patterns]])  # split different frequencies
-        self.ids = np.array([i for i in dataset.ids[dataset.groups == self.seasonal_patterns]])
-        self.timeseries = [ts for ts in training_values]
+        split = 'training' if self.flag == 'train' else 'test'
+        self.source_files = ('M4-info.csv', split + '.npz')
+        names = ['{}.{}.{}'.format(split, self.seasonal_patterns, name) for name in ('values', 'offsets', 'ids')]
+        self.values, self.offsets, self.ids = load_arrays(self, names, self.__read_source__)
+
+    def __read_source__(self):
+        dataset = M4Dataset.load(training=self.flag == 'train', dataset_file=self.root_path)
+        group = dataset.groups == self.seasonal_patterns  # split different frequencies
+        values, offsets = pack_series(dataset.values[group])
+        return [values, offsets, np.asarray(dataset.ids[group], dtype=str)]
+
+    @property
+    def timeseries(self):
+        return [self.values[begin:end] for begin, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def gather(self, series, positions):
+        """
+        Values of `series` at `positions` (one row of positions per series) and the mask of the positions
+        inside their series; positions outside are 0.
+        """
+        lengths = (self.offsets[series + 1] - self.offsets[series])[:, None]
+        mask = (positions >= 0) & (positions < lengths)
+        index = self.offsets[series][:, None] + np.clip(positions, 0, lengths - 1)
+        return np.where(mask, self.values[index], 0).astype(np.float32), mask.astype(np.float32)
 
     def __getitem__(self, index):
-        insample = np.zeros((self.seq_len, 1))
-        insample_mask = np.zeros((self.seq_len, 1))
-        outsample = np.zeros((self.pred_len + self.label_len, 1))
-        outsample_mask = np.zeros((self.pred_len + self.label_len, 1))  # m4 dataset
-
-        sampled_timeseries = self.timeseries[index]
-        cut_point = np.random.randint(low=max(1, len(sampled_timeseries) - self.window_sampling_limit),
-                                      high=len(sampled_timeseries),
-                                      size=1)[0]
-
-        insample_window = sampled_timeseries[max(0, cut_point - self.seq_len):cut_point]
-        insample[-len(insample_window):, 0] = insample_window
-        insample_mask[-len(insample_window):, 0] = 1.0
-        outsample_window = sampled_timeseries[
-                           cut_point - self.label_len:min(len(sampled_timeseries), cut_point + self.pred_len)]
-        outsample[:len(outsample_window), 0] = outsample_window
-        outsample_mask[:len(outsample_window), 0] = 1.0
-        return insample, outsample, insample_mask, outsample_mask
+        if np.isscalar(index):
+            return tuple(batch[0] for batch in self[[index]])
+
+        # cut points and windows of the whole batch at once
+        series = np.asarray(index)
+        lengths = self.offsets[series + 1] - self.offsets[series]
+        cut_point = np.random.randint(low=np.maximum(1, lengths - self.window_sampling_limit), high=lengths)
+
+        insample, insample_mask = self.gather(series, cut_point[:, None] - self.seq_len + np.arange(self.seq_len))
+        outsample, outsample_mask = self.gather(
+            series, cut_point[:, None] - self.label_len + np.arange(self.label_len + self.pred_len))
+        return insample[..., None], outsample[..., None], insample_mask[..., None], outsample_mask[..., None]
 
     def __len__(self):
-        return len(self.timeseries)
+        return len(self.offsets) - 1
 
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
@@ -676,240 +814,149 @@ class Dataset_M4(Dataset):
 
         :return: Last insample window of all timeseries. Shape "timeseries, insample size"
         """
-        insample = np.zeros((len(self.timeseries), self.seq_len))
-        insample_mask = np.zeros((len(self.timeseries), self.seq_len))
-        for i, ts in enumerate(self.timeseries):
-            ts_last_window = ts[-self.seq_len:]
-            insample[i, -len(ts):] = ts_last_window
-            insample_mask[i, -len(ts):] = 1.0
-        return insample, insample_mask
+        series = np.arange(len(self))
+        lengths = self.offsets[1:] - self.offsets[:-1]
+        return self.gather(series, lengths[:, None] - self.seq_len + np.arange(self.seq_len))
 
 
-class PSMSegLoader(Dataset):
+class SegLoader(SharedMemoryDataset):
+    """
+    Base of the anomaly detection loaders. Subclasses name their `source_files` and read the raw train
+    series, test series and test labels in `read_train`, `read_test` and `read_test_labels`, or the test
+    series and labels together in `read_test_split` when they come from the same file.
+
+    The scaler is fitted on the train series and the scaled series are computed once per experiment, then shared
+    by the train/val/test/thre instances (see `load_arrays`). An instance only keeps the series of its flag.
+    """
+    shared_arrays = ('train', 'val', 'test', 'test_labels')
+    source_files = ()
+
     def __init__(self, args, root_path, win_size, step=1, flag="train"):
+        self.args = args
+        self.root_path = root_path
         self.flag = flag
         self.step = step
         self.win_size = win_size
-        self.scaler = StandardScaler()
-        data = pd.read_csv(os.path.join(root_path, 'train.csv'))
-        data = data.values[:, 1:]
-        data = np.nan_to_num(data)
-        self.scaler.fit(data)
-        data = self.scaler.transform(data)
-        test_data = pd.read_csv(os.path.join(root_path, 'test.csv'))
-        test_data = test_data.values[:, 1:]
-        test_data = np.nan_to_num(test_data)
-        self.test = self.scaler.transform(test_data)
-        self.train = data
-        data_len = len(self.train)
-        self.val = self.train[(int)(data_len * 0.8):]
-        self.test_labels = pd.read_csv(os.path.join(root_path, 'test_label.csv')).values[:, 1:]
-        print("test:", self.test.shape)
-        print("train:", self.train.shape)
+        self.__read_data__()
 
-    def __len__(self):
-        if self.flag == "train":
-            return (self.train.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'val'):
-            return (self.val.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'test'):
-            return (self.test.shape[0] - self.win_size) // self.step + 1
+    def __read_data__(self):
+        self.scaler = StandardScaler()
+        stats, train = load_arrays(self, ['scaler', 'train'], self.__read_train__)
+        restore_scaler(self.scaler, stats)
+        # the train and val windows are labelled with the first test labels, every flag needs them
+        test, self.test_labels = load_arrays(self, ['test', 'test_labels'], self.__read_test__)
+
+        self.train = self.val = self.test = None
+        if self.flag in ('train', 'val'):
+            self.train = train
+            self.val = train[(int)(len(train) * 0.8):]
+            self.series = self.flag
         else:
-            return (self.test.shape[0] - self.win_size) // self.win_size + 1
+            self.test = test
+            self.series = 'test'
+        # the windows of the thresholding pass do not overlap
+        self.stride = self.step if self.flag in ('train', 'val', 'test') else self.win_size
 
-    def __getitem__(self, index):
-        index = index * self.step
-        if self.flag == "train":
-            return np.float32(self.train[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'val'):
-            return np.float32(self.val[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'test'):
-            return np.float32(self.test[index:index + self.win_size]), np.float32(
-                self.test_labels[index:index + self.win_size])
-        else:
-            return np.float32(self.test[
-                              index // self.step * self.win_size:index // self.step * self.win_size + self.win_size]), np.float32(
-                self.test_labels[index // self.step * self.win_size:index // self.step * self.win_size + self.win_size])
+    def __read_train__(self):
+        train = self.read_train()
+        self.scaler.fit(train)
+        stats = np.stack([self.scaler.mean_, self.scaler.scale_]).astype(np.float64)
+        return [stats, self.scaler.transform(train).astype(np.float32)]
 
+    def __read_test__(self):
+        test, test_labels = self.read_test_split()
+        return [self.scaler.transform(test).astype(np.float32), np.asarray(test_labels, dtype=np.float32)]
 
-class MSLSegLoader(Dataset):
-    def __init__(self, args, root_path, win_size, step=1, flag="train"):
-        self.flag = flag
-        self.step = step
-        self.win_size = win_size
-        self.scaler = StandardScaler()
-        data = np.load(os.path.join(root_path, "MSL_train.npy"))
-        self.scaler.fit(data)
-        data = self.scaler.transform(data)
-        test_data = np.load(os.path.join(root_path, "MSL_test.npy"))
-        self.test = self.scaler.transform(test_data)
-        self.train = data
-        data_len = len(self.train)
-        self.val = self.train[(int)(data_len * 0.8):]
-        self.test_labels = np.load(os.path.join(root_path, "MSL_test_label.npy"))
-        print("test:", self.test.shape)
-        print("train:", self.train.shape)
+    def read_train(self):
+        raise NotImplementedError
+
+    def read_test_split(self):
+        return self.read_test(), self.read_test_labels()
+
+    def read_test(self):
+        raise NotImplementedError
+
+    def read_test_labels(self):
+        raise NotImplementedError
 
     def __len__(self):
-        if self.flag == "train":
-            return (self.train.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'val'):
-            return (self.val.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'test'):
-            return (self.test.shape[0] - self.win_size) // self.step + 1
-        else:
-            return (self.test.shape[0] - self.win_size) // self.win_size + 1
+        return (len(getattr(self, self.series)) - self.win_size) // self.stride + 1
 
     def __getitem__(self, index):
-        index = index * self.step
-        if self.flag == "train":
-            return np.float32(self.train[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'val'):
-            return np.float32(self.val[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'test'):
-            return np.float32(self.test[index:index + self.win_size]), np.float32(
-                self.test_labels[index:index + self.win_size])
+        begin = index * self.stride
+        end = begin + self.win_size
+        if self.series == 'test':
+            labels = self.test_labels[begin:end]
         else:
-            return np.float32(self.test[
-                              index // self.step * self.win_size:index // self.step * self.win_size + self.win_size]), np.float32(
-                self.test_labels[index // self.step * self.win_size:index // self.step * self.win_size + self.win_size])
+            labels = self.test_labels[0:self.win_size]
+        return getattr(self, self.series)[begin:end], labels
 
 
-class SMAPSegLoader(Dataset):
-    def __init__(self, args, root_path, win_size, step=1, flag="train"):
-        self.flag = flag
-        self.step = step
-        self.win_size = win_size
-        self.scaler = StandardScaler()
-        data = np.load(os.path.join(root_path, "SMAP_train.npy"))
-        self.scaler.fit(data)
-        data = self.scaler.transform(data)
-        test_data = np.load(os.path.join(root_path, "SMAP_test.npy"))
-        self.test = self.scaler.transform(test_data)
-        self.train = data
-        data_len = len(self.train)
-        self.val = self.train[(int)(data_len * 0.8):]
-        self.test_labels = np.load(os.path.join(root_path, "SMAP_test_label.npy"))
-        print("test:", self.test.shape)
-        print("train:", self.train.shape)
+class PSMSegLoader(SegLoader):
+    source_files = ('train.csv', 'test.csv', 'test_label.csv')
 
-    def __len__(self):
+    def read_train(self):
+        return np.nan_to_num(pd.read_csv(os.path.join(self.root_path, 'train.csv')).values[:, 1:])
 
-        if self.flag == "train":
-            return (self.train.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'val'):
-            return (self.val.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'test'):
-            return (self.test.shape[0] - self.win_size) // self.step + 1
-        else:
-            return (self.test.shape[0] - self.win_size) // self.win_size + 1
+    def read_test(self):
+        return np.nan_to_num(pd.read_csv(os.path.join(self.root_path, 'test.csv')).values[:, 1:])
+
+    def read_test_labels(self):
+        return pd.read_csv(os.path.join(self.root_path, 'test_label.csv')).values[:, 1:]
+
+
+class MSLSegLoader(SegLoader):
+    source_files = ('MSL_train.npy', 'MSL_test.npy', 'MSL_test_label.npy')
+
+    def read_train(self):
+        return np.load(os.path.join(self.root_path, "MSL_train.npy"), mmap_mode='r')
+
+    def read_test(self):
+        return np.load(os.path.join(self.root_path, "MSL_test.npy"), mmap_mode='r')
+
+    def read_test_labels(self):
+        return np.load(os.path.join(self.root_path, "MSL_test_label.npy"), mmap_mode='r')
+
+
+class SMAPSegLoader(SegLoader):
+    source_files = ('SMAP_train.npy', 'SMAP_test.npy', 'SMAP_test_label.npy')
+
+    def read_train(self):
+        return np.load(os.path.join(self.root_path, "SMAP_train.npy"), mmap_mode='r')
+
+    def read_test(self):
+        return np.load(os.path.join(self.root_path, "SMAP_test.npy"), mmap_mode='r')
+
+    def read_test_labels(self):
+        return np.load(os.path.join(self.root_path, "SMAP_test_label.npy"), mmap_mode='r')
 
-    def __getitem__(self, index):
-        index = index * self.step
-        if self.flag == "train":
-            return np.float32(self.train[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'val'):
-            return np.float32(self.val[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'test'):
-            return np.float32(self.test[index:index + self.win_size]), np.float32(
-                self.test_labels[index:index + self.win_size])
-        else:
-            return np.float32(self.test[
-                              index // self.step * self.win_size:index // self.step * self.win_size + self.win_size]), np.float32(
-                self.test_labels[index // self.step * self.win_size:index // self.step * self.win_size + self.win_size])
 
+class SMDSegLoader(SegLoader):
+    source_files = ('SMD_train.npy', 'SMD_test.npy', 'SMD_test_label.npy')
 
-class SMDSegLoader(Dataset):
     def __init__(self, args, root_path, win_size, step=100, flag="train"):
-        self.flag = flag
-        self.step = step
-        self.win_size = win_size
-        self.scaler = StandardScaler()
-        data = np.load(os.path.join(root_path, "SMD_train.npy"))
-        self.scaler.fit(data)
-        data = self.scaler.transform(data)
-        test_data = np.load(os.path.join(root_path, "SMD_test.npy"))
-        self.test = self.scaler.transform(test_data)
-        self.train = data
-        data_len = len(self.train)
-        self.val = self.train[(int)(data_len * 0.8):]
-        self.test_labels = np.load(os.path.join(root_path, "SMD_test_label.npy"))
+        super().__init__(args, root_path, win_size, step, flag)
 
-    def __len__(self):
-        if self.flag == "train":
-            return (self.train.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'val'):
-            return (self.val.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'test'):
-            return (self.test.shape[0] - self.win_size) // self.step + 1
-        else:
-            return (self.test.shape[0] - self.win_size) // self.win_size + 1
+    def read_train(self):
+        return np.load(os.path.join(self.root_path, "SMD_train.npy"), mmap_mode='r')
 
-    def __getitem__(self, index):
-        index = index * self.step
-        if self.flag == "train":
-            return np.float32(self.train[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'val'):
-            return np.float32(self.val[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'test'):
-            return np.float32(self.test[index:index + self.win_size]), np.float32(
-                self.test_labels[index:index + self.win_size])
-        else:
-            return np.float32(self.test[
-                              index // self.step * self.win_size:index // self.step * self.win_size + self.win_size]), np.float32(
-                self.test_labels[index // self.step * self.win_size:index // self.step * self.win_size + self.win_size])
+    def read_test(self):
+        return np.load(os.path.join(self.root_path, "SMD_test.npy"), mmap_mode='r')
 
+    def read_test_labels(self):
+        return np.load(os.path.join(self.root_path, "SMD_test_label.npy"), mmap_mode='r')
 
-class SWATSegLoader(Dataset):
-    def __init__(self, args, root_path, win_size, step=1, flag="train"):
-        self.flag = flag
-        self.step = step
-        self.win_size = win_size
-        self.scaler = StandardScaler()
 
-        train_data = pd.read_csv(os.path.join(root_path, 'swat_train2.csv'))
-        test_data = pd.read_csv(os.path.join(root_path, 'swat2.csv'))
-        labels = test_data.values[:, -1:]
-        train_data = train_data.values[:, :-1]
-        test_data = test_data.values[:, :-1]
-
-        self.scaler.fit(train_data)
-        train_data = self.scaler.transform(train_data)
-        test_data = self.scaler.transform(test_data)
-        self.train = train_data
-        self.test = test_data
-        data_len = len(self.train)
-        self.val = self.train[(int)(data_len * 0.8):]
-        self.test_labels = labels
-        print("test:", self.test.shape)
-        print("train:", self.train.shape)
+class SWATSegLoader(SegLoader):
+    source_files = ('swat_train2.csv', 'swat2.csv')
 
-    def __len__(self):
-        """
-        Number of images in the object dataset.
-        """
-        if self.flag == "train":
-            return (self.train.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'val'):
-            return (self.val.shape[0] - self.win_size) // self.step + 1
-        elif (self.flag == 'test'):
-            return (self.test.shape[0] - self.win_size) // self.step + 1
-        else:
-            return (self.test.shape[0] - self.win_size) // self.win_size + 1
+    def read_train(self):
+        return pd.read_csv(os.path.join(self.root_path, 'swat_train2.csv')).values[:, :-1]
 
-    def __getitem__(self, index):
-        index = index * self.step
-        if self.flag == "train":
-            return np.float32(self.train[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'val'):
-            return np.float32(self.val[index:index + self.win_size]), np.float32(self.test_labels[0:self.win_size])
-        elif (self.flag == 'test'):
-            return np.float32(self.test[index:index + self.win_size]), np.float32(
-                self.test_labels[index:index + self.win_size])
-        else:
-            return np.float32(self.test[
-                              index // self.step * self.win_size:index // self.step * self.win_size + self.win_size]), np.float32(
-                self.test_labels[index // self.step * self.win_size:index // self.step * self.win_size + self.win_size])
+    def read_test_split(self):
+        # the labels are the last column of the test file, parsed once for both
+        test = pd.read_csv(os.path.join(self.root_path, 'swat2.csv')).values
+        return test[:, :-1], test[:, -1:]
 
 
 class UEAloader(Dataset):
@@ -919,11 +966,11 @@ class UEAloader(Dataset):
     Argument:
         limit_size: float in (0, 1) for debug
     Attributes:
-        all_df: (num_samples * seq_len, num_columns) dataframe indexed by integer indices, with multiple rows corresponding to the same index (sample).
-            Each row is a time step; Each column contains either metadata (e.g. timestamp) or a feature.
-        feature_df: (num_samples * seq_len, feat_dim) dataframe; contains the subset of columns of `all_df` which correspond to selected features
-        feature_names: names of columns contained in `feature_df` (same as feature_df.columns)
-        all_IDs: (num_samples,) series of IDs contained in `all_df`/`feature_df` (same as all_df.index.unique() )
+        data: (num_samples, max_seq_len, feat_dim) float32 array of the normalized samples, padded with 0s
+        lengths: (num_samples,) length of each sample in `data`
+        labels: (num_samples, 1) int8 array of class codes
+        feature_names: names of the feature dimensions
+        all_IDs: (num_samples,) sample IDs (integer indices 0 ... num_samples-1)
         labels_df: (num_samples, num_labels) pd.DataFrame of label(s) for each sample
         max_seq_len: maximum sequence (time series) length. If None, script argument `max_seq_len` will be used.
             (Moreover, script argument overrides this attribute)
@@ -933,8 +980,9 @@ class UEAloader(Dataset):
         self.args = args
         self.root_path = root_path
         self.flag = flag
-        self.all_df, self.labels_df = self.load_all(root_path, file_list=file_list, flag=flag)
-        self.all_IDs = self.all_df.index.unique()  # all sample IDs (integer indices 0 ... num_samples-1)
+        self.normalizer = Normalizer()
+        self.load_all(root_path, file_list=file_list, flag=flag)
+        self.all_IDs = np.arange(len(self.data))  # all sample IDs (integer indices 0 ... num_samples-1)
 
         if limit_size is not None:
             if limit_size > 1:
@@ -942,17 +990,22 @@ class UEAloader(Dataset):
             else:  # interpret as proportion if in (0, 1]
                 limit_size = int(limit_size * len(self.all_IDs))
             self.all_IDs = self.all_IDs[:limit_size]
-            self.all_df = self.all_df.loc[self.all_IDs]
-
-        # use all features
-        self.feature_names = self.all_df.columns
-        self.feature_df = self.all_df
+            self.data = self.data[:limit_size]
+            self.lengths = self.lengths[:limit_size]
+            self.labels = self.labels[:limit_size]
 
-        # pre_process
-        normalizer = Normalizer()
-        self.feature_df = normalizer.normalize(self.feature_df)
+        self.labels_df = pd.DataFrame(self.labels, dtype=np.int8)
         print(len(self.all_IDs))
 
+        # with --batch_augmentation the presets of `batch_presets` are applied per batch by `augment_batch`.
+        # `augment` applies the DTW based presets after them, so with any of those every preset runs per sample
+        self.batch_augmentation = None
+        if flag == "TRAIN" and args.augmentation_ratio > 0 and args.batch_augmentation:
+            if any(getattr(args, p) for p in sample_presets):
+                print('--batch_augmentation is ignored with the DTW based presets, augmenting per sample')
+            else:
+                self.batch_augmentation = BatchAugmentation(args)
+
     def load_all(self, root_path, file_list=None, flag=None):
         """
         Loads datasets from csv files contained in `root_path` into a dataframe, optionally choosing from `pattern`
@@ -960,9 +1013,7 @@ class UEAloader(Dataset):
             root_path: directory containing all individual .csv files
             file_list: optionally, provide a list of file paths within `root_path` to consider.
                 Otherwise, entire `root_path` contents will be used.
-        Returns:
-            all_df: a single (possibly concatenated) dataframe with all data corresponding to specified files
-            labels_df: dataframe containing label(s) for each sample
+        Sets `data`, `lengths`, `labels`, `class_names`, `feature_names` and `max_seq_len`.
         """
         # Select paths for training and evaluation
         if file_list is None:
@@ -978,17 +1029,34 @@ class UEAloader(Dataset):
             pattern='*.ts'
             raise Exception("No .ts files found using pattern: '{}'".format(pattern))
 
-        all_df, labels_df = self.load_single(input_paths[0])  # a single file contains dataset
+        filepath = input_paths[0]  # a single file contains dataset
+        if self.args.data_cache:
+            # the padded arrays are cached next to the .ts file, keyed by the file and the normalizer settings
+            fields = [os.path.abspath(filepath), os.stat(filepath).st_mtime_ns, self.normalizer.norm_type]
+            key = hashlib.md5('|'.join(map(str, fields)).encode()).hexdigest()[:16]
+            cache_path = '{}.{}.npz'.format(filepath, key)
+            if not os.path.exists(cache_path):
+                save_arrays(cache_path, **self.load_single(filepath))
+            arrays = dict(np.load(cache_path))
+        else:
+            arrays = self.load_single(filepath)
 
-        return all_df, labels_df
+        self.data = arrays['data']
+        self.lengths = arrays['lengths']
+        self.labels = arrays['labels']
+        self.class_names = pd.Index(arrays['class_names'])
+        self.feature_names = pd.Index(arrays['feature_names'])
+        self.max_seq_len = int(self.lengths.max())
 
     def load_single(self, filepath):
+        """
+        Reads a .ts file into a padded (num_samples, max_seq_len, feat_dim) float32 array of normalized samples.
+        """
         df, labels = load_from_tsfile_to_dataframe(filepath, return_separate_X_and_y=True,
                                                              replace_missing_vals_with='NaN')
         labels = pd.Series(labels, dtype="category")
-        self.class_names = labels.cat.categories
-        labels_df = pd.DataFrame(labels.cat.codes,
-                                 dtype=np.int8)  # int8-32 gives an error when using nn.CrossEntropyLoss
+        class_names = labels.cat.categories
+        label_codes = np.asarray(labels.cat.codes, dtype=np.int8)[:, None]  # int8-32 gives an error when using nn.CrossEntropyLoss
 
         lengths = df.applymap(
             lambda x: len(x)).values  # (num_samples, num_dimensions) array containing the length of each series
@@ -998,25 +1066,27 @@ class UEAloader(Dataset):
         if np.sum(horiz_diffs) > 0:  # if any row (sample) has varying length across dimensions
             df = df.applymap(subsample)
 
-        lengths = df.applymap(lambda x: len(x)).values
-        vert_diffs = np.abs(lengths - np.expand_dims(lengths[0, :], 0))
-        if np.sum(vert_diffs) > 0:  # if any column (dimension) has varying length across samples
-            self.max_seq_len = int(np.max(lengths[:, 0]))
-        else:
-            self.max_seq_len = lengths[0, 0]
-
-        # First create a (seq_len, feat_dim) dataframe for each sample, indexed by a single integer ("ID" of the sample)
-        # Then concatenate into a (num_samples * seq_len, feat_dim) dataframe, with multiple rows corresponding to the
-        # sample index (i.e. the same scheme as all datasets in this project)
+        lengths = df.applymap(lambda x: len(x)).values[:, 0]
 
-        df = pd.concat((pd.DataFrame({col: df.loc[row, col] for col in df.columns}).reset_index(drop=True).set_index(
-            pd.Series(lengths[row, 0] * [row])) for row in range(df.shape[0])), axis=0)
+        # All samples are concatenated into one (num_samples * seq_len, feat_dim) dataframe, indexed by the
+        # sample ID, to fill missing values and normalize. Then the rows are scattered into the padded array.
+        values = np.concatenate([np.stack([np.asarray(df.iloc[row, col], dtype=np.float64)
+                                           for col in range(df.shape[1])], axis=1)
+                                 for row in range(df.shape[0])], axis=0)
+        flat_df = pd.DataFrame(values, columns=df.columns, index=np.repeat(np.arange(len(lengths)), lengths))
 
         # Replace NaN values
-        grp = df.groupby(by=df.index)
-        df = grp.transform(interpolate_missing)
+        if flat_df.isna().values.any():
+            grp = flat_df.groupby(by=flat_df.index)
+            flat_df = grp.transform(interpolate_missing)
 
-        return df, labels_df
+        # pre_process
+        flat_df = self.normalizer.normalize(flat_df)
+
+        data = np.zeros((len(lengths), lengths.max(), df.shape[1]), dtype=np.float32)
+        data[np.arange(lengths.max()) < lengths[:, None]] = flat_df.values
+        return {'data': data, 'lengths': lengths, 'labels': label_codes,
+                'class_names': np.asarray(class_names, dtype=str), 'feature_names': np.asarray(df.columns, dtype=str)}
 
     def instance_norm(self, case):
         if self.root_path.count('EthanolConcentration') > 0:  # special process for numerical stability
@@ -1028,18 +1098,39 @@ class UEAloader(Dataset):
         else:
             return case
 
+    def instance_norm_batch(self, X, lengths):
+        # instance_norm of every sample of a padded batch (batch_size, padded_length, feat_dim)
+        if self.root_path.count('EthanolConcentration') > 0:
+            mask = (torch.arange(X.shape[1]) < lengths.unsqueeze(1)).unsqueeze(-1)
+            X = X - X.sum(1, keepdim=True) / lengths.view(-1, 1, 1)
+            stdev = torch.sqrt(torch.var(X, dim=2, keepdim=True, unbiased=False) + 1e-5)
+            return X / stdev * mask
+        else:
+            return X
+
+    def augment_batch(self, X, lengths):
+        """
+        Collate transform of the train set with --batch_augmentation: augments the padded batch and only then
+        applies the instance normalization, like __getitem__ does for a single sample.
+        """
+        return self.instance_norm_batch(self.batch_augmentation(X, lengths), lengths)
+
+    @property
+    def collate_transform(self):
+        return self.augment_batch if self.batch_augmentation is not None else None
+
     def __getitem__(self, ind):
-        batch_x = self.feature_df.loc[self.all_IDs[ind]].values
-        labels = self.labels_df.loc[self.all_IDs[ind]].values
-        if self.flag == "TRAIN" and self.args.augmentation_ratio > 0:
-            num_samples = len(self.all_IDs)
-            num_columns = self.feature_df.shape[1]
-            seq_len = int(self.feature_df.shape[0] / num_samples)
+        batch_x = self.data[ind, :self.lengths[ind]]
+        labels = self.labels[ind]
+        if self.flag == "TRAIN" and self.args.augmentation_ratio > 0 and self.batch_augmentation is None:
+            seq_len, num_columns = batch_x.shape
             batch_x = batch_x.reshape((1, seq_len, num_columns))
             batch_x, labels, augmentation_tags = run_augmentation_single(batch_x, labels, self.args)
 
             batch_x = batch_x.reshape((1 * seq_len, num_columns))
 
+        if self.batch_augmentation is not None:
+            return torch.from_numpy(np.ascontiguousarray(batch_x)), torch.from_numpy(labels)
         return self.instance_norm(torch.from_numpy(batch_x)), \
                torch.from_numpy(labels)
 
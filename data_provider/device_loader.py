@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+import torch
+
+# share of the free device memory the uploaded data may take, the rest is left to the model and its activations
+memory_fraction = 0.5
+
+
+def upload_size(dataset):
+    """
+    Bytes DeviceWindowLoader uploads for `dataset`: the float32 series and time stamps.
+    """
+    arrays = [dataset.data_x, dataset.data_stamp] + ([] if dataset.data_y is dataset.data_x else [dataset.data_y])
+    return sum(4 * np.asarray(a).size for a in arrays)
+
+
+def fits_on_device(dataset, device):
+    """
+    Whether the data of `dataset` fits in `memory_fraction` of the free memory of a cuda device. On the cpu the
+    arrays are already in memory and are always accepted.
+    """
+    if device.type != 'cuda':
+        return True
+    free, total = torch.cuda.mem_get_info(device)
+    return upload_size(dataset) <= memory_fraction * free
+
+
+class DeviceWindowLoader:
+    """
+    Drop-in replacement of the DataLoader for small forecasting datasets.
+    The scaled series and time stamps are uploaded to the device once as float32 tensors and every batch of
+    sliding windows is gathered on the device by index arithmetic, including the shuffling. This removes the
+    worker processes, the collation and the per-batch host-to-device copies.
+
+    Yields (batch_x, batch_y, batch_x_mark, batch_y_mark) exactly like iterating the DataLoader would.
+    Check `fits_on_device` first, the data is not split to fit.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle, drop_last, device):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+
+        self.seq_len = dataset.seq_len
+        self.label_len = dataset.label_len
+        self.pred_len = dataset.pred_len
+        self.num_windows = len(dataset)
+
+        self.data_x = self._upload(dataset.data_x)
+        self.data_y = self.data_x if dataset.data_y is dataset.data_x else self._upload(dataset.data_y)
+        self.data_stamp = self._upload(dataset.data_stamp)
+        self.s_steps = torch.arange(self.seq_len, device=device)
+        self.r_steps = torch.arange(self.label_len + self.pred_len, device=device)
+
+    def _upload(self, array):
+        return torch.as_tensor(np.asarray(array, dtype=np.float32), device=self.device)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_windows // self.batch_size
+        return math.ceil(self.num_windows / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.num_windows, device=self.device)
+        else:
+            order = torch.arange(self.num_windows, device=self.device)
+
+        for i in range(len(self)):
+            s_begin = order[i * self.batch_size:(i + 1) * self.batch_size].unsqueeze(1)
+            s_index = s_begin + self.s_steps
+            r_index = s_begin + (self.seq_len - self.label_len) + self.r_steps
+
+            yield self.data_x[s_index], self.data_y[r_index], \
+                self.data_stamp[s_index], self.data_stamp[r_index]
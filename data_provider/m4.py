@@ -129,6 +129,20 @@ class M4Meta:
     }  # from interpretable.gin
 
 
+def pack_series(values: np.ndarray, dtype=np.float32):
+    """
+    Packs variable-length series into one buffer. NaN values (padding) are dropped.
+
+    :param values: Series, e.g. `M4Dataset.values`.
+    :return: (values, offsets): series i is values[offsets[i]:offsets[i + 1]].
+    """
+    series = [v[~np.isnan(v)] for v in values]
+    offsets = np.zeros(len(series) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in series])
+    packed = np.concatenate(series).astype(dtype) if len(series) > 0 else np.zeros(0, dtype=dtype)
+    return packed, offsets
+
+
 def load_m4_info() -> pd.DataFrame:
     """
     Load M4Info file.
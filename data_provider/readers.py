@@ -0,0 +1,217 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+columnar_formats = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'feather',
+    '.ipc': 'feather',
+}
+
+
+def file_format(path):
+    """
+    Format of a data file from its extension: 'parquet', 'feather' (Feather / Arrow IPC) or 'csv'.
+    """
+    return columnar_formats.get(os.path.splitext(path)[1].lower(), 'csv')
+
+
+def is_columnar(path):
+    return file_format(path) != 'csv'
+
+
+def frame_columns(path):
+    """
+    Column names of a data file, read from the schema (or the csv header) only.
+    """
+    fmt = file_format(path)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).schema_arrow.names
+    elif fmt == 'feather':
+        import pyarrow as pa
+        return pa.ipc.open_file(pa.memory_map(path)).schema.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def frame_length(path):
+    """
+    Number of rows of a columnar data file, read from its metadata only.
+    """
+    fmt = file_format(path)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    elif fmt == 'feather':
+        import pyarrow as pa
+        reader = pa.ipc.open_file(pa.memory_map(path))
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    raise ValueError('Row count from metadata is not available for {}'.format(path))
+
+
+def read_frame(path, columns=None, rows=None):
+    """
+    Reads a csv, Parquet or Feather/Arrow IPC file into a DataFrame.
+
+    :param columns: only read these columns (projection pushdown for columnar files).
+    :param rows: (start, stop) range of rows to return. Parquet files only read the row groups overlapping the
+        range, Feather/Arrow IPC files are memory-mapped and sliced without reading the other rows.
+    """
+    fmt = file_format(path)
+    start, stop = rows if rows is not None else (0, None)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        if rows is None:
+            table = parquet_file.read(columns=columns)
+        else:
+            metadata = parquet_file.metadata
+            groups, offset, first = [], 0, None
+            for i in range(metadata.num_row_groups):
+                group_rows = metadata.row_group(i).num_rows
+                if offset + group_rows > start and (stop is None or offset < stop):
+                    groups.append(i)
+                    first = offset if first is None else first
+                offset += group_rows
+            if groups:
+                table = parquet_file.read_row_groups(groups, columns=columns)
+                table = table.slice(start - first, None if stop is None else stop - start)
+            else:
+                # empty range (or past the end): no row group to read, only the schema
+                table = parquet_file.schema_arrow.empty_table()
+                if columns is not None:
+                    table = table.select(columns)
+    elif fmt == 'feather':
+        import pyarrow as pa
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        if rows is not None:
+            table = table.slice(start, None if stop is None else stop - start)
+    else:
+        df = pd.read_csv(path, usecols=columns)
+        if columns is not None:
+            df = df[columns]
+        return df if rows is None else df.iloc[start:stop].reset_index(drop=True)
+    return table.to_pandas()
+
+
+def count_rows(path):
+    """
+    Number of data rows of a data file. Csv files are scanned in binary blocks without being parsed.
+    """
+    if is_columnar(path):
+        return frame_length(path)
+    rows, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            rows += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        rows += 1
+    return rows - 1  # header
+
+
+def iter_frames(path, columns=None, chunk_rows=100000, stop=None):
+    """
+    Reads a csv, Parquet or Feather/Arrow IPC file as consecutive DataFrames of at most `chunk_rows` rows,
+    only holding one chunk in memory at a time.
+
+    :param columns: only read these columns.
+    :param stop: stop after this many rows.
+    """
+    fmt = file_format(path)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas() for batch in
+                  pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns))
+    elif fmt == 'feather':
+        length = frame_length(path)
+        chunks = (read_frame(path, columns, rows=(start, min(start + chunk_rows, length)))
+                  for start in range(0, length, chunk_rows))
+    else:
+        chunks = (df if columns is None else df[columns] for df in
+                  pd.read_csv(path, usecols=columns, chunksize=chunk_rows, nrows=stop))
+
+    offset = 0
+    for df in chunks:
+        if stop is not None and offset + len(df) > stop:
+            df = df.iloc[:stop - offset]
+        if len(df) > 0:
+            yield df.reset_index(drop=True)
+        offset += len(df)
+        if stop is not None and offset >= stop:
+            break
+
+
+def iter_ranges(path, ranges, columns=None):
+    """
+    Reads the rows [start, stop) of each of `ranges` (in increasing order of start and stop, they may overlap)
+    from a csv, Parquet or Feather/Arrow IPC file, one DataFrame per range.
+
+    Columnar files only read the ranges (see `read_frame`). Csv files are scanned once in binary blocks for
+    the line ends, only the lines of the ranges are parsed.
+
+    :param columns: only read these columns.
+    """
+    if is_columnar(path):
+        for start, stop in ranges:
+            yield read_frame(path, columns, rows=(start, stop))
+        return
+
+    with open(path, 'rb') as f:
+        header = f.readline()
+        # lines of the previous range, the file is at row `end`
+        lines, end = b'', 0
+        for start, stop in ranges:
+            if start >= end:
+                end += read_lines(f, start - end, keep=False)[1]
+                lines = b''
+            if start < end:
+                lines = last_lines(lines, end - start)
+            new_lines, count = read_lines(f, stop - end)
+            lines += new_lines
+            end += count
+            df = pd.read_csv(io.BytesIO(header + lines), usecols=columns)
+            yield df if columns is None else df[columns]
+
+
+def read_lines(f, n, keep=True, block_size=1 << 20):
+    """
+    Reads the next `n` lines of a binary file, fewer at its end; keep=False only moves past them.
+
+    :return: (the lines, number of lines).
+    """
+    blocks, count, last = [], 0, b'\n'
+    while count < n:
+        block = f.read(block_size)
+        if not block:
+            # a last line without line end
+            count += last != b'\n'
+            break
+        is_end = np.frombuffer(block, dtype=np.uint8) == ord('\n')
+        ends = np.count_nonzero(is_end)
+        if count + ends >= n:
+            stop = int(np.flatnonzero(is_end)[n - count - 1]) + 1
+            f.seek(stop - len(block), os.SEEK_CUR)
+            block = block[:stop]
+            ends = n - count
+        count += ends
+        last = block[-1:]
+        if keep:
+            blocks.append(block)
+    return b''.join(blocks), count
+
+
+def last_lines(lines, n):
+    # the last n lines of `lines`, the last one with or without its line end
+    position = len(lines) - 1 if lines.endswith(b'\n') else len(lines)
+    for _ in range(n):
+        position = lines.rfind(b'\n', 0, position)
+        if position < 0:
+            return lines
+    return lines[position + 1:]
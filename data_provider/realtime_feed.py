@@ -0,0 +1,103 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from data_fetcher import CryptoDataLoader
+from utils.market_data import market_source
+
+
+class RealtimeFeed:
+    """
+    Long-lived source of the realtime BTC bars: one CryptoDataLoader for the lifetime of the predictor and a
+    bounded ring buffer of the newest `capacity` bars with their indicators, refreshed incrementally by a
+    background thread every `interval` seconds. Reading the newest rows only copies them out of the buffer,
+    there is no file I/O, exchange request or thread startup on the caller's side.
+
+    In backtest mode the loader never fetches and windows are read from its history instead.
+
+    The bars come from `args.market_source` (a ccxt exchange or a file replayed by a simulated exchange,
+    see `utils.market_data.market_source`).
+
+    :param capacity: number of newest bars kept, at least seq_len.
+    :param interval: seconds between two refreshes of the background thread; None to refresh only on
+        `refresh()` calls.
+    """
+
+    def __init__(self, args, capacity=1024, interval=10., loader=None):
+        self.args = args
+        self.loader = loader if loader is not None else \
+            CryptoDataLoader(source=market_source(args))
+        self.capacity = capacity
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.exit_flag = threading.Event()
+
+        history = self.loader.get_data(-capacity)
+        self.columns = list(history.columns[1:])
+        self.values = np.empty((capacity, len(self.columns)), dtype=np.float64)
+        self.dates = np.empty(capacity, dtype='datetime64[ns]')
+        self.count = 0
+        self.push(history.iloc[-capacity:])
+
+        self.thread = None
+        if not args.backtest:
+            self.refresh()
+            if interval is not None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def push(self, df):
+        """
+        Appends rows (a 'date' column and the columns of the feed) to the ring buffer, oldest first.
+        """
+        if df is None or len(df) == 0:
+            return
+        df = df.iloc[-self.capacity:]
+        position = (self.count + np.arange(len(df))) % self.capacity
+        values = df[self.columns].to_numpy(dtype=np.float64)
+        dates = pd.to_datetime(df['date']).values
+        with self.lock:
+            self.values[position] = values
+            self.dates[position] = dates
+            self.count += len(df)
+
+    def refresh(self):
+        # only the new rows, the history stays in the bar log of the loader
+        self.push(self.loader.append_new_data(verbose=False))
+
+    def run(self):
+        while not self.exit_flag.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # a failed refresh is retried on the next interval, the buffer keeps the bars it has
+                print(f"Feed refresh failed: {e}")
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def latest(self, n):
+        """
+        DataFrame of the newest `n` bars (fewer if the feed has not seen that many), oldest first.
+        """
+        with self.lock:
+            n = min(n, len(self))
+            position = (self.count - n + np.arange(n)) % self.capacity
+            values, dates = self.values[position], self.dates[position]
+        # column-major like the frames of the loader, the scaler then sums in the same order
+        df = pd.DataFrame(np.asfortranarray(values), columns=self.columns)
+        df.insert(0, 'date', dates)
+        return df
+
+    def window(self, begin, end):
+        """
+        Bars [begin, end) of the whole history of the loader (read from its bar log), for backtests.
+        """
+        return self.loader.get_data(begin, end)
+
+    def stop(self):
+        self.exit_flag.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.loader.stop()
@@ -1,10 +1,14 @@
+import math
 import os
 import numpy as np
 import pandas as pd
 import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Sampler
 
 
-def collate_fn(data, max_len=None):
+def collate_fn(data, max_len=None, transform=None):
     """Build mini-batch tensors from a list of (X, mask) tuples. Mask input. Create
     Args:
         data: len(batch_size) list of tuples (X, y).
@@ -13,6 +17,7 @@ def collate_fn(data, max_len=None):
                 (for classification or regression, respectively). num_labels > 1 for multi-task models
         max_len: global fixed sequence length. Used for architectures requiring fixed length input,
             where the batch length cannot vary dynamically. Longer sequences are clipped, shorter are padded with 0s
+        transform: optional callable (X, lengths) -> X applied once to the whole padded batch
     Returns:
         X: (batch_size, padded_length, feat_dim) torch tensor of masked features (input)
         targets: (batch_size, padded_length, feat_dim) torch tensor of unmasked features (output)
@@ -21,23 +26,24 @@ def collate_fn(data, max_len=None):
         padding_masks: (batch_size, padded_length) boolean tensor, 1 means keep vector at this position, 0 means padding
     """
 
-    batch_size = len(data)
     features, labels = zip(*data)
 
     # Stack and pad features and masks (convert 2D to 3D tensors, i.e. add batch dimension)
-    lengths = [X.shape[0] for X in features]  # original sequence length for each time series
+    lengths = torch.tensor([X.shape[0] for X in features])  # original sequence length for each time series
     if max_len is None:
-        max_len = max(lengths)
+        max_len = int(lengths.max())
 
-    X = torch.zeros(batch_size, max_len, features[0].shape[-1])  # (batch_size, padded_length, feat_dim)
-    for i in range(batch_size):
-        end = min(lengths[i], max_len)
-        X[i, :end, :] = features[i][:end, :]
+    X = pad_sequence(features, batch_first=True).float()  # (batch_size, longest length, feat_dim)
+    if X.shape[1] < max_len:
+        X = F.pad(X, (0, 0, 0, max_len - X.shape[1]))
+    X = X[:, :max_len]  # (batch_size, padded_length, feat_dim)
 
     targets = torch.stack(labels, dim=0)  # (batch_size, num_labels)
 
-    padding_masks = padding_mask(torch.tensor(lengths, dtype=torch.int16),
-                                 max_len=max_len)  # (batch_size, padded_length) boolean tensor, "1" means keep
+    padding_masks = padding_mask(lengths, max_len=max_len)  # (batch_size, padded_length) boolean tensor, "1" means keep
+
+    if transform is not None:
+        X = transform(X, lengths.clamp(max=max_len))
 
     return X, targets, padding_masks
 
@@ -47,12 +53,43 @@ def padding_mask(lengths, max_len=None):
     Used to mask padded positions: creates a (batch_size, max_len) boolean mask from a tensor of sequence lengths,
     where 1 means keep element at this position (time step)
     """
-    batch_size = lengths.numel()
-    max_len = max_len or lengths.max_val()  # trick works because of overloading of 'or' operator for non-boolean types
-    return (torch.arange(0, max_len, device=lengths.device)
-            .type_as(lengths)
-            .repeat(batch_size, 1)
-            .lt(lengths.unsqueeze(1)))
+    max_len = max_len or int(lengths.max())
+    return torch.arange(0, max_len, device=lengths.device).lt(lengths.unsqueeze(1))
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping samples of similar length. The samples are sorted by length and split into
+    `num_buckets` buckets of equal size; every batch is drawn from a single bucket. With `shuffle` the samples
+    are shuffled inside their bucket and the batches of all buckets are shuffled together.
+
+    Combined with `collate_fn(max_len=None)` a batch is only padded to the longest sample of its bucket.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, num_buckets=10):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        order = np.argsort(np.asarray(lengths), kind='stable')
+        self.buckets = [b for b in np.array_split(order, min(num_buckets, len(order))) if len(b) > 0]
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket)).numpy()]
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum(math.ceil(len(b) / self.batch_size) for b in self.buckets)
 
 
 class Normalizer(object):
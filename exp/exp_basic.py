@@ -1,5 +1,6 @@
 import os
 import torch
+from data_provider.data_factory import clear_views
 from models import Autoformer, Transformer, TimesNet, Nonstationary_Transformer, DLinear, FEDformer, \
     Informer, LightTS, Reformer, ETSformer, Pyraformer, PatchTST, MICN, Crossformer, FiLM, iTransformer, \
     Koopa, TiDE, FreTS, TimeMixer, TSMixer, SegRNN, MambaSimple, Mamba, TemporalFusionTransformer
@@ -8,6 +9,8 @@ from models import Autoformer, Transformer, TimesNet, Nonstationary_Transformer,
 class Exp_Basic(object):
     def __init__(self, args):
         self.args = args
+        # the data views of a previous experiment are not reused
+        clear_views()
         self.model_dict = {
             'TimesNet': TimesNet,
             'Autoformer': Autoformer,
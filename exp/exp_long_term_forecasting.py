@@ -9,7 +9,7 @@ import os
 import time
 import warnings
 import numpy as np
-from utils.dtw_metric import dtw,accelerated_dtw
+from utils.dtw_metric import dtw,accelerated_dtw,batch_dtw
 from utils.augmentation import run_augmentation,run_augmentation_single
 
 warnings.filterwarnings('ignore')
@@ -255,16 +255,8 @@ class Exp_Long_Term_Forecast(Exp_Basic):
         
         # dtw calculation
         if self.args.use_dtw:
-            dtw_list = []
-            manhattan_distance = lambda x, y: np.abs(x - y)
-            for i in range(preds.shape[0]):
-                x = preds[i].reshape(-1,1)
-                y = trues[i].reshape(-1,1)
-                if i % 100 == 0:
-                    print("calculating dtw iter:", i)
-                d, _, _, _ = accelerated_dtw(x, y, dist=manhattan_distance)
-                dtw_list.append(d)
-            dtw = np.array(dtw_list).mean()
+            # all samples through one banded dynamic program, sharded over --eval_workers processes
+            dtw = batch_dtw(preds, trues, window=self.args.dtw_window, num_workers=self.args.eval_workers).mean()
         else:
             dtw = -999
             
@@ -4,6 +4,8 @@ import os
 import warnings
 from datetime import timedelta, datetime
 from data_provider.data_factory import data_provider
+from data_provider.realtime_feed import RealtimeFeed
+from utils.inference_session import InferenceSession
 from exp.exp_basic import Exp_Basic
 from utils.display_manager import DisplayManager
 from utils.BTC_trading_strategy import BTCTradingStrategy
@@ -20,9 +22,10 @@ class RealTimeBTCPricePredictor(Exp_Basic):
         self.time = 0
         self.trade = BTCTradingStrategy(self.trade_pred_time, self.pred_time)
         self.display = DisplayManager(self, self.pred_time, self.interval, self.trade)
-        self.last_test_data = None
         self.args.seq_begin = 100
         self.args.seq_end = self.args.seq_begin + self.args.seq_len
+        self.feed = None
+        self.session = None  # InferenceSession created on the first tick
 
     def _build_model(self):
         model = self.model_dict[self.args.model].Model(self.args).float()
@@ -30,67 +33,51 @@ class RealTimeBTCPricePredictor(Exp_Basic):
             model = nn.DataParallel(model, device_ids=self.args.device_ids)
         return model
 
+    def _get_feed(self):
+        if self.feed is None:
+            # started on the first tick and kept: the bars are refreshed in the background between ticks
+            self.feed = RealtimeFeed(self.args, capacity=max(self.args.feed_capacity, self.args.seq_len),
+                                     interval=self.args.feed_interval)
+        return self.feed
+
     def _get_data(self, flag):
-        data_set, data_loader = data_provider(self.args, flag)
+        data_set, data_loader = data_provider(self.args, flag, feed=self._get_feed())
         return data_set, data_loader
 
     def predict(self):
-        test_data, test_loader = self._get_data(flag='test')
+        feed = self._get_feed()
+        if self.session is None:
+            self.model.eval()
+            self.session = InferenceSession(self.model, self.args, feed.columns, self.device)
+        if self.args.backtest:
+            bars = feed.window(self.args.seq_begin, self.args.seq_end)
+        else:
+            bars = feed.latest(self.args.seq_len)
         self.args.seq_begin += 1
         self.args.seq_end += 1
 
-        # Check if the test data has changed
-        if self.last_test_data is not None and test_data == self.last_test_data:
+        # only the bars newer than the previous tick are written into the session
+        written = self.session.update(bars)
+        if written is None:
+            print(f"Not enough bars yet ({len(bars)} of {self.args.seq_len}), skipping prediction.")
+            return
+        if written == 0:
             print("Test data has not changed, skipping prediction.")
             return
-        self.last_test_data = test_data
-
-        with torch.no_grad():
-            for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(test_loader):
-                batch_x = batch_x.float().to(self.device)
-                batch_y = batch_y.float().to(self.device)
-                batch_x_mark = batch_x_mark.float().to(self.device)
-                batch_y_mark = batch_y_mark.float().to(self.device)
-
-                dec_inp = torch.zeros_like(batch_y[:, -self.args.pred_len:, :]).float()
-                dec_inp = torch.cat([batch_y[:, :self.args.label_len, :], dec_inp], dim=1).float().to(self.device)
-
-                if self.args.use_amp:
-                    with torch.cuda.amp.autocast():
-                        if self.args.output_attention:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                        else:
-                            outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-                else:
-                    if self.args.output_attention:
-                        outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                    else:
-                        outputs = self.model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-
-                f_dim = -1 if self.args.features == 'MS' else 0
-                outputs = outputs[:, -self.args.pred_len:, :]
-                batch_y = batch_y[:, -self.args.pred_len:, :].to(self.device)
-                outputs = outputs.detach().cpu().numpy()
-                batch_y = batch_y.detach().cpu().numpy()
-                if test_data.scale and self.args.inverse:
-                    shape = outputs.shape
-                    outputs = test_data.inverse_transform(outputs.squeeze(0)).reshape(shape)
-                    batch_x = test_data.inverse_transform(batch_x.squeeze(0)).reshape(shape)
-
-                outputs = outputs[:, :, f_dim:]
-                batch_x = batch_x[:, :, f_dim:]
-
-                pred_prices = outputs[0, :, -1][:self.pred_time]
-                true_prices = batch_x[0, :, -1]
-                true_last = true_prices[-1]
-                time_last = test_data.get_last_time()
 
-                print(f"time: {self.time}")
-                print(f"Predictions for next {self.pred_time} minutes starting from {time_last + timedelta(minutes=1)} : {pred_prices}")
-                print(f"True at {time_last} : {true_last}")
-                if(self.time % self.trade_interval == 0):
-                    self.trade.update(true_prices, pred_prices)
-                self.display.update_data(time_last, true_prices, pred_prices)
+        outputs = self.session.forward()
+        pred_prices, true_prices = self.session.postprocess(outputs)
+        pred_prices = pred_prices[:self.pred_time]
+        true_last = true_prices[-1]
+        time_last = self.session.last_time
+
+        print(f"time: {self.time}")
+        print(f"Predictions for next {self.pred_time} minutes starting from {time_last + timedelta(minutes=1)} : {pred_prices}")
+        print(f"True at {time_last} : {true_last}")
+        print("Latency (ms): " + ", ".join(f"{stage} {ms:.2f}" for stage, ms in self.session.latency.items()))
+        if(self.time % self.trade_interval == 0):
+            self.trade.update(true_prices, pred_prices)
+        self.display.update_data(time_last, true_prices, pred_prices)
 
         self.time += self.interval
 
@@ -1,7 +1,7 @@
 from data_provider.data_factory import data_provider
 from data_provider.m4 import M4Meta
 from exp.exp_basic import Exp_Basic
-from utils.tools import EarlyStopping, adjust_learning_rate, visual
+from utils.tools import EarlyStopping, adjust_learning_rate, visual, inference_chunk_size
 from utils.losses import mape_loss, mase_loss, smape_loss
 from utils.m4_summary import M4Summary
 import torch
@@ -140,33 +140,40 @@ class Exp_Short_Term_Forecast(Exp_Basic):
 
         return self.model
 
+    def predict(self, x):
+        """
+        Forecasts of all series of `x` (series, seq_len, C), in chunks of `inference_chunk_size` series.
+        Each chunk is moved to the device and its forecast is written into an output preallocated on the host.
+
+        :return: (series, pred_len, C) tensor on the host.
+        """
+        B, _, C = x.shape
+        chunk_size = inference_chunk_size(self.args, B)
+        outputs = torch.empty((B, self.args.pred_len, C))
+        for begin in range(0, B, chunk_size):
+            batch_x = x[begin:begin + chunk_size].to(self.device)
+            # decoder input
+            dec_inp = torch.zeros((batch_x.shape[0], self.args.pred_len, C), device=self.device)
+            dec_inp = torch.cat([batch_x[:, -self.args.label_len:, :], dec_inp], dim=1)
+            # encoder - decoder
+            outputs[begin:begin + chunk_size] = self.model(batch_x, None, dec_inp, None)[:, -self.args.pred_len:, :]
+        return outputs
+
     def vali(self, train_loader, vali_loader, criterion):
         x, _ = train_loader.dataset.last_insample_window()
         y = vali_loader.dataset.timeseries
-        x = torch.tensor(x, dtype=torch.float32).to(self.device)
-        x = x.unsqueeze(-1)
+        x = torch.from_numpy(x).unsqueeze(-1)
 
         self.model.eval()
         with torch.no_grad():
-            # decoder input
-            B, _, C = x.shape
-            dec_inp = torch.zeros((B, self.args.pred_len, C)).float().to(self.device)
-            dec_inp = torch.cat([x[:, -self.args.label_len:, :], dec_inp], dim=1).float()
-            # encoder - decoder
-            outputs = torch.zeros((B, self.args.pred_len, C)).float()  # .to(self.device)
-            id_list = np.arange(0, B, 500)  # validation set size
-            id_list = np.append(id_list, B)
-            for i in range(len(id_list) - 1):
-                outputs[id_list[i]:id_list[i + 1], :, :] = self.model(x[id_list[i]:id_list[i + 1]], None,
-                                                                      dec_inp[id_list[i]:id_list[i + 1]],
-                                                                      None).detach().cpu()
+            outputs = self.predict(x)
             f_dim = -1 if self.args.features == 'MS' else 0
             outputs = outputs[:, -self.args.pred_len:, f_dim:]
             pred = outputs
             true = torch.from_numpy(np.array(y))
             batch_y_mark = torch.ones(true.shape)
 
-            loss = criterion(x.detach().cpu()[:, :, 0], self.args.frequency_map, pred[:, :, 0], true, batch_y_mark)
+            loss = criterion(x[:, :, 0], self.args.frequency_map, pred[:, :, 0], true, batch_y_mark)
 
         self.model.train()
         return loss
@@ -176,8 +183,7 @@ class Exp_Short_Term_Forecast(Exp_Basic):
         _, test_loader = self._get_data(flag='test')
         x, _ = train_loader.dataset.last_insample_window()
         y = test_loader.dataset.timeseries
-        x = torch.tensor(x, dtype=torch.float32).to(self.device)
-        x = x.unsqueeze(-1)
+        x = torch.from_numpy(x).unsqueeze(-1)
 
         if test:
             print('loading model')
@@ -189,27 +195,15 @@ class Exp_Short_Term_Forecast(Exp_Basic):
 
         self.model.eval()
         with torch.no_grad():
-            B, _, C = x.shape
-            dec_inp = torch.zeros((B, self.args.pred_len, C)).float().to(self.device)
-            dec_inp = torch.cat([x[:, -self.args.label_len:, :], dec_inp], dim=1).float()
-            # encoder - decoder
-            outputs = torch.zeros((B, self.args.pred_len, C)).float().to(self.device)
-            id_list = np.arange(0, B, 1)
-            id_list = np.append(id_list, B)
-            for i in range(len(id_list) - 1):
-                outputs[id_list[i]:id_list[i + 1], :, :] = self.model(x[id_list[i]:id_list[i + 1]], None,
-                                                                      dec_inp[id_list[i]:id_list[i + 1]], None)
-
-                if id_list[i] % 1000 == 0:
-                    print(id_list[i])
+            outputs = self.predict(x)
 
             f_dim = -1 if self.args.features == 'MS' else 0
             outputs = outputs[:, -self.args.pred_len:, f_dim:]
-            outputs = outputs.detach().cpu().numpy()
+            outputs = outputs.numpy()
 
             preds = outputs
             trues = y
-            x = x.detach().cpu().numpy()
+            x = x.numpy()
 
             for i in range(0, preds.shape[0], preds.shape[0] // 10):
                 gt = np.concatenate((x[i, :, 0], trues[i]), axis=0)
@@ -237,7 +231,8 @@ class Exp_Short_Term_Forecast(Exp_Basic):
                 and 'Daily_forecast.csv' in os.listdir(file_path) \
                 and 'Hourly_forecast.csv' in os.listdir(file_path) \
                 and 'Quarterly_forecast.csv' in os.listdir(file_path):
-            m4_summary = M4Summary(file_path, self.args.root_path)
+            m4_summary = M4Summary(file_path, self.args.root_path, cache=self.args.data_cache,
+                                    num_workers=self.args.eval_workers)
             # m4_forecast.set_index(m4_winner_forecast.columns[0], inplace=True)
             smape_results, owa_results, mape, mase = m4_summary.evaluate()
             print('smape:', smape_results)
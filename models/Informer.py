@@ -15,6 +15,7 @@ class Model(nn.Module):
     def __init__(self, configs):
         super(Model, self).__init__()
         self.task_name = configs.task_name
+        self.seq_len = configs.seq_len
         self.pred_len = configs.pred_len
         self.label_len = configs.label_len
 
@@ -124,6 +125,7 @@ class Model(nn.Module):
         output = self.act(enc_out)  # the output transformer encoder/decoder embeddings don't include non-linearity
         output = self.dropout(output)
         output = output * x_mark_enc.unsqueeze(-1)  # zero-out padding embeddings
+        output = F.pad(output, (0, 0, 0, self.seq_len - output.shape[1]))  # batches padded to their longest sample
         output = output.reshape(output.shape[0], -1)  # (batch_size, seq_length * d_model)
         output = self.projection(output)  # (batch_size, num_classes)
         return output
@@ -108,6 +108,8 @@ class Model(nn.Module):
         output = self.dropout(output)
         # zero-out padding embeddings
         output = output * x_mark_enc.unsqueeze(-1)
+        # batches padded to their longest sample (--dynamic_padding) back to seq_len
+        output = F.pad(output, (0, 0, 0, self.seq_len - output.shape[1]))
         # (batch_size, seq_length * d_model)
         output = output.reshape(output.shape[0], -1)
         output = self.projection(output)  # (batch_size, num_classes)
@@ -41,13 +41,12 @@ class TimesBlock(nn.Module):
         for i in range(self.k):
             period = period_list[i]
             # padding
-            if (self.seq_len + self.pred_len) % period != 0:
-                length = (
-                                 ((self.seq_len + self.pred_len) // period) + 1) * period
-                padding = torch.zeros([x.shape[0], (length - (self.seq_len + self.pred_len)), x.shape[2]]).to(x.device)
+            if T % period != 0:
+                length = ((T // period) + 1) * period
+                padding = torch.zeros([x.shape[0], (length - T), x.shape[2]]).to(x.device)
                 out = torch.cat([x, padding], dim=1)
             else:
-                length = (self.seq_len + self.pred_len)
+                length = T
                 out = x
             # reshape
             out = out.reshape(B, length // period, period,
@@ -56,7 +55,7 @@ class TimesBlock(nn.Module):
             out = self.conv(out)
             # reshape back
             out = out.permute(0, 2, 3, 1).reshape(B, -1, N)
-            res.append(out[:, :(self.seq_len + self.pred_len), :])
+            res.append(out[:, :T, :])
         res = torch.stack(res, dim=-1)
         # adaptive aggregation
         period_weight = F.softmax(period_weight, dim=1)
@@ -195,6 +194,8 @@ class Model(nn.Module):
         output = self.dropout(output)
         # zero-out padding embeddings
         output = output * x_mark_enc.unsqueeze(-1)
+        # batches padded to their longest sample (--dynamic_padding) back to seq_len
+        output = F.pad(output, (0, 0, 0, self.seq_len - output.shape[1]))
         # (batch_size, seq_length * d_model)
         output = output.reshape(output.shape[0], -1)
         output = self.projection(output)  # (batch_size, num_classes)
@@ -30,13 +30,15 @@ if __name__ == '__main__':
     # data loader
     parser.add_argument('--data', type=str, required=True, default='ETTm1', help='dataset type')
     parser.add_argument('--root_path', type=str, default='./data/ETT/', help='root path of the data file')
-    parser.add_argument('--data_path', type=str, default='ETTh1.csv', help='data file')
+    parser.add_argument('--data_path', type=str, default='ETTh1.csv', help='data file, .csv or columnar .parquet/.feather/.arrow (Dataset_Custom only)')
     parser.add_argument('--features', type=str, default='M',
                         help='forecasting task, options:[M, S, MS]; M:multivariate predict multivariate, S:univariate predict univariate, MS:multivariate predict univariate')
     parser.add_argument('--target', type=str, default='OT', help='target feature in S or MS task')
     parser.add_argument('--freq', type=str, default='h',
                         help='freq for time features encoding, options:[s:secondly, t:minutely, h:hourly, d:daily, b:business days, w:weekly, m:monthly], you can also use more detailed freq like 15min or 3h')
     parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='location of model checkpoints')
+    parser.add_argument('--data_cache', action='store_true', default=False,
+                        help='cache the parsed and scaled dataset as .npy files next to the data file and memory-map it, also memoizes time stamp features')
 
     # forecasting task
     parser.add_argument('--seq_len', type=int, default=96, help='input sequence length')
@@ -88,9 +90,32 @@ if __name__ == '__main__':
 
     # optimization
     parser.add_argument('--num_workers', type=int, default=10, help='data loader num workers')
+    parser.add_argument('--eval_workers', type=int, default=0,
+                        help='processes used to score the M4 seasonal groups and to compute the DTW metric, '
+                             '0 to compute them in the main process')
+    parser.add_argument('--window_batch', action='store_true', default=False,
+                        help='gather whole batches of forecasting windows in one vectorized operation')
+    parser.add_argument('--data_on_device', action='store_true', default=False,
+                        help='upload the whole forecasting dataset to the device once and build batches there '
+                             '(falls back to the DataLoader if it does not fit in the free device memory)')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='read the forecasting data file in chunks instead of loading it in memory '
+                             '(custom and BTC data, without augmentation)')
+    parser.add_argument('--stream_chunk', type=int, default=100000, help='rows per chunk with --stream')
+    parser.add_argument('--stream_buffer', type=int, default=10000,
+                        help='size of the shuffle buffer of training windows with --stream')
+    parser.add_argument('--length_buckets', type=int, default=0,
+                        help='classification: draw each batch from one of this many length buckets, 0 to disable')
+    parser.add_argument('--dynamic_padding', action='store_true', default=False,
+                        help='classification: pad batches to their longest sample instead of seq_len; only for '
+                             'TimesNet, Transformer, Informer and Reformer')
     parser.add_argument('--itr', type=int, default=1, help='experiments times')
     parser.add_argument('--train_epochs', type=int, default=10, help='train epochs')
     parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
+    parser.add_argument('--infer_batch', type=int, default=0,
+                        help='series per forward pass in short-term forecasting vali/test, 0 to derive it from --infer_memory')
+    parser.add_argument('--infer_memory', type=int, default=2048,
+                        help='memory budget (MB) of the activations of one inference chunk when --infer_batch is 0')
     parser.add_argument('--patience', type=int, default=3, help='early stopping patience')
     parser.add_argument('--learning_rate', type=float, default=0.0001, help='optimizer learning rate')
     parser.add_argument('--des', type=str, default='test', help='exp description')
@@ -112,6 +137,8 @@ if __name__ == '__main__':
     # metrics (dtw)
     parser.add_argument('--use_dtw', type=bool, default=False, 
                         help='the controller of using dtw metric (dtw is time consuming, not suggested unless necessary)')
+    parser.add_argument('--dtw_window', type=int, default=None,
+                        help='Sakoe-Chiba band of the dtw metric in time steps, None for the unconstrained dtw')
     
     # Augmentation
     parser.add_argument('--augmentation_ratio', type=int, default=0, help="How many times to augment")
@@ -132,7 +159,36 @@ if __name__ == '__main__':
     parser.add_argument('--discdtw', default=False, action="store_true", help="Discrimitive DTW warp preset augmentation")
     parser.add_argument('--discsdtw', default=False, action="store_true", help="Discrimitive shapeDTW warp preset augmentation")
     parser.add_argument('--extra_tag', type=str, default="", help="Anything extra")
+    parser.add_argument('--batch_augmentation', action='store_true', default=False,
+                        help='classification: apply the jitter/scaling/rotation/permutation/warp/slice presets as batched '
+                             'torch transforms in the collate step instead of per sample in numpy')
     parser.add_argument('--backtest', default=False, action="store_true", help="backtest")
+    parser.add_argument('--feed_capacity', type=int, default=1024,
+                        help='realtime BTC: number of newest bars kept in memory by the feed')
+    parser.add_argument('--feed_interval', type=float, default=10.,
+                        help='realtime BTC: seconds between two background refreshes of the feed')
+    parser.add_argument('--market_source', type=str, default='binance',
+                        help='realtime BTC: ccxt exchange id of the bars, or a file of bars (csv, parquet, bar log) '
+                             'replayed by a simulated exchange')
+    parser.add_argument('--market_proxy', type=str, default=None,
+                        help='realtime BTC: proxy of the exchange requests, e.g. http://127.0.0.1:4780')
+    parser.add_argument('--sim_start', type=str, default=None,
+                        help='realtime BTC, replayed --market_source: clock of the replay at the start, e.g. '
+                             '2024-06-21 00:00:00; one day after the first bar by default')
+    parser.add_argument('--sim_speed', type=float, default=1.,
+                        help='realtime BTC, replayed --market_source: simulated seconds per second')
+    parser.add_argument('--sim_latency', type=float, default=0.,
+                        help='realtime BTC, replayed --market_source: seconds per request')
+    parser.add_argument('--sim_rate_limit', type=float, default=0.,
+                        help='realtime BTC, replayed --market_source: ms between two requests')
+    parser.add_argument('--sim_page_size', type=int, default=1000,
+                        help='realtime BTC, replayed --market_source: bars per request')
+    parser.add_argument('--sim_network_errors', type=float, default=0.,
+                        help='realtime BTC, replayed --market_source: probability of a network error per request')
+    parser.add_argument('--sim_exchange_errors', type=float, default=0.,
+                        help='realtime BTC, replayed --market_source: probability of an exchange error per request')
+    parser.add_argument('--sim_seed', type=int, default=0,
+                        help='realtime BTC, replayed --market_source: seed of the injected errors')
 
     args = parser.parse_args()
     # args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
@@ -1,5 +1,6 @@
 import numpy as np
 from tqdm import tqdm
+from utils.dtw_index import DTWIndex
 
 def jitter(x, sigma=0.03):
     # https://arxiv.org/pdf/1706.00527.pdf
@@ -142,12 +143,14 @@ def spawner(x, labels, sigma=0.05, verbose=0):
             ret[i,:] = pat
     return jitter(ret, sigma=sigma)
 
-def wdba(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True, verbose=0):
+def wdba(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True, verbose=0, index=None):
     # https://ieeexplore.ieee.org/document/8215569
     # use verbose = -1 to turn off warnings    
     # slope_constraint is for DTW. "symmetric" or "asymmetric"
-    x = np.array(x)
-    import utils.dtw as dtw
+    # index is a utils.dtw_index.DTWIndex of x to share the distances between calls
+    if index is None:
+        index = DTWIndex(np.array(x), labels)
+    x = index.x
     
     if use_window:
         window = np.ceil(x.shape[1] / 10.).astype(int)
@@ -164,21 +167,19 @@ def wdba(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True,
         if choices.size > 0:        
             # pick random intra-class pattern
             k = min(choices.size, batch_size)
-            random_prototypes = x[np.random.choice(choices, k, replace=False)]
+            prototype_ids = np.random.choice(choices, k, replace=False)
+            random_prototypes = x[prototype_ids]
             
-            # calculate dtw between all
-            dtw_matrix = np.zeros((k, k))
-            for p, prototype in enumerate(random_prototypes):
-                for s, sample in enumerate(random_prototypes):
-                    if p == s:
-                        dtw_matrix[p, s] = 0.
-                    else:
-                        dtw_matrix[p, s] = dtw.dtw(prototype, sample, dtw.RETURN_VALUE, slope_constraint=slope_constraint, window=window)
+            # calculate dtw between all, only the rows that can give the medoid are computed
+            dtw_matrix = index.medoid_distances(prototype_ids, slope_constraint, window)
                         
             # get medoid
             medoid_id = np.argsort(np.sum(dtw_matrix, axis=1))[0]
             nearest_order = np.argsort(dtw_matrix[medoid_id])
             medoid_pattern = random_prototypes[medoid_id]
+            others = nearest_order[nearest_order != medoid_id]
+            if others.size > 0 and dtw_matrix[medoid_id, nearest_order[1]] != 0.:
+                paths = dict(zip(others, index.paths(prototype_ids[[medoid_id] * others.size], prototype_ids[others], slope_constraint, window)))
             
             # start weighted DBA
             average_pattern = np.zeros_like(medoid_pattern)
@@ -188,7 +189,7 @@ def wdba(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True,
                     average_pattern += medoid_pattern
                     weighted_sums += np.ones_like(weighted_sums) 
                 else:
-                    path = dtw.dtw(medoid_pattern, random_prototypes[nid], dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)
+                    path = paths[nid]
                     dtw_value = dtw_matrix[medoid_id, nid]
                     warped = random_prototypes[nid, path[1]]
                     weight = np.exp(np.log(0.5)*dtw_value/dtw_matrix[medoid_id, nearest_order[1]])
@@ -218,21 +219,29 @@ def random_guided_warp(x, labels, slope_constraint="symmetric", use_window=True,
     orig_steps = np.arange(x.shape[1])
     l = np.argmax(labels, axis=1) if labels.ndim > 1 else labels
     
-    ret = np.zeros_like(x)
-    # for i, pat in enumerate(tqdm(x)):
-    for i, pat in enumerate(x):
+    # pick the random intra-class patterns first (same draws as one by one), then warp all pairs in one batch
+    prototype_ids = {}
+    for i in range(x.shape[0]):
         # guarentees that same one isnt selected
         choices = np.delete(np.arange(x.shape[0]), i)
         # remove ones of different classes
         choices = np.where(l[choices] == l[i])[0]
-        if choices.size > 0:        
-            # pick random intra-class pattern
-            random_prototype = x[np.random.choice(choices)]
+        if choices.size > 0:
+            prototype_ids[i] = np.random.choice(choices)
+    if dtw_type != "shape" and prototype_ids:
+        ids = np.array(list(prototype_ids))
+        paths = dict(zip(ids, dtw.dtw_batch(x[[prototype_ids[i] for i in ids]], x[ids], dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)))
+
+    ret = np.zeros_like(x)
+    # for i, pat in enumerate(tqdm(x)):
+    for i, pat in enumerate(x):
+        if i in prototype_ids:
+            random_prototype = x[prototype_ids[i]]
             
             if dtw_type == "shape":
                 path = dtw.shape_dtw(random_prototype, pat, dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)
             else:
-                path = dtw.dtw(random_prototype, pat, dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)
+                path = paths[i]
                             
             # Time warp
             warped = pat[path[1]]
@@ -247,12 +256,15 @@ def random_guided_warp(x, labels, slope_constraint="symmetric", use_window=True,
 def random_guided_warp_shape(x, labels, slope_constraint="symmetric", use_window=True):
     return random_guided_warp(x, labels, slope_constraint, use_window, dtw_type="shape")
 
-def discriminative_guided_warp(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True, dtw_type="normal", use_variable_slice=True, verbose=0):
+def discriminative_guided_warp(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True, dtw_type="normal", use_variable_slice=True, verbose=0, index=None):
     # use verbose = -1 to turn off warnings
     # slope_constraint is for DTW. "symmetric" or "asymmetric"
     # dtw_type is for shapeDTW or DTW. "normal" or "shape"
+    # index is a utils.dtw_index.DTWIndex of x to share the distances between calls
     
     import utils.dtw as dtw
+    if index is None:
+        index = DTWIndex(x, labels)
     
     if use_window:
         window = np.ceil(x.shape[1] / 10.).astype(int)
@@ -278,28 +290,26 @@ def discriminative_guided_warp(x, labels, batch_size=6, slope_constraint="symmet
         if positive.size > 0 and negative.size > 0:
             pos_k = min(positive.size, positive_batch)
             neg_k = min(negative.size, negative_batch)
-            positive_prototypes = x[np.random.choice(positive, pos_k, replace=False)]
-            negative_prototypes = x[np.random.choice(negative, neg_k, replace=False)]
+            positive_ids = np.random.choice(positive, pos_k, replace=False)
+            negative_ids = np.random.choice(negative, neg_k, replace=False)
+            positive_prototypes = x[positive_ids]
                         
             # vector embedding and nearest prototype in one
             pos_aves = np.zeros((pos_k))
             neg_aves = np.zeros((pos_k))
             if dtw_type == "shape":
-                for p, pos_prot in enumerate(positive_prototypes):
-                    for ps, pos_samp in enumerate(positive_prototypes):
+                for p, pos_id in enumerate(positive_ids):
+                    for ps, pos_samp in enumerate(positive_ids):
                         if p != ps:
-                            pos_aves[p] += (1./(pos_k-1.))*dtw.shape_dtw(pos_prot, pos_samp, dtw.RETURN_VALUE, slope_constraint=slope_constraint, window=window)
-                    for ns, neg_samp in enumerate(negative_prototypes):
-                        neg_aves[p] += (1./neg_k)*dtw.shape_dtw(pos_prot, neg_samp, dtw.RETURN_VALUE, slope_constraint=slope_constraint, window=window)
+                            pos_aves[p] += (1./(pos_k-1.))*index.shape_distance(pos_id, pos_samp, slope_constraint, window)
+                    for ns, neg_samp in enumerate(negative_ids):
+                        neg_aves[p] += (1./neg_k)*index.shape_distance(pos_id, neg_samp, slope_constraint, window)
                 selected_id = np.argmax(neg_aves - pos_aves)
-                path = dtw.shape_dtw(positive_prototypes[selected_id], pat, dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)
+                path = dtw.shape_dtw(positive_prototypes[selected_id], pat, dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window,
+                                     prototype_descriptors=index.descriptors(positive_ids[selected_id]), sample_descriptors=index.descriptors(i))
             else:
-                for p, pos_prot in enumerate(positive_prototypes):
-                    for ps, pos_samp in enumerate(positive_prototypes):
-                        if p != ps:
-                            pos_aves[p] += (1./(pos_k-1.))*dtw.dtw(pos_prot, pos_samp, dtw.RETURN_VALUE, slope_constraint=slope_constraint, window=window)
-                    for ns, neg_samp in enumerate(negative_prototypes):
-                        neg_aves[p] += (1./neg_k)*dtw.dtw(pos_prot, neg_samp, dtw.RETURN_VALUE, slope_constraint=slope_constraint, window=window)
+                # exact distances only for the prototypes that can be selected
+                pos_aves, neg_aves = index.discriminative_scores(positive_ids, negative_ids, slope_constraint, window)
                 selected_id = np.argmax(neg_aves - pos_aves)
                 path = dtw.dtw(positive_prototypes[selected_id], pat, dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)
                    
@@ -325,8 +335,8 @@ def discriminative_guided_warp(x, labels, batch_size=6, slope_constraint="symmet
                 ret[i] = window_slice(pat[np.newaxis,:,:], reduce_ratio=0.9+0.1*warp_amount[i]/max_warp)[0]
     return ret
 
-def discriminative_guided_warp_shape(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True):
-    return discriminative_guided_warp(x, labels, batch_size, slope_constraint, use_window, dtw_type="shape")
+def discriminative_guided_warp_shape(x, labels, batch_size=6, slope_constraint="symmetric", use_window=True, index=None):
+    return discriminative_guided_warp(x, labels, batch_size, slope_constraint, use_window, dtw_type="shape", index=index)
 
 
 def run_augmentation(x, y, args):
@@ -336,8 +346,10 @@ def run_augmentation(x, y, args):
     y_aug = y
     if args.augmentation_ratio > 0:
         augmentation_tags = "%d"%args.augmentation_ratio
+        # distances between the samples of x, shared by the DTW guided presets of all rounds
+        index = DTWIndex(x, y) if args.wdba or args.discdtw or args.discsdtw else None
         for n in range(args.augmentation_ratio):
-            x_temp, augmentation_tags = augment(x, y, args)
+            x_temp, augmentation_tags = augment(x, y, args, index=index)
             x_aug = np.append(x_aug, x_temp, axis=0)
             y_aug = np.append(y_aug, y, axis=0)
             print("Round %d: %s done"%(n, augmentation_tags))
@@ -349,14 +361,15 @@ def run_augmentation(x, y, args):
 
 def run_augmentation_single(x, y, args):
     # print("Augmenting %s"%args.data)
-    np.random.seed(args.seed)
+    # draws from the global numpy state: it is seeded once per run (and per loader worker by seed_worker),
+    # reseeding here would give every sample the same noise
     x_aug = x
     y_aug = y
     if args.augmentation_ratio > 0:
         augmentation_tags = "%d"%args.augmentation_ratio
         for n in range(args.augmentation_ratio):
             x_temp, augmentation_tags = augment(x, y, args)
-            x_aug =x_temp
+            x_aug = x_temp.astype(x.dtype, copy=False)
             # print("Round %d: %s done"%(n, augmentation_tags))
         if args.extra_tag:
             augmentation_tags += "_"+args.extra_tag
@@ -365,8 +378,15 @@ def run_augmentation_single(x, y, args):
     return x_aug, y_aug, augmentation_tags
 
 
-def augment(x, y, args):
+def seed_worker(worker_id):
+    # DataLoader workers are forked with a copy of the numpy state, give each one its own stream
+    import torch
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def augment(x, y, args, index=None):
     import utils.augmentation as aug
+    # the index only describes x as given, not the output of the presets applied before
     augmentation_tags = ""
     if args.jitter:
         x = aug.jitter(x)
@@ -405,12 +425,12 @@ def augment(x, y, args):
         x = aug.random_guided_warp_shape(x, y)
         augmentation_tags += "_rgws"
     if args.wdba:
-        x = aug.wdba(x, y)
+        x = aug.wdba(x, y, index=index if index is not None and index.x is x else None)
         augmentation_tags += "_wdba"
     if args.discdtw:
-        x = aug.discriminative_guided_warp(x, y)
+        x = aug.discriminative_guided_warp(x, y, index=index if index is not None and index.x is x else None)
         augmentation_tags += "_dgw"
     if args.discsdtw:
-        x = aug.discriminative_guided_warp_shape(x, y)
+        x = aug.discriminative_guided_warp_shape(x, y, index=index if index is not None and index.x is x else None)
         augmentation_tags += "_dgws"
     return x, augmentation_tags
@@ -0,0 +1,134 @@
+import argparse
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+_magic = b'BARLOG01'
+# magic, header size, record size, number of value columns
+_header = struct.Struct('<8sIII')
+
+
+class BarLog:
+    """
+    Append-only log of bars in fixed width binary records: the bar time (int64 milliseconds since the epoch)
+    followed by one float64 per value column. A small header stores the record layout and the column names.
+
+    The records are memory-mapped when the log is opened, so reopening does not parse anything. Appended bars
+    are written and fsynced right away, a crash loses at most the bars of the write in progress (a torn last
+    record is dropped when the log is opened again). Bar times are increasing, the time column is the index.
+
+    :param path: log file, created if it does not exist.
+    :param columns: value columns of a new log (the existing header is used otherwise).
+    :param writable: open for appending; a read-only log can be opened while another process appends to it.
+    """
+
+    def __init__(self, path, columns=None, writable=True):
+        self.path = path
+        if writable and (not os.path.exists(path) or os.path.getsize(path) == 0):
+            if columns is None:
+                raise ValueError('Columns are required to create the bar log {}'.format(path))
+            self._create(list(columns))
+        with open(path, 'rb') as f:
+            magic, self.header_size, record_size, n_columns = _header.unpack(f.read(_header.size))
+            if magic != _magic:
+                raise ValueError('{} is not a bar log'.format(path))
+            names = f.read(self.header_size - _header.size).rstrip(b'\0').decode('utf-8')
+        self.columns = names.split(',') if n_columns else []
+        self.dtype = np.dtype([('date', '<i8')] + [(c, '<f8') for c in self.columns])
+        assert self.dtype.itemsize == record_size, 'Corrupted bar log header'
+
+        self._file = open(path, 'r+b' if writable else 'rb')
+        records, torn = divmod(os.path.getsize(path) - self.header_size, self.dtype.itemsize)
+        if torn and writable:
+            self._file.truncate(self.header_size + records * self.dtype.itemsize)
+        self._map(records)
+
+    def _create(self, columns):
+        names = ','.join(columns).encode('utf-8')
+        # records start on a 64 byte boundary
+        header_size = -(-(_header.size + len(names)) // 64) * 64
+        header = _header.pack(_magic, header_size, 8 * (len(columns) + 1), len(columns)) + names
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header.ljust(header_size, b'\0'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _map(self, records):
+        if records > 0:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.header_size,
+                                     shape=(records,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def last_time(self):
+        return int(self.records['date'][-1]) if len(self.records) else None
+
+    def locate(self, time):
+        """
+        Position of the first bar at or after `time` (a timestamp or milliseconds since the epoch).
+        """
+        if not isinstance(time, (int, np.integer)):
+            time = pd.Timestamp(time).value // 10 ** 6
+        return int(np.searchsorted(self.records['date'], time))
+
+    def append(self, df):
+        """
+        Appends the rows of `df` (a 'date' column and the value columns) later than the last bar and fsyncs them.
+
+        :return: number of bars written.
+        """
+        dates = pd.to_datetime(df['date']).values.astype('datetime64[ms]').astype(np.int64)
+        new = dates > self.last_time if self.last_time is not None else np.ones(len(dates), dtype=bool)
+        if not new.any():
+            return 0
+        records = np.empty(int(new.sum()), dtype=self.dtype)
+        records['date'] = dates[new]
+        for c in self.columns:
+            records[c] = np.asarray(df[c], dtype=np.float64)[new]
+
+        self._file.seek(self.header_size + len(self.records) * self.dtype.itemsize)
+        self._file.write(records.tobytes())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._map(len(self.records) + len(records))
+        return len(records)
+
+    def frame(self, start=None, stop=None):
+        """
+        DataFrame of the bars [start, stop) with the 'date' column as datetimes.
+        """
+        records = self.records[start:stop]
+        df = pd.DataFrame({c: np.array(records[c]) for c in self.columns})
+        df.insert(0, 'date', records['date'].astype('datetime64[ms]').astype('datetime64[ns]'))
+        return df
+
+    def to_csv(self, path):
+        self.frame().to_csv(path, index=False)
+
+    def close(self):
+        self.records = np.zeros(0, dtype=self.dtype)
+        self._file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a bar log to csv')
+    parser.add_argument('log', type=str, help='bar log file')
+    parser.add_argument('csv', type=str, help='csv file to write')
+    parser.add_argument('--start', type=str, default=None, help='first bar time, e.g. 2024-06-20 00:00:00')
+    parser.add_argument('--end', type=str, default=None, help='bars before this time')
+    args = parser.parse_args()
+
+    log = BarLog(args.log, writable=False)
+    start = log.locate(args.start) if args.start else None
+    stop = log.locate(args.end) if args.end else None
+    log.frame(start, stop).to_csv(args.csv, index=False)
+    print('{} bars written to {}'.format(len(log.records[start:stop]), args.csv))
+    log.close()
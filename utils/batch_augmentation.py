@@ -0,0 +1,207 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+# presets of utils.augmentation with a batched torch implementation, in the order `augment` applies them
+batch_presets = ('jitter', 'scaling', 'rotation', 'permutation', 'randompermutation',
+                 'magwarp', 'timewarp', 'windowslice', 'windowwarp')
+# DTW based presets, only per sample; `augment` applies them after the batch presets
+sample_presets = ('spawner', 'dtwwarp', 'shapedtwwarp', 'wdba', 'discdtw', 'discsdtw')
+
+
+@lru_cache(maxsize=None)
+def spline_coefficients(knot):
+    """
+    Piecewise polynomial coefficients (4, knot+1, knot+2) of the cubic splines (scipy's default not-a-knot
+    boundary) through `knot`+2 equally spaced knots on [0, 1], one spline per unit vector of knot values.
+    A spline through any knot values is the matching linear combination of these basis splines.
+    """
+    from scipy.interpolate import CubicSpline
+    knots = np.linspace(0., 1., num=knot + 2)
+    return CubicSpline(knots, np.eye(knot + 2)).c
+
+
+def spline_basis(u, knot, dtype):
+    """
+    Values (..., knot+2) of the basis splines at the positions `u` in [0, 1].
+    """
+    coef = torch.as_tensor(spline_coefficients(knot), dtype=dtype, device=u.device)
+    piece = (u * (knot + 1)).floor().long().clamp(0, knot)
+    dx = u - piece.to(dtype) / (knot + 1)
+    c = coef[:, piece]  # (4, ..., knot+2)
+    return ((c[0] * dx.unsqueeze(-1) + c[1]) * dx.unsqueeze(-1) + c[2]) * dx.unsqueeze(-1) + c[3]
+
+
+def resample(x, pos):
+    """
+    Linear interpolation of every series of `x` (B, L, C) at the fractional time positions `pos` (B, M).
+    """
+    lo = pos.floor().clamp(0, x.shape[1] - 1)
+    w = (pos - lo).unsqueeze(-1).to(x.dtype)
+    lo = lo.long()
+    hi = (lo + 1).clamp(max=x.shape[1] - 1)
+    index = lambda i: i.unsqueeze(-1).expand(-1, -1, x.shape[2])
+    return torch.gather(x, 1, index(lo)) * (1 - w) + torch.gather(x, 1, index(hi)) * w
+
+
+def interp(x, xp, fp, n):
+    """
+    Row-wise `np.interp(x, xp[:n], fp[:n])` for 2d tensors, with `n` (R,) the valid length of every row.
+    """
+    xp = xp.masked_fill(torch.arange(xp.shape[1], device=xp.device) >= n.unsqueeze(1), float('inf'))
+    last = (n - 1).clamp(min=1).unsqueeze(1)
+    hi = torch.minimum(torch.searchsorted(xp.contiguous(), x.contiguous(), right=True).clamp(min=1), last)
+    lo = hi - 1
+    x0, x1 = torch.gather(xp, 1, lo), torch.gather(xp, 1, hi)
+    w = torch.where(x1 > x0, (x - x0) / (x1 - x0), torch.ones_like(x)).clamp(0, 1)
+    return torch.gather(fp, 1, lo) * (1 - w) + torch.gather(fp, 1, hi) * w
+
+
+def jitter(x, lengths, generator, sigma=0.03):
+    return x + sigma * torch.randn(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+
+
+def scaling(x, lengths, generator, sigma=0.1):
+    factor = 1. + sigma * torch.randn((x.shape[0], 1, x.shape[2]), generator=generator, device=x.device,
+                                      dtype=x.dtype)
+    return x * factor
+
+
+def rotation(x, lengths, generator):
+    flip = torch.randint(0, 2, (x.shape[0], 1, x.shape[2]), generator=generator, device=x.device) * 2 - 1
+    rotate_axis = torch.rand((x.shape[0], x.shape[2]), generator=generator, device=x.device).argsort(dim=1)
+    return flip.to(x.dtype) * torch.gather(x, 2, rotate_axis.unsqueeze(1).expand_as(x))
+
+
+def permutation(x, lengths, generator, max_segments=5, seg_mode="equal"):
+    batch, steps = x.shape[0], x.shape[1]
+    t = torch.arange(steps, device=x.device)
+    j = torch.arange(1, max_segments - 1, device=x.device)
+    num_segs = torch.randint(1, max_segments, (batch, 1), generator=generator, device=x.device)
+
+    if seg_mode == "random":
+        # num_segs-1 distinct sorted split points in [0, length-2)
+        keys = torch.rand((batch, steps), generator=generator, device=x.device)
+        keys = keys.masked_fill(t >= (lengths - 2).unsqueeze(1), float('inf'))
+        points = keys.argsort(dim=1)[:, :max_segments - 2]
+        bounds = points.masked_fill(j >= num_segs, steps).sort(dim=1).values
+    else:
+        # boundaries of np.array_split(range(length), num_segs)
+        size, extra = lengths.unsqueeze(1) // num_segs, lengths.unsqueeze(1) % num_segs
+        bounds = (j * size + torch.minimum(j, extra)).masked_fill(j >= num_segs, steps)
+    segment = (t.unsqueeze(0).unsqueeze(-1) >= bounds.unsqueeze(1)).sum(-1)
+
+    # a random order of the segments, the padding stays at the end
+    rank = torch.rand((batch, max_segments - 1), generator=generator, device=x.device).argsort(dim=1).argsort(dim=1)
+    key = torch.where(t >= lengths.unsqueeze(1), max_segments - 1, torch.gather(rank, 1, segment)) * steps + t
+    order = key.argsort(dim=1)
+    return torch.gather(x, 1, order.unsqueeze(-1).expand_as(x))
+
+
+def magnitude_warp(x, lengths, generator, sigma=0.2, knot=4):
+    random_warps = 1. + sigma * torch.randn((x.shape[0], knot + 2, x.shape[2]), generator=generator,
+                                            device=x.device, dtype=x.dtype)
+    u = torch.arange(x.shape[1], device=x.device, dtype=x.dtype) / (lengths - 1).clamp(min=1).unsqueeze(1).to(x.dtype)
+    warper = torch.bmm(spline_basis(u.clamp(max=1), knot, x.dtype), random_warps)
+    return x * warper
+
+
+def time_warp(x, lengths, generator, sigma=0.2, knot=4):
+    batch, steps, dims = x.shape
+    random_warps = 1. + sigma * torch.randn((batch, knot + 2, dims), generator=generator, device=x.device,
+                                            dtype=x.dtype)
+    last = (lengths - 1).clamp(min=1).unsqueeze(1).to(x.dtype)
+    t = torch.arange(steps, device=x.device, dtype=x.dtype).expand(batch, -1)
+    warp_steps = torch.linspace(0., 1., knot + 2, device=x.device, dtype=x.dtype) * last
+    warp = torch.bmm(spline_basis((t / last).clamp(max=1), knot, x.dtype), warp_steps.unsqueeze(-1) * random_warps)
+    end = torch.gather(warp, 1, (lengths - 1).clamp(min=0).view(-1, 1, 1).expand(-1, 1, dims))
+    xp = torch.minimum((last.unsqueeze(-1) / end * warp).clamp(min=0), last.unsqueeze(-1))
+
+    rows = lambda a: a.transpose(1, 2).reshape(batch * dims, steps)
+    ret = interp(t.repeat_interleave(dims, dim=0), rows(xp), rows(x), lengths.repeat_interleave(dims))
+    return ret.view(batch, dims, steps).transpose(1, 2)
+
+
+def window_slice(x, lengths, generator, reduce_ratio=0.9):
+    n = lengths.to(torch.float64)
+    target_len = torch.ceil(reduce_ratio * n)
+    high = (n - target_len).clamp(min=1)
+    starts = (torch.rand(lengths.shape, generator=generator, device=x.device, dtype=torch.float64) * high).floor()
+    t = torch.arange(x.shape[1], device=x.device, dtype=torch.float64)
+    # np.interp(np.linspace(0, target_len, num=length), np.arange(target_len), pat[start:start+target_len])
+    pos = torch.minimum(t * (target_len / (n - 1).clamp(min=1)).unsqueeze(1), (target_len - 1).unsqueeze(1))
+    ret = resample(x, starts.unsqueeze(1) + pos)
+    return torch.where((target_len < n).view(-1, 1, 1), ret, x)
+
+
+def window_warp(x, lengths, generator, window_ratio=0.1, scales=[0.5, 2.]):
+    n = lengths.to(torch.float64).unsqueeze(1)
+    scales = torch.as_tensor(scales, dtype=torch.float64, device=x.device)
+    warp_scales = scales[torch.randint(0, len(scales), lengths.shape, generator=generator, device=x.device)]
+    warp_size = torch.ceil(window_ratio * n)
+    high = (n - warp_size - 2).clamp(min=1)
+    window_starts = 1 + (torch.rand(n.shape, generator=generator, device=x.device, dtype=torch.float64)
+                         * high).floor()
+    window_len = torch.floor(warp_size * warp_scales.unsqueeze(1))
+    warped_len = n - warp_size + window_len
+
+    def source(j):
+        # position in the original series of step j of the warped series
+        inside = window_starts + (j - window_starts) * (warp_size - 1) / (window_len - 1).clamp(min=1)
+        after = j - window_len + warp_size
+        return torch.where(j < window_starts, j, torch.where(j < window_starts + window_len, inside, after))
+
+    # np.interp(np.arange(length), np.linspace(0, length-1, num=warped.size), warped)
+    t = torch.arange(x.shape[1], device=x.device, dtype=torch.float64)
+    pos = t * (warped_len - 1) / (n - 1).clamp(min=1)
+    j0 = torch.minimum(pos.floor(), warped_len - 1)
+    j1 = torch.minimum(j0 + 1, warped_len - 1)
+    w = (pos - j0).clamp(0, 1).unsqueeze(-1).to(x.dtype)
+    return resample(x, source(j0)) * (1 - w) + resample(x, source(j1)) * w
+
+
+class BatchAugmentation:
+    """
+    The preset augmentations of `utils.augmentation.augment` selected by args (see `batch_presets`) as batched
+    torch transforms, applied to a whole padded batch (B, L, C) at once, e.g. in the collate function.
+    Every sample is augmented over its own length only and the padding stays zero.
+
+    Each process draws from its own torch.Generator seeded from torch.initial_seed(), which the DataLoader sets
+    to a different value in every worker and every epoch.
+    """
+
+    def __init__(self, args):
+        self.transforms = []
+        for preset, transform in zip(batch_presets, [jitter, scaling, rotation, permutation, permutation,
+                                                     magnitude_warp, time_warp, window_slice, window_warp]):
+            if getattr(args, preset, False):
+                if preset == 'randompermutation':
+                    self.transforms.append(lambda x, lengths, g: permutation(x, lengths, g, seg_mode="random"))
+                else:
+                    self.transforms.append(transform)
+        self._generator = None
+        self._seed = None
+
+    def __bool__(self):
+        return len(self.transforms) > 0
+
+    def generator(self, device):
+        seed = (os.getpid(), torch.initial_seed(), str(device))
+        if self._seed != seed:
+            self._generator = torch.Generator(device=device)
+            self._generator.manual_seed(torch.initial_seed())
+            self._seed = seed
+        return self._generator
+
+    def __call__(self, x, lengths):
+        """
+        :param x: padded batch (B, L, C).
+        :param lengths: valid length of every sample (B,).
+        """
+        generator = self.generator(x.device)
+        mask = (torch.arange(x.shape[1], device=x.device) < lengths.unsqueeze(1)).unsqueeze(-1)
+        for transform in self.transforms:
+            x = transform(x, lengths, generator)
+        return x * mask
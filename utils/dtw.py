@@ -10,12 +10,18 @@ RETURN_ALL = -1
 
 # Core DTW
 def _traceback(DTW, slope_constraint):
+    """ Warping path of a cumulative matrix, or the list of the paths of a batch of them (B, p+1, s+1).
+    All the pairs of a batch are traced back together, one vectorized step per move.
+    """
+    if DTW.ndim == 3:
+        return _traceback_batch(DTW, slope_constraint)
+
     i, j = np.array(DTW.shape) - 1
     p, q = [i-1], [j-1]
-    
+
     if slope_constraint == "asymmetric":
         while (i > 1):
-            tb = np.argmin((DTW[i-1, j], DTW[i-1, j-1], DTW[i-1, j-2]))
+            tb = _argmin3(DTW[i-1, j], DTW[i-1, j-1], DTW[i-1, j-2])
 
             if (tb == 0):
                 i = i - 1
@@ -26,11 +32,11 @@ def _traceback(DTW, slope_constraint):
                 i = i - 1
                 j = j - 2
 
-            p.insert(0, i-1)
-            q.insert(0, j-1)
+            p.append(i-1)
+            q.append(j-1)
     elif slope_constraint == "symmetric":
         while (i > 1 or j > 1):
-            tb = np.argmin((DTW[i-1, j-1], DTW[i-1, j], DTW[i, j-1]))
+            tb = _argmin3(DTW[i-1, j-1], DTW[i-1, j], DTW[i, j-1])
 
             if (tb == 0):
                 i = i - 1
@@ -40,12 +46,73 @@ def _traceback(DTW, slope_constraint):
             elif (tb == 2):
                 j = j - 1
 
-            p.insert(0, i-1)
-            q.insert(0, j-1)
+            p.append(i-1)
+            q.append(j-1)
     else:
         sys.exit("Unknown slope constraint %s"%slope_constraint)
-        
-    return (np.array(p), np.array(q))
+
+    # built from the end, reversed once instead of inserting at the front
+    return (np.array(p[::-1]), np.array(q[::-1]))
+
+def _argmin3(a, b, c):
+    # np.argmin of three values (the first of equal minima, nan counts as the minimum) without building an array
+    if a != a:
+        return 0
+    if b != b:
+        return 1
+    if c != c:
+        return 2
+    if a <= b:
+        return 0 if a <= c else 2
+    return 1 if b <= c else 2
+
+def _traceback_batch(DTW, slope_constraint):
+    batch = np.arange(DTW.shape[0])
+    i = np.full(DTW.shape[0], DTW.shape[1] - 1)
+    j = np.full(DTW.shape[0], DTW.shape[2] - 1)
+    ps, qs, actives = [i - 1], [j - 1], [np.ones(DTW.shape[0], dtype=bool)]
+
+    if slope_constraint == "asymmetric":
+        moves_i, moves_j = np.array([1, 1, 1]), np.array([0, 1, 2])
+        active = i > 1
+    elif slope_constraint == "symmetric":
+        moves_i, moves_j = np.array([1, 1, 0]), np.array([1, 0, 1])
+        active = (i > 1) | (j > 1)
+    else:
+        sys.exit("Unknown slope constraint %s"%slope_constraint)
+
+    while active.any():
+        # np.argmin picks the first of equal candidates, in the order of the moves
+        candidates = np.stack([DTW[batch, i - di, j - dj] for di, dj in zip(moves_i, moves_j)])
+        tb = np.argmin(candidates, axis=0)
+        i = np.where(active, i - moves_i[tb], i)
+        j = np.where(active, j - moves_j[tb], j)
+        ps.append(i - 1)
+        qs.append(j - 1)
+        actives.append(active)
+        if slope_constraint == "asymmetric":
+            active = i > 1
+        else:
+            active = (i > 1) | (j > 1)
+
+    ps, qs, actives = np.stack(ps), np.stack(qs), np.stack(actives)
+    return [(ps[actives[:, b], b][::-1].astype(np.int64), qs[actives[:, b], b][::-1].astype(np.int64))
+            for b in batch]
+
+def _cost_matrix(prototypes, samples, window, block=1 << 22):
+    """ Euclidean distances (B, p, s) between the steps of the prototypes (B, p, d) and of the samples (B, s, d)
+    within the window, inf outside. Computed in blocks of rows to bound the memory of the broadcast.
+    """
+    b, p, s = prototypes.shape[0], prototypes.shape[1], samples.shape[1]
+    cost = np.full((b, p, s), np.inf)
+    steps = np.arange(s)
+    rows = max(1, block // max(1, b * s * samples.shape[2]))
+    for r in range(0, p, rows):
+        i = np.arange(r, min(p, r + rows))
+        dist = np.linalg.norm(samples[:, np.newaxis, :, :] - prototypes[:, i, np.newaxis, :], axis=-1)
+        band = np.abs(steps[np.newaxis, :] - i[:, np.newaxis]) <= window
+        cost[:, i] = np.where(band, dist, np.inf)
+    return cost
 
 def dtw(prototype, sample, return_flag = RETURN_VALUE, slope_constraint="asymmetric", window=None):
     """ Computes the DTW of two sequences.
@@ -61,11 +128,7 @@ def dtw(prototype, sample, return_flag = RETURN_VALUE, slope_constraint="asymmet
     if window is None:
         window = s
     
-    cost = np.full((p, s), np.inf)
-    for i in range(p):
-        start = max(0, i-window)
-        end = min(s, i+window)+1
-        cost[i,start:end]=np.linalg.norm(sample[start:end] - prototype[i], axis=1)
+    cost = _cost_matrix(prototype.reshape(1, p, -1), sample.reshape(1, s, -1), window)[0]
 
     DTW = _cummulative_matrix(cost, slope_constraint, window)
         
@@ -76,35 +139,181 @@ def dtw(prototype, sample, return_flag = RETURN_VALUE, slope_constraint="asymmet
     else:
         return DTW[-1,-1]
 
+def dtw_batch(prototypes, samples, return_flag = RETURN_VALUE, slope_constraint="asymmetric", window=None, threshold=None):
+    """ Computes the DTW of many pairs of sequences at once, pair k being (prototypes[k], samples[k]).
+    Gives the same values and paths as calling dtw on every pair.
+    :param prototypes: np array [B, 0..b, dims] (or [0..b, dims] to compare one prototype with every sample)
+    :param samples: np array [B, 0..t, dims] (or [0..t, dims])
+    :param threshold: early abandoning (RETURN_VALUE only), scalar or [B]: the pairs whose DTW is proven to be
+        larger are returned as inf, the computation stops once every pair is abandoned
+    :return: array of B values for RETURN_VALUE, list of B paths for RETURN_PATH
+    """
+    prototypes, samples = np.asarray(prototypes), np.asarray(samples)
+    if prototypes.ndim == 2:
+        prototypes = np.broadcast_to(prototypes, (samples.shape[0],) + prototypes.shape)
+    if samples.ndim == 2:
+        samples = np.broadcast_to(samples, (prototypes.shape[0],) + samples.shape)
+    assert prototypes.shape[1] != 0, "Prototype empty!"
+    assert samples.shape[1] != 0, "Sample empty!"
+
+    if window is None:
+        window = samples.shape[1]
+
+    cost = _cost_matrix(prototypes, samples, window)
+    if threshold is not None and return_flag != RETURN_PATH:
+        return _abandoning_values(cost, slope_constraint, window, threshold)
+    DTW = _cummulative_matrix(cost, slope_constraint, window)
+
+    if return_flag == RETURN_PATH:
+        return _traceback(DTW, slope_constraint)
+    return DTW[:, -1, -1]
+
 def _cummulative_matrix(cost, slope_constraint, window):
-    p = cost.shape[0]
-    s = cost.shape[1]
+    """ Cumulative matrix (p+1, s+1) of a cost matrix (p, s), or (B, p+1, s+1) of a batch of them.
+    The asymmetric recursion only looks at the previous row and is filled row by row, the symmetric one
+    also at the previous column and is filled by anti-diagonals. Every cell is computed by the same
+    expression as the cell by cell recursion, so the values are identical.
+    """
+    if cost.ndim == 2:
+        return _cummulative_matrix(cost[np.newaxis], slope_constraint, window)[0]
+
+    b = cost.shape[0]
+    p = cost.shape[1]
+    s = cost.shape[2]
     
     # Note: DTW is one larger than cost and the original patterns
-    DTW = np.full((p+1, s+1), np.inf)
+    DTW = np.full((b, p+1, s+1), np.inf)
 
-    DTW[0, 0] = 0.0
+    DTW[:, 0, 0] = 0.0
 
     if slope_constraint == "asymmetric":
         for i in range(1, p+1):
             if i <= window+1:
-                DTW[i,1] = cost[i-1,0] + min(DTW[i-1,0], DTW[i-1,1])
-            for j in range(max(2, i-window), min(s, i+window)+1):
-                DTW[i,j] = cost[i-1,j-1] + min(DTW[i-1,j-2], DTW[i-1,j-1], DTW[i-1,j])
+                DTW[:, i, 1] = cost[:, i-1, 0] + np.minimum(DTW[:, i-1, 0], DTW[:, i-1, 1])
+            start, end = max(2, i-window), min(s, i+window)+1
+            if start < end:
+                DTW[:, i, start:end] = cost[:, i-1, start-1:end-1] + np.minimum(np.minimum(
+                    DTW[:, i-1, start-2:end-2], DTW[:, i-1, start-1:end-1]), DTW[:, i-1, start:end])
     elif slope_constraint == "symmetric":
-        for i in range(1, p+1):
-            for j in range(max(1, i-window), min(s, i+window)+1):
-                DTW[i,j] = cost[i-1,j-1] + min(DTW[i-1,j-1], DTW[i,j-1], DTW[i-1,j])
+        # cell (i, j) only depends on cells of the anti-diagonals i+j-1 and i+j-2. The matrices are skewed
+        # to G[d, i] = DTW[i, d-i] so that every anti-diagonal and its dependencies are contiguous slices
+        i, j = np.arange(p+1)[:, np.newaxis], np.arange(s+1)[np.newaxis, :]
+        G = np.full((b, p+s+1, p+1), np.inf)
+        G[:, 0, 0] = 0.0
+        skewed_cost = np.full((b, p+s+1, p+1), np.inf)
+        skewed_cost[:, (i+j)[1:, 1:], np.broadcast_to(i, (p+1, s+1))[1:, 1:]] = cost
+        for d in range(2, p+s+1):
+            lo = max(1, d-s, -((window-d) // 2))
+            hi = min(p, d-1, (d+window) // 2) + 1
+            if lo < hi:
+                G[:, d, lo:hi] = skewed_cost[:, d, lo:hi] + np.minimum(np.minimum(
+                    G[:, d-2, lo-1:hi-1], G[:, d-1, lo:hi]), G[:, d-1, lo-1:hi-1])
+        DTW = G[:, i+j, i]
     else:
         sys.exit("Unknown slope constraint %s"%slope_constraint)
         
     return DTW
 
-def shape_dtw(prototype, sample, return_flag = RETURN_VALUE, slope_constraint="asymmetric", window=None, descr_ratio=0.05):
+def _abandoning_values(cost, slope_constraint, window, threshold, every=4):
+    """ Final DTW values of a batch of cost matrices (B, p, s) with early abandoning: same recursion as
+    _cummulative_matrix, but a pair is dropped from the batch as soon as every path has to cross cells above
+    its threshold (a row for the asymmetric recursion, two consecutive anti-diagonals for the symmetric one,
+    the costs are not negative) and its value is inf. Checked every `every` rows or anti-diagonals.
+    """
+    b, p, s = cost.shape
+    values = np.full(b, np.inf)
+    alive = np.arange(b)
+    threshold = np.broadcast_to(threshold, (b,))
+
+    if slope_constraint == "asymmetric":
+        DTW = np.full((b, p+1, s+1), np.inf)
+        DTW[:, 0, 0] = 0.0
+        for i in range(1, p+1):
+            if i <= window+1:
+                DTW[:, i, 1] = cost[:, i-1, 0] + np.minimum(DTW[:, i-1, 0], DTW[:, i-1, 1])
+            start, end = max(2, i-window), min(s, i+window)+1
+            if start < end:
+                DTW[:, i, start:end] = cost[:, i-1, start-1:end-1] + np.minimum(np.minimum(
+                    DTW[:, i-1, start-2:end-2], DTW[:, i-1, start-1:end-1]), DTW[:, i-1, start:end])
+            if i % every == 0:
+                keep = DTW[:, i].min(axis=1) <= threshold[alive]
+                if not keep.all():
+                    alive, DTW, cost = alive[keep], DTW[keep], cost[keep]
+                    if alive.size == 0:
+                        return values
+        values[alive] = DTW[:, -1, -1]
+    elif slope_constraint == "symmetric":
+        i, j = np.arange(p+1)[:, np.newaxis], np.arange(s+1)[np.newaxis, :]
+        G = np.full((b, p+s+1, p+1), np.inf)
+        G[:, 0, 0] = 0.0
+        skewed_cost = np.full((b, p+s+1, p+1), np.inf)
+        skewed_cost[:, (i+j)[1:, 1:], np.broadcast_to(i, (p+1, s+1))[1:, 1:]] = cost
+        for d in range(2, p+s+1):
+            lo = max(1, d-s, -((window-d) // 2))
+            hi = min(p, d-1, (d+window) // 2) + 1
+            if lo < hi:
+                G[:, d, lo:hi] = skewed_cost[:, d, lo:hi] + np.minimum(np.minimum(
+                    G[:, d-2, lo-1:hi-1], G[:, d-1, lo:hi]), G[:, d-1, lo-1:hi-1])
+            if d % every == 0:
+                keep = G[:, d-1:d+1].min(axis=(1, 2)) <= threshold[alive]
+                if not keep.all():
+                    alive, G, skewed_cost = alive[keep], G[keep], skewed_cost[keep]
+                    if alive.size == 0:
+                        return values
+        values[alive] = G[:, p+s, p]
+    else:
+        sys.exit("Unknown slope constraint %s"%slope_constraint)
+    return values
+
+def shape_descriptors(sequence, descr_ratio=0.05):
+    """ Raw subsequence descriptors of shapeDTW: for every step the window of `feature_len` steps of the
+    edge padded sequence starting there, flattened. Extracted once per sequence with a strided view.
+    :param sequence: np array [0..t, dims]
+    :return: np array [0..t, feature_len*dims]
+    """
+    length = sequence.shape[0]
+    feature_len = np.clip(np.round(length * descr_ratio), 5, 100).astype(int)
+    pad_front = (np.ceil(feature_len / 2.)).astype(int)
+    pad_back = (np.floor(feature_len / 2.)).astype(int)
+    padded = np.pad(sequence, ((pad_front, pad_back), (0, 0)), mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, feature_len, axis=0)[:length]
+    return np.ascontiguousarray(windows.transpose(0, 2, 1)).reshape(length, -1)
+
+def _shape_cost_matrix(prototype_descriptors, sample_descriptors, window, block=1 << 22):
+    """ shapeDTW cost matrix: Euclidean distances between the descriptors of the steps i and j for
+    max(0, i-window) <= j < min(s, i+window), inf elsewhere. The differences are computed band by band in
+    blocks of rows and each cell is sqrt(d.dot(d)) like np.linalg.norm, so the costs are bitwise identical to
+    the norm of every pair of windows.
+    """
+    p, s = prototype_descriptors.shape[0], sample_descriptors.shape[0]
+    cost = np.full((p, s), np.inf)
+    if 2 * window >= s:
+        offsets = None
+        width = s
+    else:
+        offsets = np.arange(-window, window)
+        width = offsets.size
+    rows = max(1, block // max(1, width * sample_descriptors.shape[1]))
+    for r in range(0, p, rows):
+        i = np.arange(r, min(p, r + rows))[:, np.newaxis]
+        j = np.broadcast_to(np.arange(s), (i.size, s)) if offsets is None else i + offsets
+        band = (j >= np.maximum(0, i - window)) & (j < np.minimum(s, i + window))
+        i, j = np.broadcast_to(i, j.shape)[band], j[band]
+        # np.linalg.norm takes the BLAS dot of a fresh array, whose data starts on 16 bytes, and the dot rounds
+        # differently for other alignments: every difference row starts on 16 bytes as well
+        features = sample_descriptors.shape[1]
+        diff = np.empty((i.size, features + features % 2))[:, :features]
+        np.subtract(sample_descriptors[j], prototype_descriptors[i], out=diff)
+        cost[i, j] = np.sqrt([row.dot(row) for row in diff])
+    return cost
+
+def shape_dtw(prototype, sample, return_flag = RETURN_VALUE, slope_constraint="asymmetric", window=None, descr_ratio=0.05,
+              prototype_descriptors=None, sample_descriptors=None):
     """ Computes the shapeDTW of two sequences.
     :param prototype: np array [0..b]
     :param sample: np array [0..t]
-    :param extended: bool
+    :param prototype_descriptors: shape_descriptors(prototype, descr_ratio) if already extracted
+    :param sample_descriptors: shape_descriptors(sample, descr_ratio) if already extracted
     """
     # shapeDTW
     # https://www.sciencedirect.com/science/article/pii/S0031320317303710
@@ -117,24 +326,12 @@ def shape_dtw(prototype, sample, return_flag = RETURN_VALUE, slope_constraint="a
     if window is None:
         window = s
         
-    p_feature_len = np.clip(np.round(p * descr_ratio), 5, 100).astype(int)
-    s_feature_len = np.clip(np.round(s * descr_ratio), 5, 100).astype(int)
-    
-    # padding
-    p_pad_front = (np.ceil(p_feature_len / 2.)).astype(int)
-    p_pad_back = (np.floor(p_feature_len / 2.)).astype(int)
-    s_pad_front = (np.ceil(s_feature_len / 2.)).astype(int)
-    s_pad_back = (np.floor(s_feature_len / 2.)).astype(int)
-    
-    prototype_pad = np.pad(prototype, ((p_pad_front, p_pad_back), (0, 0)), mode="edge") 
-    sample_pad = np.pad(sample, ((s_pad_front, s_pad_back), (0, 0)), mode="edge") 
-    p_p = prototype_pad.shape[0]
-    s_p = sample_pad.shape[0]
+    if prototype_descriptors is None:
+        prototype_descriptors = shape_descriptors(prototype, descr_ratio)
+    if sample_descriptors is None:
+        sample_descriptors = shape_descriptors(sample, descr_ratio)
         
-    cost = np.full((p, s), np.inf)
-    for i in range(p):
-        for j in range(max(0, i-window), min(s, i+window)):
-            cost[i, j] = np.linalg.norm(sample_pad[j:j+s_feature_len] - prototype_pad[i:i+p_feature_len])
+    cost = _shape_cost_matrix(prototype_descriptors, sample_descriptors, window)
             
     DTW = _cummulative_matrix(cost, slope_constraint=slope_constraint, window=window)
     
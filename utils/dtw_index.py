@@ -0,0 +1,206 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import utils.dtw as dtw
+
+# relative slack of the bounds, covers the rounding of sums taken in a different order than the DTW recursion
+_slack = 1e-9
+
+
+class DTWIndex:
+    """
+    Prototype search over the samples of one augmentation input, shared by the guided warps for the lifetime
+    of a `run_augmentation` call.
+
+    Pairs of samples are addressed by their indices in `x`. Exact distances (and paths) are memoized, cheap
+    lower bounds (LB_Kim and LB_Keogh on per-class cached envelopes) and upper bounds (the diagonal path) let
+    the searches skip the candidates that cannot win and abandon the DTW of the others early.
+    """
+
+    def __init__(self, x, labels):
+        self.x = x
+        self.labels = np.argmax(labels, axis=1) if labels.ndim > 1 else labels
+        self._distances = {}
+        self._paths = {}
+        self._envelopes = {}
+        self._descriptors = {}
+
+    def _window(self, window):
+        return self.x.shape[1] if window is None else int(window)
+
+    def envelope(self, label, window):
+        """
+        Upper and lower LB_Keogh envelopes (n, length, dims) of the samples of class `label`, with their indices.
+        """
+        window = min(self._window(window), self.x.shape[1])
+        key = (label, window)
+        if key not in self._envelopes:
+            members = np.where(self.labels == label)[0]
+            padded = np.pad(self.x[members], ((0, 0), (window, window), (0, 0)), mode="edge")
+            windows = sliding_window_view(padded, 2 * window + 1, axis=1)
+            position = np.full(len(self.x), -1)
+            position[members] = np.arange(len(members))
+            self._envelopes[key] = (position, windows.max(axis=-1), windows.min(axis=-1))
+        return self._envelopes[key]
+
+    def lower_bounds(self, a, b, slope_constraint, window):
+        """
+        Lower bounds of the DTW of the pairs (x[a[k]], x[b[k]]): the largest of LB_Kim (first and last cells)
+        and LB_Keogh (every prototype step is matched within the envelope of the sample), or the exact
+        distance when it is memoized.
+        """
+        a, b = np.asarray(a), np.asarray(b)
+        prototypes, samples = self.x[a], self.x[b]
+        keogh = np.zeros(len(a))
+        for label in np.unique(self.labels[b]):
+            k = self.labels[b] == label
+            position, upper, lower = self.envelope(label, window)
+            gap = np.maximum(prototypes[k] - upper[position[b[k]]], 0) + np.maximum(lower[position[b[k]]] - prototypes[k], 0)
+            keogh[k] = np.linalg.norm(gap, axis=-1).sum(axis=1)
+
+        last = np.linalg.norm(prototypes[:, -1] - samples[:, -1], axis=-1)
+        first = np.linalg.norm(prototypes[:, 0] - samples[:, 0], axis=-1)
+        if slope_constraint == "asymmetric" and samples.shape[1] > 1 and self._window(window) >= 1:
+            # the asymmetric recursion may also start on the second step of the sample
+            first = np.minimum(first, np.linalg.norm(prototypes[:, 0] - samples[:, 1], axis=-1))
+        kim = first + last if prototypes.shape[1] > 1 or samples.shape[1] > 1 else first
+
+        bounds = np.maximum(kim, keogh) * (1 - _slack)
+        return np.array([self._distances.get((ai, bi, slope_constraint, window), lb)
+                         for ai, bi, lb in zip(a.tolist(), b.tolist(), bounds)])
+
+    def upper_bounds(self, a, b, slope_constraint, window):
+        """
+        Upper bounds of the DTW of the pairs (x[a[k]], x[b[k]]): the cost of the diagonal path, or the exact
+        distance when it is memoized.
+        """
+        a, b = np.asarray(a), np.asarray(b)
+        bounds = np.linalg.norm(self.x[a] - self.x[b], axis=-1).sum(axis=1) * (1 + _slack)
+        return np.array([self._distances.get((ai, bi, slope_constraint, window), ub)
+                         for ai, bi, ub in zip(a.tolist(), b.tolist(), bounds)])
+
+    def distances(self, a, b, slope_constraint, window, threshold=None):
+        """
+        Exact DTW of the pairs (x[a[k]], x[b[k]]), the missing ones computed in one batch. With a threshold the
+        pairs proven to be larger are abandoned and returned as inf.
+        """
+        a, b = np.asarray(a).tolist(), np.asarray(b).tolist()
+        threshold = np.broadcast_to(np.inf if threshold is None else threshold, (len(a),))
+        values = np.array([self._distances.get((ai, bi, slope_constraint, window), np.nan) for ai, bi in zip(a, b)])
+        missing = np.where(np.isnan(values))[0]
+        if missing.size > 0:
+            computed = dtw.dtw_batch(self.x[[a[k] for k in missing]], self.x[[b[k] for k in missing]],
+                                     dtw.RETURN_VALUE, slope_constraint=slope_constraint, window=window,
+                                     threshold=None if np.isinf(threshold[missing]).all() else threshold[missing])
+            for k, value in zip(missing, computed):
+                values[k] = value
+                if np.isfinite(value):
+                    self._distances[a[k], b[k], slope_constraint, window] = value
+        return values
+
+    def paths(self, a, b, slope_constraint, window):
+        """
+        DTW paths of the pairs (x[a[k]], x[b[k]]), the missing ones computed in one batch.
+        """
+        a, b = np.asarray(a).tolist(), np.asarray(b).tolist()
+        missing = [k for k in range(len(a)) if (a[k], b[k], slope_constraint, window) not in self._paths]
+        if missing:
+            computed = dtw.dtw_batch(self.x[[a[k] for k in missing]], self.x[[b[k] for k in missing]],
+                                     dtw.RETURN_PATH, slope_constraint=slope_constraint, window=window)
+            for k, path in zip(missing, computed):
+                self._paths[a[k], b[k], slope_constraint, window] = path
+        return [self._paths[ai, bi, slope_constraint, window] for ai, bi in zip(a, b)]
+
+    def descriptors(self, i):
+        """
+        shapeDTW descriptors of x[i], extracted once.
+        """
+        if i not in self._descriptors:
+            self._descriptors[i] = dtw.shape_descriptors(self.x[i])
+        return self._descriptors[i]
+
+    def shape_distance(self, a, b, slope_constraint, window):
+        key = (a, b, slope_constraint, window, "shape")
+        if key not in self._distances:
+            self._distances[key] = dtw.shape_dtw(self.x[a], self.x[b], dtw.RETURN_VALUE,
+                                                 slope_constraint=slope_constraint, window=window,
+                                                 prototype_descriptors=self.descriptors(a),
+                                                 sample_descriptors=self.descriptors(b))
+        return self._distances[key]
+
+    def medoid_distances(self, ids, slope_constraint, window):
+        """
+        Distance matrix (k, k) of the samples `ids` with exact rows only for the rows that could have the
+        smallest sum (the medoid); the other rows are inf. np.argsort(matrix.sum(axis=1))[0] is the same as
+        on the full matrix.
+
+        A row whose lower bound exceeds the smallest upper bound of a row sum is skipped, the others are
+        computed in one batch, abandoning the distances that would make their row exceed that upper bound.
+        """
+        k = len(ids)
+        matrix = np.zeros((k, k))
+        if k < 2:
+            return matrix
+        p, s = np.nonzero(~np.eye(k, dtype=bool))
+        lower, upper = np.zeros((k, k)), np.zeros((k, k))
+        lower[p, s] = self.lower_bounds(ids[p], ids[s], slope_constraint, window)
+        upper[p, s] = self.upper_bounds(ids[p], ids[s], slope_constraint, window)
+        lower_sums = lower.sum(axis=1)
+        best = upper.sum(axis=1).min()
+
+        rows = lower_sums <= best
+        matrix[~rows] = np.inf
+        pairs = rows[p]
+        # a distance larger than this makes the row sum exceed the best upper bound whatever the others are
+        threshold = best - (lower_sums[p[pairs]] - lower[p[pairs], s[pairs]]) + _slack * best
+        matrix[p[pairs], s[pairs]] = self.distances(ids[p[pairs]], ids[s[pairs]], slope_constraint, window,
+                                                    threshold=threshold)
+        return matrix
+
+    def discriminative_scores(self, positive_ids, negative_ids, slope_constraint, window):
+        """
+        (pos_aves, neg_aves) of discriminative_guided_warp: the mean distance of each positive prototype to the
+        other positives and to the negatives, accumulated in the same order. Only the prototypes that could
+        have the largest neg_aves - pos_aves get exact values, the others get neg_aves = -inf.
+
+        A prototype whose upper bound of the score is below the largest lower bound of a score is skipped,
+        the others are computed in one batch, abandoning the positive distances that would bring their score
+        below that lower bound.
+        """
+        pos_k, neg_k = len(positive_ids), len(negative_ids)
+        pos_p, pos_s = np.nonzero(~np.eye(pos_k, dtype=bool))
+        neg_p, neg_s = np.divmod(np.arange(pos_k * neg_k), neg_k)
+        pos_lower = self.lower_bounds(positive_ids[pos_p], positive_ids[pos_s], slope_constraint, window)
+        pos_upper = self.upper_bounds(positive_ids[pos_p], positive_ids[pos_s], slope_constraint, window)
+        neg_lower = self.lower_bounds(positive_ids[neg_p], negative_ids[neg_s], slope_constraint, window)
+        neg_upper = self.upper_bounds(positive_ids[neg_p], negative_ids[neg_s], slope_constraint, window)
+        pos_weight = 1. / (pos_k - 1.) if pos_k > 1 else 0.
+        pos_lower_sums = np.bincount(pos_p, pos_lower, minlength=pos_k)
+        neg_upper_aves = np.bincount(neg_p, neg_upper, minlength=pos_k) / neg_k
+        upper = neg_upper_aves - pos_lower_sums * pos_weight
+        lower = np.bincount(neg_p, neg_lower, minlength=pos_k) / neg_k - np.bincount(pos_p, pos_upper, minlength=pos_k) * pos_weight
+        best = lower.max()
+
+        candidates = upper >= best - _slack * abs(best)
+        pos_pairs, neg_pairs = candidates[pos_p], candidates[neg_p]
+        # a positive distance larger than this makes the score fall below the best lower bound
+        threshold = (neg_upper_aves[pos_p[pos_pairs]] - best) / pos_weight - (pos_lower_sums[pos_p[pos_pairs]] - pos_lower[pos_pairs]) if pos_k > 1 else np.zeros(0)
+        threshold = threshold + _slack * np.abs(threshold)
+        dists = self.distances(np.concatenate([positive_ids[pos_p[pos_pairs]], positive_ids[neg_p[neg_pairs]]]),
+                               np.concatenate([positive_ids[pos_s[pos_pairs]], negative_ids[neg_s[neg_pairs]]]),
+                               slope_constraint, window,
+                               threshold=np.concatenate([threshold, np.full(neg_pairs.sum(), np.inf)]))
+        pos_dists, neg_dists = dists[:pos_pairs.sum()], dists[pos_pairs.sum():]
+
+        pos_aves = np.zeros(pos_k)
+        neg_aves = np.full(pos_k, -np.inf)
+        for p in np.where(candidates)[0]:
+            if np.isinf(pos_dists[pos_p[pos_pairs] == p]).any():
+                continue
+            pos_ave, neg_ave = 0., 0.
+            for d in pos_dists[pos_p[pos_pairs] == p]:
+                pos_ave += (1./(pos_k-1.))*d
+            for d in neg_dists[neg_p[neg_pairs] == p]:
+                neg_ave += (1./neg_k)*d
+            pos_aves[p], neg_aves[p] = pos_ave, neg_ave
+        return pos_aves, neg_aves
@@ -1,3 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 from numpy import array, zeros, full, argmin, inf, ndim
 from scipy.spatial.distance import cdist
 from math import isinf
@@ -97,6 +100,72 @@ def accelerated_dtw(x, y, dist, warp=1):
     return D1[-1, -1], C, D1, path
 
 
+def banded_dtw(x, y, window=None):
+    """
+    DTW distances of many pairs of 1-D sequences at once, with the absolute difference as cost (the
+    distance of `accelerated_dtw(x[k], y[k], dist=lambda a, b: np.abs(a - b))`, equal to it without a window).
+
+    The dynamic program runs over the anti-diagonals of all the pairs together and only keeps the last two
+    diagonals of the Sakoe-Chiba band, so time and memory grow with the band width instead of the full matrix.
+
+    :param x: (B, n) array
+    :param y: (B, m) array
+    :param window: Sakoe-Chiba band, cells with |i-j| > window are not reachable. None for no band.
+    :return: (B,) distances (inf when the band cannot connect the two ends)
+    """
+    b, n = x.shape
+    m = y.shape[1]
+    w = max(n, m) if window is None else int(window)
+    # slot s of a diagonal d holds the cell (i, j) with i - j = s - w - 1, i + j = d; slots 0 and 2w+2 stay inf
+    k = np.arange(-w - 1, w + 2)
+    inner = slice(1, 2 * w + 2)
+    prev2 = full((b, 2 * w + 3), inf)
+    prev1 = full((b, 2 * w + 3), inf)
+    prev2[:, w + 1] = 0.  # D[0, 0]
+    for d in range(2, n + m + 1):
+        i = (d + k[inner]) // 2
+        j = d - i
+        valid = ((d + k[inner]) % 2 == 0) & (i >= 1) & (i <= n) & (j >= 1) & (j <= m)
+        # cost in the precision of the inputs like cdist, accumulated in float64
+        cost = np.abs(x[:, np.clip(i - 1, 0, n - 1)] - y[:, np.clip(j - 1, 0, m - 1)]).astype(np.float64)
+        # diagonal (i-1, j-1) on d-2, left (i, j-1) and up (i-1, j) on d-1
+        step = np.minimum(np.minimum(prev2[:, inner], prev1[:, 2:]), prev1[:, :-2])
+        cur = full((b, 2 * w + 3), inf)
+        cur[:, inner] = np.where(valid, cost + step, inf)
+        prev2, prev1 = prev1, cur
+    if abs(n - m) > w:
+        return full(b, inf)
+    return prev1[:, n - m + w + 1]
+
+
+def _banded_dtw(task):
+    return banded_dtw(*task)
+
+
+def batch_dtw(preds, trues, window=None, batch_size=256, num_workers=0):
+    """
+    DTW metric of a whole forecast: the DTW distance between every flattened prediction and its ground truth,
+    as `Exp_Long_Term_Forecast.test` computes it sample by sample with `accelerated_dtw`.
+
+    :param preds: (N, pred_len, C) predictions
+    :param trues: (N, pred_len, C) ground truth
+    :param window: Sakoe-Chiba band in time steps (window * C positions of the flattened samples), None for none.
+    :param batch_size: number of samples run through the dynamic program together.
+    :param num_workers: shard the batches across a process pool of this size when > 0.
+    :return: (N,) distances
+    """
+    x = preds.reshape(len(preds), -1)
+    y = trues.reshape(len(trues), -1)
+    band = None if window is None else window * preds.shape[-1]
+    tasks = [(x[i:i + batch_size], y[i:i + batch_size], band) for i in range(0, len(x), batch_size)]
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            dists = list(pool.map(_banded_dtw, tasks))
+    else:
+        dists = [_banded_dtw(task) for task in tasks]
+    return np.concatenate(dists) if dists else np.zeros(0)
+
+
 def _traceback(D):
     i, j = array(D.shape) - 2
     p, q = [i], [j]
@@ -0,0 +1,280 @@
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# bar columns the indicators are computed from and the columns `CryptoDataLoader.add_indicators` adds, in order
+bar_columns = ['date', 'open', 'high', 'low', 'OT', 'volume']
+indicator_columns = ['SMA_10', 'EMA_10', 'RSI', 'MACD', 'MACD_signal', 'MACD_diff', 'VWAP', 'Volume_Ratio',
+                     'Volume_Momentum', 'STD_20', 'ATR', 'Bollinger_High', 'Bollinger_Low', 'CMO_14', 'Volume_MA_20']
+
+
+def _divide(a, b):
+    # float division with the numpy semantics of the vectorized version (x/0 = +-inf, 0/0 = nan)
+    if b == 0:
+        return math.nan if a == 0 or a != a else math.copysign(math.inf, a) * math.copysign(1., b)
+    return a / b
+
+
+class RollingSum:
+    """
+    Fixed window rolling sum (or mean) of pandas `Series.rolling(window).sum()` / `.mean()`, one value at a time.
+    Keeps the Kahan compensated running sum of pandas' online algorithm so that the results are the same bits.
+    """
+
+    def __init__(self, window, mean=False):
+        self.window = window
+        self.mean = mean
+        self.values = deque()
+        self.nobs = 0
+        self.neg_ct = 0
+        self.sum_x = 0.
+        self.compensation_add = 0.
+        self.compensation_remove = 0.
+        self.num_consecutive_same_value = 0
+        self.prev_value = None
+
+    def update(self, val):
+        if self.prev_value is None:
+            self.prev_value = val
+        self.values.append(val)
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            if old == old:
+                self.nobs -= 1
+                y = -old - self.compensation_remove
+                t = self.sum_x + y
+                self.compensation_remove = t - self.sum_x - y
+                self.sum_x = t
+                self.neg_ct -= math.copysign(1., old) < 0
+        if val == val:
+            self.nobs += 1
+            y = val - self.compensation_add
+            t = self.sum_x + y
+            self.compensation_add = t - self.sum_x - y
+            self.sum_x = t
+            self.neg_ct += math.copysign(1., val) < 0
+            self.num_consecutive_same_value = self.num_consecutive_same_value + 1 if val == self.prev_value else 1
+            self.prev_value = val
+
+        if self.nobs < self.window:
+            return math.nan
+        if not self.mean:
+            if self.num_consecutive_same_value >= self.nobs:
+                return self.prev_value * self.nobs
+            return self.sum_x
+        result = self.sum_x / self.nobs
+        if self.num_consecutive_same_value >= self.nobs:
+            result = self.prev_value
+        elif self.neg_ct == 0 and result < 0:
+            result = 0.
+        elif self.neg_ct == self.nobs and result > 0:
+            result = 0.
+        return result
+
+
+class RollingStd:
+    """
+    Fixed window rolling standard deviation of pandas `Series.rolling(window).std(ddof)`, one value at a time,
+    with pandas' online Welford / Kahan updates.
+    """
+
+    def __init__(self, window, ddof=1):
+        self.window = window
+        self.ddof = ddof
+        self.values = deque()
+        self.nobs = 0.
+        self.mean_x = 0.
+        self.ssqdm_x = 0.
+        self.compensation_add = 0.
+        self.compensation_remove = 0.
+        self.num_consecutive_same_value = 0
+        self.prev_value = None
+
+    def update(self, val):
+        if self.prev_value is None:
+            self.prev_value = val
+        self.values.append(val)
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            if old == old:
+                self.nobs -= 1
+                if self.nobs:
+                    prev_mean = self.mean_x - self.compensation_remove
+                    y = old - self.compensation_remove
+                    t = y - self.mean_x
+                    self.compensation_remove = t + self.mean_x - y
+                    self.mean_x = self.mean_x - t / self.nobs
+                    self.ssqdm_x = self.ssqdm_x - (old - prev_mean) * (old - self.mean_x)
+                else:
+                    self.mean_x = 0.
+                    self.ssqdm_x = 0.
+        if val == val:
+            self.nobs += 1
+            self.num_consecutive_same_value = self.num_consecutive_same_value + 1 if val == self.prev_value else 1
+            self.prev_value = val
+            prev_mean = self.mean_x - self.compensation_add
+            y = val - self.compensation_add
+            t = y - self.mean_x
+            self.compensation_add = t + self.mean_x - y
+            self.mean_x = self.mean_x + t / self.nobs
+            self.ssqdm_x = self.ssqdm_x + (val - prev_mean) * (val - self.mean_x)
+
+        if self.nobs < self.window or self.nobs <= self.ddof:
+            return math.nan
+        if self.nobs == 1 or self.num_consecutive_same_value >= self.nobs:
+            return 0.
+        var = self.ssqdm_x / (self.nobs - self.ddof)
+        return math.sqrt(var) if var >= 0 else 0.
+
+
+class EWMMean:
+    """
+    Exponentially weighted mean of pandas `Series.ewm(..., adjust=False).mean()`, one value at a time.
+
+    :param span: decay as a span, or
+    :param alpha: decay as a smoothing factor.
+    """
+
+    def __init__(self, span=None, alpha=None, min_periods=0):
+        com = (span - 1) / 2 if span is not None else (1. - alpha) / alpha
+        self.alpha = 1. / (1. + com)
+        self.old_wt_factor = 1. - self.alpha
+        self.min_periods = max(min_periods, 1)
+        self.weighted = None
+        self.old_wt = 1.
+        self.nobs = 0
+
+    def update(self, cur):
+        observation = cur == cur
+        self.nobs += observation
+        if self.weighted is None:
+            self.weighted = cur
+        elif self.weighted == self.weighted:
+            self.old_wt *= self.old_wt_factor
+            if observation:
+                if self.weighted != cur:
+                    self.weighted = (self.old_wt * self.weighted + self.alpha * cur) / (self.old_wt + self.alpha)
+                self.old_wt = 1.
+        elif observation:
+            self.weighted = cur
+        return self.weighted if self.nobs >= self.min_periods else math.nan
+
+
+class AverageTrueRange:
+    """
+    `ta.volatility.average_true_range`: 0 over the first window-1 bars, then the mean true range of the first
+    window bars followed by Wilder's smoothing.
+    """
+
+    def __init__(self, window=14):
+        self.window = window
+        self.first = []
+        self.atr = 0.
+        self.prev_close = None
+
+    def update(self, high, low, close):
+        tr = high - low
+        if self.prev_close is not None:
+            tr = np.nanmax([tr, abs(high - self.prev_close), abs(low - self.prev_close)])
+        self.prev_close = close
+        if len(self.first) < self.window:
+            self.first.append(tr)
+            if len(self.first) == self.window:
+                self.atr = np.array(self.first).sum() / self.window
+            return self.atr
+        self.atr = (self.atr * (self.window - 1) + tr) / float(self.window)
+        return self.atr
+
+
+class IndicatorEngine:
+    """
+    Stateful version of `CryptoDataLoader.add_indicators`: keeps the rolling sums, EMA states and Wilder averages
+    of the bars seen so far and only computes the rows of new bars, so the cost of an update does not grow with
+    the history.
+
+    The rows returned by successive `update` calls concatenated are the same columns and values (bit for bit)
+    as `add_indicators` over all the bars at once, including the rows it drops and the index of the others.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last_date = None
+        self.prev_close = None
+        self.prev_volume = None
+        self.cum_pv = 0.
+        self.cum_volume = 0.
+        self.sma = RollingSum(10, mean=True)
+        self.ema = EWMMean(span=10, min_periods=10)
+        self.rsi_up = EWMMean(alpha=1 / 14, min_periods=14)
+        self.rsi_down = EWMMean(alpha=1 / 14, min_periods=14)
+        self.macd_fast = EWMMean(span=12, min_periods=12)
+        self.macd_slow = EWMMean(span=26, min_periods=26)
+        self.macd_signal = EWMMean(span=9, min_periods=9)
+        self.std = RollingStd(20)
+        self.atr = AverageTrueRange(14)
+        self.bollinger_mavg = RollingSum(20, mean=True)
+        self.bollinger_std = RollingStd(20, ddof=0)
+        self.cmo_gains = RollingSum(14)
+        self.cmo_losses = RollingSum(14)
+        self.volume_ma = RollingSum(20, mean=True)
+
+    def step(self, high, low, close, volume):
+        """
+        Indicator values (in the order of `indicator_columns`) of the next bar.
+        """
+        diff = close - self.prev_close if self.prev_close is not None else math.nan
+
+        sma = self.sma.update(close)
+        ema = self.ema.update(close)
+
+        emaup = self.rsi_up.update(diff if diff > 0 else 0.)
+        emadn = self.rsi_down.update(-(diff if diff < 0 else 0.))
+        rsi = 100. if emadn == 0 else 100 - (100 / (1 + _divide(emaup, emadn)))
+
+        fast, slow = self.macd_fast.update(close), self.macd_slow.update(close)
+        macd = fast - slow
+        macd_signal = self.macd_signal.update(macd)
+
+        self.cum_pv += volume * (high + low + close) / 3
+        self.cum_volume += volume
+        vwap = _divide(self.cum_pv, self.cum_volume)
+        if self.prev_volume is not None:
+            volume_ratio, volume_momentum = _divide(volume, self.prev_volume), volume - self.prev_volume
+        else:
+            volume_ratio, volume_momentum = math.nan, math.nan
+
+        std = self.std.update(close)
+        atr = self.atr.update(high, low, close)
+        mavg, mstd = self.bollinger_mavg.update(close), self.bollinger_std.update(close)
+
+        gains = self.cmo_gains.update(diff if diff > 0 else 0.)
+        losses = self.cmo_losses.update(-diff if diff < 0 else 0.)
+        cmo = _divide(100 * (gains - losses), gains + losses)
+
+        volume_ma = self.volume_ma.update(volume)
+
+        self.prev_close, self.prev_volume = close, volume
+        return (sma, ema, rsi, macd, macd_signal, macd - macd_signal, vwap, volume_ratio, volume_momentum,
+                std, atr, mavg + 2 * mstd, mavg - 2 * mstd, cmo, volume_ma)
+
+    def update(self, bars):
+        """
+        Adds new bars and returns their rows with the indicators, without the rows `add_indicators` drops.
+
+        :param bars: DataFrame of the new bars with (at least) the columns of `bar_columns`, oldest first.
+        """
+        bars = bars[bar_columns].reset_index(drop=True)
+        columns = [bars[c].to_numpy(dtype=np.float64) for c in ('high', 'low', 'OT', 'volume')]
+        values = np.array([self.step(*bar) for bar in zip(*(c.tolist() for c in columns))],
+                          dtype=np.float64).reshape(len(bars), len(indicator_columns))
+        # add_indicators turns the infinite values into missing ones and drops their rows with the warm-up rows
+        values[np.isinf(values)] = np.nan
+
+        index = pd.RangeIndex(self.count, self.count + len(bars))
+        df = pd.concat([bars.set_axis(index), pd.DataFrame(values, columns=indicator_columns, index=index)], axis=1)
+        self.count += len(bars)
+        if len(bars) > 0:
+            self.last_date = bars['date'].iloc[-1]
+        return df.dropna()
@@ -0,0 +1,134 @@
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from utils.timefeatures import time_stamp
+
+
+class InferenceSession:
+    """
+    Warm state of the realtime forecaster between ticks. The model inputs live in buffers preallocated on the
+    device for seq_len / label_len / pred_len, every tick only writes the bars newer than the previous one:
+    the older rows are shifted in place (between two ping-pong buffers), the window is standardized on the
+    device like `Dataset_BTC_RT_minute` does with its StandardScaler, and the decoder input is refreshed from
+    the tail of the window. The marks of the forecast are recomputed from the last bar on every tick, the bars
+    are not always one minute apart.
+
+    The model runs under torch.inference_mode and the inverse scaling of the outputs is one fused tensor op.
+    The wall time of the stages of the last tick is kept in `latency` (ms).
+
+    :param columns: value columns of the bars, in the order of the dataset (target last).
+    """
+
+    def __init__(self, model, args, columns, device):
+        self.model = model
+        self.args = args
+        self.device = device
+        self.timeenc = 0 if args.embed != 'timeF' else 1
+        self.columns = [c for c in columns if c != args.target] + [args.target] \
+            if args.features in ('M', 'MS') else [args.target]
+        self.seq_len, self.label_len, self.pred_len = args.seq_len, args.label_len, args.pred_len
+        dims = len(self.columns)
+        marks = time_stamp(pd.DatetimeIndex([pd.Timestamp(0)]), self.timeenc, args.freq, minute_unit=1).shape[1]
+
+        def buffer(*shape, dtype=torch.float32):
+            return torch.zeros(shape, dtype=dtype, device=device)
+
+        self.raw = [buffer(self.seq_len, dims, dtype=torch.float64) for _ in range(2)]
+        self.marks = [buffer(self.seq_len, marks) for _ in range(2)]
+        self.future_marks = buffer(self.pred_len, marks)
+        self.scaled = buffer(self.seq_len, dims, dtype=torch.float64)
+        self.mean = buffer(dims, dtype=torch.float64)
+        self.std = buffer(dims, dtype=torch.float64)
+        self.x_enc = buffer(1, self.seq_len, dims)
+        self.x_mark_enc = buffer(1, self.seq_len, marks)
+        self.x_dec = buffer(1, self.label_len + self.pred_len, dims)
+        self.x_mark_dec = buffer(1, self.label_len + self.pred_len, marks)
+        self.last_time = None
+        self.latency = {}
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def _shift(self, buffers, new):
+        # drop the len(new) oldest rows and append `new`, writing into the other buffer of the pair
+        k = new.shape[0]
+        current, other = buffers
+        if k < current.shape[0]:
+            other[:-k].copy_(current[k:])
+        other[-k:].copy_(new[-other.shape[0]:])
+        buffers.reverse()
+
+    def update(self, bars):
+        """
+        Feeds the bars of the current window (a 'date' column and the value columns, oldest first) and returns
+        the number of new bars written; 0 when there is nothing newer than the previous tick, None when the
+        first window is shorter than seq_len.
+        """
+        start = time.perf_counter()
+        if self.last_time is not None:
+            bars = bars[bars['date'] > self.last_time]
+        bars = bars.iloc[-self.seq_len:]
+        k = len(bars)
+        if self.last_time is None and k < self.seq_len:
+            return None
+        if k == 0:
+            return 0
+        dates = pd.DatetimeIndex(bars['date'])
+        self.last_time = dates[-1]
+
+        values = torch.as_tensor(bars[self.columns].to_numpy(dtype=np.float64), device=self.device)
+        marks = torch.as_tensor(time_stamp(dates, self.timeenc, self.args.freq, minute_unit=1), device=self.device)
+        future = pd.date_range(self.last_time, periods=self.pred_len + 1, freq='min')[1:]
+        self.future_marks.copy_(torch.as_tensor(time_stamp(future, self.timeenc, self.args.freq, minute_unit=1)))
+        self._shift(self.raw, values)
+        self._shift(self.marks, marks)
+
+        # StandardScaler of the window: population std, constant columns keep a scale of 1
+        raw = self.raw[0]
+        torch.mean(raw, dim=0, out=self.mean)
+        torch.std(raw, dim=0, unbiased=False, out=self.std)
+        self.std.masked_fill_(self.std < 10 * np.finfo(np.float64).eps, 1.)
+        torch.sub(raw, self.mean, out=self.scaled).div_(self.std)
+
+        self.x_enc[0].copy_(self.scaled)
+        self.x_mark_enc[0].copy_(self.marks[0])
+        self.x_dec[0, :self.label_len].copy_(self.x_enc[0, -self.label_len:])
+        self.x_mark_dec[0, :self.label_len].copy_(self.x_mark_enc[0, -self.label_len:])
+        self.x_mark_dec[0, self.label_len:].copy_(self.future_marks)
+        self._synchronize()
+        self.latency['feature update'] = (time.perf_counter() - start) * 1000
+        return k
+
+    def forward(self):
+        start = time.perf_counter()
+        with torch.inference_mode():
+            if self.args.use_amp:
+                with torch.cuda.amp.autocast():
+                    outputs = self.model(self.x_enc, self.x_mark_enc, self.x_dec, self.x_mark_dec)
+            else:
+                outputs = self.model(self.x_enc, self.x_mark_enc, self.x_dec, self.x_mark_dec)
+            if self.args.output_attention:
+                outputs = outputs[0]
+        self._synchronize()
+        self.latency['forward'] = (time.perf_counter() - start) * 1000
+        return outputs
+
+    def postprocess(self, outputs):
+        """
+        (predicted, true) target prices of the forecast and of the window, in prices with args.inverse.
+        """
+        start = time.perf_counter()
+        with torch.inference_mode():
+            outputs = outputs[0, -self.pred_len:, -1]
+            if self.args.inverse:
+                predicted = torch.addcmul(self.mean[-1], outputs.double(), self.std[-1])
+                true = self.raw[0][:, -1]
+            else:
+                predicted, true = outputs, self.x_enc[0, :, -1]
+            predicted, true = predicted.cpu().numpy(), true.cpu().numpy()
+        self.latency['postprocess'] = (time.perf_counter() - start) * 1000
+        return predicted, true
@@ -15,12 +15,14 @@
 """
 M4 Summary
 """
+import hashlib
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-from data_provider.m4 import M4Dataset
+from data_provider.m4 import M4Dataset, pack_series
 from data_provider.m4 import M4Meta
 import os
 
@@ -47,12 +49,112 @@ def mape(forecast, target):
     return 100 * np.abs(forecast - target) / denom
 
 
+def seasonal_scale(values, offsets, frequency):
+    """
+    MASE scale of packed series: the mean absolute difference between values `frequency` steps apart
+    in every series, for all series at once.
+
+    :param values: packed insample values, series i is values[offsets[i]:offsets[i + 1]].
+    :return: (timeseries,) scales.
+    """
+    lengths = np.diff(offsets)
+    series = np.repeat(np.arange(len(lengths)), lengths)
+    position = np.arange(len(values)) - offsets[series]
+    t = np.nonzero(position >= frequency)[0]
+    diff = np.abs(values[t] - values[t - frequency])
+    return np.bincount(series[t], weights=diff, minlength=len(lengths)) / (lengths - frequency)
+
+
+def group_scores(forecast, target, scale):
+    """
+    sMAPE, MAPE and MASE of the forecasts of one group, all series of a group have the same horizon.
+
+    :param forecast: Forecasts. Shape: timeseries, time.
+    :param target: Shape: timeseries, time.
+    :param scale: MASE scales of the series, see `seasonal_scale`.
+    """
+    mases = np.mean(np.abs(forecast - target), axis=1) / scale
+    return np.mean(smape_2(forecast, target)), np.mean(mape(forecast, target)), np.mean(mases)
+
+
+def _group_scores(task):
+    return group_scores(*task)
+
+
+# M4 data loaded in the current process: root path -> (groups, {group: (target, scale)})
+_m4_data = {}
+# Naive2 scores computed in the current process: cache key -> {group: (smape, mase)}
+_naive2_scores = {}
+
+
 class M4Summary:
-    def __init__(self, file_path, root_path):
+    def __init__(self, file_path, root_path, cache=False, num_workers=0):
+        """
+        :param cache: store the Naive2 scores next to submission-Naive2.csv for later runs.
+        :param num_workers: evaluate the seasonal groups in this many processes, 0 to evaluate in this process.
+        """
         self.file_path = file_path
-        self.training_set = M4Dataset.load(training=True, dataset_file=root_path)
-        self.test_set = M4Dataset.load(training=False, dataset_file=root_path)
+        self.root_path = root_path
         self.naive_path = os.path.join(root_path, 'submission-Naive2.csv')
+        self.cache = cache
+        self.num_workers = num_workers
+        self.groups, self.group_data = self.load_data()
+
+    def load_data(self):
+        """
+        Test targets and MASE scales of every group, loaded once per process.
+        """
+        key = os.path.abspath(self.root_path)
+        if key not in _m4_data:
+            training_set = M4Dataset.load(training=True, dataset_file=self.root_path)
+            test_set = M4Dataset.load(training=False, dataset_file=self.root_path)
+            group_data = {}
+            for group_name in M4Meta.seasonal_patterns:
+                group = test_set.groups == group_name
+                target, _ = pack_series(test_set.values[group], dtype=np.float64)
+                insample, offsets = pack_series(training_set.values[group], dtype=np.float64)
+                # all timeseries within group have same frequency
+                frequency = training_set.frequencies[group][0]
+                group_data[group_name] = (target.reshape(np.count_nonzero(group), -1),
+                                          seasonal_scale(insample, offsets, frequency))
+            _m4_data[key] = test_set.groups, group_data
+        return _m4_data[key]
+
+    def score_groups(self, forecasts):
+        """
+        :param forecasts: {group: forecasts of the group}
+        :return: {group: (smape, mape, mase)}
+        """
+        tasks = [(forecasts[g],) + self.group_data[g] for g in M4Meta.seasonal_patterns]
+        if self.num_workers > 0:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+                scores = list(pool.map(_group_scores, tasks))
+        else:
+            scores = [group_scores(*task) for task in tasks]
+        return dict(zip(M4Meta.seasonal_patterns, scores))
+
+    def naive2_scores(self):
+        """
+        sMAPE and MASE of the Naive2 forecasts per group, computed once per process (and once per dataset
+        with `cache`).
+        """
+        stat = os.stat(self.naive_path)
+        fields = [os.path.abspath(self.naive_path), stat.st_mtime_ns, stat.st_size]
+        key = hashlib.md5('|'.join(map(str, fields)).encode()).hexdigest()[:16]
+        cache_file = os.path.join(self.root_path, 'naive2_scores.{}.npy'.format(key))
+        if key not in _naive2_scores and self.cache and os.path.exists(cache_file):
+            _naive2_scores[key] = dict(zip(M4Meta.seasonal_patterns, map(tuple, np.load(cache_file))))
+        if key not in _naive2_scores:
+            naive2_forecasts = pd.read_csv(self.naive_path).values[:, 1:].astype(np.float32)
+            forecasts = {}
+            for group_name in M4Meta.seasonal_patterns:
+                group = naive2_forecasts[self.groups == group_name]
+                forecasts[group_name] = group[~np.isnan(group)].reshape(len(group), -1)
+            scores = self.score_groups(forecasts)
+            _naive2_scores[key] = {g: (scores[g][0], scores[g][2]) for g in M4Meta.seasonal_patterns}
+        if self.cache and not os.path.exists(cache_file):
+            np.save(cache_file, np.array([_naive2_scores[key][g] for g in M4Meta.seasonal_patterns]))
+        return _naive2_scores[key]
 
     def evaluate(self):
         """
@@ -63,43 +165,16 @@ class M4Summary:
         """
         grouped_owa = OrderedDict()
 
-        naive2_forecasts = pd.read_csv(self.naive_path).values[:, 1:].astype(np.float32)
-        naive2_forecasts = np.array([v[~np.isnan(v)] for v in naive2_forecasts])
-
-        model_mases = {}
-        naive2_smapes = {}
-        naive2_mases = {}
-        grouped_smapes = {}
-        grouped_mapes = {}
-        for group_name in M4Meta.seasonal_patterns:
-            file_name = self.file_path + group_name + "_forecast.csv"
-            if os.path.exists(file_name):
-                model_forecast = pd.read_csv(file_name).values
-
-            naive2_forecast = group_values(naive2_forecasts, self.test_set.groups, group_name)
-            target = group_values(self.test_set.values, self.test_set.groups, group_name)
-            # all timeseries within group have same frequency
-            frequency = self.training_set.frequencies[self.test_set.groups == group_name][0]
-            insample = group_values(self.training_set.values, self.test_set.groups, group_name)
-
-            model_mases[group_name] = np.mean([mase(forecast=model_forecast[i],
-                                                    insample=insample[i],
-                                                    outsample=target[i],
-                                                    frequency=frequency) for i in range(len(model_forecast))])
-            naive2_mases[group_name] = np.mean([mase(forecast=naive2_forecast[i],
-                                                     insample=insample[i],
-                                                     outsample=target[i],
-                                                     frequency=frequency) for i in range(len(model_forecast))])
-
-            naive2_smapes[group_name] = np.mean(smape_2(naive2_forecast, target))
-            grouped_smapes[group_name] = np.mean(smape_2(forecast=model_forecast, target=target))
-            grouped_mapes[group_name] = np.mean(mape(forecast=model_forecast, target=target))
-
-        grouped_smapes = self.summarize_groups(grouped_smapes)
-        grouped_mapes = self.summarize_groups(grouped_mapes)
-        grouped_model_mases = self.summarize_groups(model_mases)
-        grouped_naive2_smapes = self.summarize_groups(naive2_smapes)
-        grouped_naive2_mases = self.summarize_groups(naive2_mases)
+        naive2 = self.naive2_scores()
+        forecasts = {g: pd.read_csv(self.file_path + g + "_forecast.csv").values
+                     for g in M4Meta.seasonal_patterns}
+        scores = self.score_groups(forecasts)
+
+        grouped_smapes = self.summarize_groups({g: scores[g][0] for g in scores})
+        grouped_mapes = self.summarize_groups({g: scores[g][1] for g in scores})
+        grouped_model_mases = self.summarize_groups({g: scores[g][2] for g in scores})
+        grouped_naive2_smapes = self.summarize_groups({g: naive2[g][0] for g in naive2})
+        grouped_naive2_mases = self.summarize_groups({g: naive2[g][1] for g in naive2})
         for k in grouped_model_mases.keys():
             grouped_owa[k] = (grouped_model_mases[k] / grouped_naive2_mases[k] +
                               grouped_smapes[k] / grouped_naive2_smapes[k]) / 2
@@ -119,7 +194,7 @@ class M4Summary:
         scores_summary = OrderedDict()
 
         def group_count(group_name):
-            return len(np.where(self.test_set.groups == group_name)[0])
+            return len(np.where(self.groups == group_name)[0])
 
         weighted_score = {}
         for g in ['Yearly', 'Quarterly', 'Monthly']:
@@ -134,7 +209,7 @@ class M4Summary:
         weighted_score['Others'] = others_score
         scores_summary['Others'] = others_score / others_count
 
-        average = np.sum(list(weighted_score.values())) / len(self.test_set.groups)
+        average = np.sum(list(weighted_score.values())) / len(self.groups)
         scores_summary['Average'] = average
 
         return scores_summary
@@ -0,0 +1,255 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_provider.readers import read_frame
+from utils.bar_log import BarLog
+
+
+class NetworkError(Exception):
+    """
+    Transient failure of a request (timeouts, dropped connections, rate limiting), worth retrying.
+    """
+
+
+class ExchangeError(Exception):
+    """
+    Request rejected by the exchange.
+    """
+
+
+class RateLimitExceeded(NetworkError):
+    pass
+
+
+class MarketDataSource:
+    """
+    Source of OHLCV bars for `CryptoDataLoader`, with the subset of the ccxt exchange interface it uses:
+    `fetch_ohlcv` returns [[time in ms, open, high, low, close, volume], ...] oldest first, at most `limit`
+    bars from `since` on, and raises the `NetworkError` / `ExchangeError` of this module. `rateLimit` is the
+    number of milliseconds to wait between two requests.
+    """
+
+    rateLimit = 0
+
+    def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+        raise NotImplementedError
+
+    def milliseconds(self):
+        # current time of the source, in ms since the epoch
+        return int(time.time() * 1000)
+
+    def parse8601(self, text):
+        # naive times are UTC, like ccxt
+        return int(pd.Timestamp(text).value // 10 ** 6)
+
+
+class CcxtSource(MarketDataSource):
+    """
+    Bars of a ccxt exchange.
+
+    :param exchange_name: ccxt exchange id, e.g. 'binance'.
+    :param proxy: proxy url of the http and https requests, e.g. http://127.0.0.1:4780; None for a direct
+        connection (or the proxy of the environment).
+    """
+
+    def __init__(self, exchange_name='binance', proxy=None):
+        import ccxt
+        self.ccxt = ccxt
+        config = {'proxies': {'http': proxy, 'https': proxy}} if proxy else {}
+        self.exchange = getattr(ccxt, exchange_name)(config)
+        self.rateLimit = self.exchange.rateLimit
+
+    def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+        try:
+            return self.exchange.fetch_ohlcv(symbol, timeframe, since=since, limit=limit)
+        except self.ccxt.NetworkError as e:
+            raise NetworkError(str(e)) from e
+        except self.ccxt.ExchangeError as e:
+            raise ExchangeError(str(e)) from e
+
+    def milliseconds(self):
+        return self.exchange.milliseconds()
+
+    def parse8601(self, text):
+        return self.exchange.parse8601(text)
+
+
+class SimulatedExchange(MarketDataSource):
+    """
+    Local exchange replaying the bars of a file (csv / parquet / feather with a 'date' or 'timestamp' column,
+    or a bar log), for tests and load tests of the realtime path without network access.
+
+    The bars released so far are the ones at or before the simulated clock. The clock starts at `start` (the
+    last bar by default, everything is released) and is moved by `advance()`, or runs `speed` times faster than
+    the wall clock. Every request waits `latency` seconds, returns at most `page_size` bars, fails with
+    `RateLimitExceeded` when it comes less than `rate_limit` ms after the previous one, and fails with a
+    `NetworkError` / `ExchangeError` with the given probabilities, drawn from a generator seeded with `seed`
+    (the same requests fail on every run). Counters of the requests are kept in `stats`.
+
+    :param path: file of the bars to replay.
+    :param start: time of the clock at the start, e.g. 2024-06-20 00:00:00.
+    :param speed: simulated seconds per wall clock second; None to move the clock only by `advance()`.
+    """
+
+    def __init__(self, path, start=None, speed=None, latency=0., rate_limit=0., page_size=1000,
+                 network_error_rate=0., exchange_error_rate=0., seed=0):
+        df = self.read_bars(path)
+        self.times = df['timestamp'].to_numpy(dtype=np.int64)
+        self.bars = df[['open', 'high', 'low', 'close', 'volume']].to_numpy(dtype=np.float64)
+        self.step = int(np.median(np.diff(self.times))) if len(self.times) > 1 else 60000
+        self.rateLimit = rate_limit
+        self.latency = latency
+        self.page_size = page_size
+        self.network_error_rate = network_error_rate
+        self.exchange_error_rate = exchange_error_rate
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bars': 0, 'network_errors': 0, 'exchange_errors': 0, 'rate_limited': 0}
+
+        self.start = self.parse8601(start) if start is not None else int(self.times[-1]) if len(self.times) else 0
+        self.speed = speed
+        self.now = self.start
+        self.wall_start = time.monotonic()
+        self.last_request = None
+
+    @staticmethod
+    def read_bars(path):
+        if os.path.splitext(path)[1] == '.bars':
+            log = BarLog(path, writable=False)
+            df = log.frame()
+            log.close()
+        else:
+            df = read_frame(path)
+        if 'timestamp' not in df.columns:
+            df['timestamp'] = pd.to_datetime(df['date']).values.astype('datetime64[ms]').astype(np.int64)
+        if 'close' not in df.columns:
+            df = df.rename(columns={'OT': 'close'})
+        return df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+    def clock(self):
+        """
+        Simulated time in ms since the epoch.
+        """
+        if self.speed is None:
+            return self.now
+        return self.start + int((time.monotonic() - self.wall_start) * 1000 * self.speed)
+
+    def milliseconds(self):
+        return self.clock()
+
+    def advance(self, bars=1):
+        """
+        Moves the manual clock by `bars` bar intervals, releasing the next bars.
+        """
+        self.now += bars * self.step
+
+    def released(self):
+        return int(np.searchsorted(self.times, self.clock(), side='right'))
+
+    def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+        with self.lock:
+            self.stats['requests'] += 1
+            now = time.monotonic()
+            last, self.last_request = self.last_request, now
+            if last is not None and (now - last) * 1000 < self.rateLimit:
+                self.stats['rate_limited'] += 1
+                raise RateLimitExceeded('{} ms between two requests, the rate limit is {} ms'.format(
+                    int((now - last) * 1000), self.rateLimit))
+            draw = self.rng.random()
+            error = 'network' if draw < self.network_error_rate else \
+                'exchange' if draw < self.network_error_rate + self.exchange_error_rate else None
+            if error is not None:
+                self.stats[error + '_errors'] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if error == 'network':
+            raise NetworkError('simulated network error')
+        if error == 'exchange':
+            raise ExchangeError('simulated exchange error')
+
+        stop = self.released()
+        limit = min(limit or self.page_size, self.page_size)
+        if since is None:
+            begin = max(stop - limit, 0)
+        else:
+            begin = int(np.searchsorted(self.times, since))
+        end = min(begin + limit, stop)
+        if end <= begin:
+            return []
+        self.stats['bars'] += end - begin
+        return [[t] + bar for t, bar in zip(self.times[begin:end].tolist(), self.bars[begin:end].tolist())]
+
+
+def market_source(args):
+    """
+    Source of `args.market_source`: the path of a file of bars replays it with a `SimulatedExchange` set up by
+    the --sim_* arguments, anything else is a ccxt exchange id (behind `args.market_proxy`).
+
+    Without --sim_start the replay starts one day after the first bar, the day of history the loader loads by
+    default, and the following bars are released at --sim_speed times the wall clock.
+    """
+    if not os.path.exists(args.market_source):
+        return CcxtSource(args.market_source, args.market_proxy)
+    start = args.sim_start
+    if start is None:
+        first = SimulatedExchange.read_bars(args.market_source)['timestamp'].iloc[0]
+        start = str(pd.Timestamp(first, unit='ms') + pd.Timedelta(days=1))
+    return SimulatedExchange(args.market_source, start=start, speed=args.sim_speed, latency=args.sim_latency,
+                             rate_limit=args.sim_rate_limit, page_size=args.sim_page_size,
+                             network_error_rate=args.sim_network_errors,
+                             exchange_error_rate=args.sim_exchange_errors, seed=args.sim_seed)
+
+
+if __name__ == '__main__':
+    from data_fetcher import CryptoDataLoader
+    # the loader catches the errors of the imported module, not of __main__
+    from utils.market_data import SimulatedExchange
+
+    parser = argparse.ArgumentParser(description='Backfill throughput and tick latency of the data loader '
+                                                 'against a simulated exchange')
+    parser.add_argument('bars', type=str, help='file of the bars to replay')
+    parser.add_argument('--ticks', type=int, default=100, help='bars released one by one after the backfill')
+    parser.add_argument('--latency', type=float, default=0., help='seconds per request')
+    parser.add_argument('--rate_limit', type=float, default=0., help='ms between two requests')
+    parser.add_argument('--page_size', type=int, default=1000, help='bars per request')
+    parser.add_argument('--network_errors', type=float, default=0., help='probability of a network error')
+    parser.add_argument('--exchange_errors', type=float, default=0., help='probability of an exchange error')
+    parser.add_argument('--retry_delay', type=float, default=0., help='seconds before retrying a failed request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    times = SimulatedExchange.read_bars(args.bars)['timestamp']
+    first = pd.Timestamp(times.iloc[0], unit='ms')
+    start = pd.Timestamp(times.iloc[max(len(times) - args.ticks - 1, 0)], unit='ms')
+    source = SimulatedExchange(args.bars, start=str(start), latency=args.latency, rate_limit=args.rate_limit,
+                               page_size=args.page_size, network_error_rate=args.network_errors,
+                               exchange_error_rate=args.exchange_errors, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as folder:
+        with contextlib.redirect_stdout(io.StringIO()):
+            begin = time.perf_counter()
+            loader = CryptoDataLoader(csv_filename=os.path.join(folder, 'bars.csv'), start_time_str=str(first),
+                                      source=source, retry_delay=args.retry_delay)
+            backfill = time.perf_counter() - begin
+            backfilled = source.stats['bars']
+            latency = []
+            for _ in range(args.ticks):
+                source.advance()
+                begin = time.perf_counter()
+                loader.append_new_data(verbose=False)
+                latency.append((time.perf_counter() - begin) * 1000)
+            loader.stop()
+
+    print('backfill: {} bars in {:.3f}s, {:.0f} bars/s'.format(backfilled, backfill, backfilled / backfill))
+    if latency:
+        print('tick latency: median {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms over {} ticks'.format(
+            np.median(latency), np.percentile(latency, 99), np.max(latency), len(latency)))
+    print(', '.join('{}: {}'.format(k, v) for k, v in source.stats.items()))
@@ -12,6 +12,9 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import hashlib
+import os
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -87,9 +90,11 @@ class WeekOfYear(TimeFeature):
         return (index.isocalendar().week - 1) / 52.0 - 0.5
 
 
+@lru_cache(maxsize=None)
 def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
     """
     Returns a list of time features that will be appropriate for the given frequency string.
+    The list is built once per frequency string and shared, do not modify it.
     Parameters
     ----------
     freq_str
@@ -146,3 +151,48 @@ def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
 
 def time_features(dates, freq='h'):
     return np.vstack([feat(dates) for feat in time_features_from_frequency_str(freq)])
+
+
+def calendar_features(dates, minute_unit=None):
+    """
+    Integer calendar fields used with timeenc == 0: month, day, weekday, hour and, if `minute_unit` is given,
+    minute // minute_unit. Shape (len(dates), num_fields).
+    """
+    fields = [dates.month, dates.day, dates.dayofweek, dates.hour]
+    if minute_unit is not None:
+        fields.append(dates.minute // minute_unit)
+    return np.stack([np.asarray(field) for field in fields], axis=1)
+
+
+def time_stamp(dates, timeenc=0, freq='h', minute_unit=None, cache_dir=None):
+    """
+    Time stamp features of the datasets as a float32 array of shape (len(dates), num_features),
+    computed from the DatetimeIndex field arrays for both encodings.
+
+    :param timeenc: 0 for `calendar_features`, 1 for `time_features` of `freq`.
+    :param minute_unit: minute resolution of the timeenc == 0 fields, None to leave the minute out.
+    :param cache_dir: if given, the result is memoized in this directory as a .npy file keyed by the
+        dates, freq and timeenc, and later calls with the same arguments only load it.
+    """
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    path = None
+    if cache_dir is not None:
+        fields = [dates.min(), dates.max(), len(dates), freq, timeenc, minute_unit]
+        key = hashlib.md5('|'.join(map(str, fields)).encode())
+        key.update(dates.asi8.tobytes())
+        path = os.path.join(cache_dir, 'time_stamp.{}.npy'.format(key.hexdigest()[:16]))
+        if os.path.exists(path):
+            return np.load(path)
+
+    if timeenc == 0:
+        stamp = calendar_features(dates, minute_unit)
+    else:
+        stamp = time_features(dates, freq=freq).transpose(1, 0)
+    stamp = stamp.astype(np.float32)
+
+    if path is not None:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, stamp)
+        os.replace(tmp_path, path)
+    return stamp
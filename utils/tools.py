@@ -115,4 +115,17 @@ def adjustment(gt, pred):
 
 
 def cal_accuracy(y_pred, y_true):
-    return np.mean(y_pred == y_true)
\ No newline at end of file
+    return np.mean(y_pred == y_true)
+
+
+def inference_chunk_size(args, num_series):
+    """
+    Number of series per forward pass for batched inference: args.infer_batch if set, otherwise as many
+    series as fit in args.infer_memory MB, estimated from the activations of the encoder/decoder layers
+    (float32, seq_len + label_len + pred_len steps of d_model + d_ff values per layer, with a 2x margin).
+    """
+    if args.infer_batch > 0:
+        return min(args.infer_batch, num_series)
+    steps = args.seq_len + args.label_len + args.pred_len
+    per_series = 4 * 2 * steps * (args.d_model + args.d_ff) * (args.e_layers + args.d_layers)
+    return int(max(1, min(num_series, args.infer_memory * 2 ** 20 // per_series)))